@@ -2,7 +2,15 @@ import streamlit as st
 import pandas as pd
 import os
 import plotly.graph_objects as go
+from datetime import date
 import db # db.pyを読み込み
+import analytics
+import rollups
+import charts
+import photo_upload
+import metrics
+import archive
+import alerts
 
 # --- 1. 画面構成設定 ---
 st.set_page_config(page_title="管理者ダッシュボード", layout="wide")
@@ -23,12 +31,82 @@ def show_sidebar_toggle():
         </style>
     """, unsafe_allow_html=True)
 
+MEAL_PAGE_SIZE = db._config("meal_page_size", 10)
+
+def page_selector(total, key):
+    # 件数からページ数を出して、表示するページ番号（0始まり）を返す
+    n_pages = max(1, -(-total // MEAL_PAGE_SIZE))
+    if n_pages == 1:
+        return 0
+    page = st.number_input(f"ページ（全 {n_pages} ページ / {total} 件）", min_value=1, max_value=n_pages, value=1, step=1, key=key)
+    return int(page) - 1
+
+def show_meal_photo(img_url):
+    # 一覧には縮小版だけを出し、元の写真はリンクを開いたときに読み込む
+    if img_url and isinstance(img_url, str) and img_url.startswith("http"):
+        st.image(photo_upload.thumbnail_url(img_url), use_container_width=True)
+        st.markdown(f"[🔍 元の写真を開く]({img_url})")
+
+def show_perf_panel():
+    # 計測値（metrics.py）の一覧。計測を有効にしている間だけ値が増える
+    with st.expander("⚙️ 性能パネル", expanded=True):
+        c_on, c_reset = st.columns([3, 1])
+        with c_on:
+            metrics.enable(st.toggle("計測を有効にする", value=metrics.enabled()))
+        with c_reset:
+            if st.button("リセット"):
+                metrics.reset()
+
+        counters, histograms = metrics.prometheus.snapshot()
+        counters = pd.DataFrame([{'name': c['name'], **c['labels'], 'value': c['value']} for c in counters])
+        if histograms:
+            st.write("処理時間 (ms)")
+            times = pd.DataFrame([{'name': h['name'], 'labels': ", ".join(f"{k}={v}" for k, v in h['labels'].items()),
+                                   'count': h['count'], 'avg': h['sum'] / h['count'], 'p50≦': h['p50'], 'p95≦': h['p95']}
+                                  for h in histograms])
+            st.dataframe(times.sort_values('avg', ascending=False).round(1), use_container_width=True, hide_index=True)
+        if not counters.empty:
+            api = counters[counters['name'] == 'api_requests']
+            if not api.empty:
+                st.write("API リクエスト数（シート・操作別）")
+                st.dataframe(api.pivot_table(index='sheet', columns='op', values='value', aggfunc='sum', fill_value=0),
+                             use_container_width=True)
+            cache = counters[counters['name'] == 'cache_requests']
+            if not cache.empty:
+                st.write("キャッシュの当たり率")
+                by_sheet = cache.pivot_table(index='sheet', columns='result', values='value', aggfunc='sum', fill_value=0)
+                by_sheet = by_sheet.reindex(columns=['hit', 'miss'], fill_value=0)
+                by_sheet['当たり率(%)'] = (by_sheet['hit'] / (by_sheet['hit'] + by_sheet['miss']) * 100).round(1)
+                st.dataframe(by_sheet, use_container_width=True)
+            moved = counters[counters['name'].isin(['rows_read', 'rows_written', 'api_bytes_sent', 'api_bytes_received'])]
+            if not moved.empty:
+                st.write("読み書きした量")
+                st.dataframe(moved.groupby('name')['value'].sum(), use_container_width=True)
+        if not histograms and counters.empty:
+            st.caption("まだ計測値がありません")
+
+        with st.expander("Prometheus 形式"):
+            st.code(metrics.prometheus.text(), language="text")
+        with st.expander("直近の計測値"):
+            st.dataframe(pd.DataFrame(metrics.recent.events()[-50:]), use_container_width=True, hide_index=True)
+
 # CSS適用
 local_css("style.css")
 show_sidebar_toggle()
 
 st.title("📈 チーム管理ダッシュボード")
 
+def cross_team_metrics(as_of):
+    # 各チーム（シャード）の指標を並列に集計し、チーム列を付けて1つの表にする
+    results, errors = db.fan_out(lambda: analytics.cached_team_metrics(db.load_many(analytics.SHEETS), as_of))
+    for key in errors:
+        st.warning(f"{key} のデータを読み込めませんでした")
+    frames = [df.reset_index(drop=True).assign(shard=key) for key, df in results.items() if not df.empty]
+    if not frames:
+        return pd.DataFrame()
+    merged = pd.concat(frames, ignore_index=True)
+    return merged[['shard'] + [c for c in merged.columns if c != 'shard']]
+
 # --- 3. ログイン処理 ---
 if 'admin_login' not in st.session_state:
     st.session_state.admin_login = False
@@ -51,22 +129,56 @@ else:
             st.session_state.admin_login = False
             st.rerun()
 
-    # DBからユーザー一覧読み込み
-    users_df = db.load_data_from_sheet('users')
+    # チーム・シーズン（シャード）の選択。振り分け表に2つ以上あるときだけ出す
+    shards = db.shard_keys()
+    if len(shards) > 1:
+        db.set_shard(st.sidebar.selectbox("チーム / シーズン", shards, key="admin_shard"))
+
+    # DBから全データを1回のリクエストでまとめて読み込み
+    try:
+        with metrics.timer('section_ms', app='admin', section='load'):
+            all_data = db.load_many(['users', 'daily', 'meal', 'exercise', 'bowel'])
+    except db.ThrottledError:
+        st.warning("アクセスが集中しています。少し待ってから再読み込みしてください")
+        st.stop()
+    except db.SheetUnavailableError:
+        st.warning("スプレッドシートを読み込めませんでした。少し待ってから再読み込みしてください")
+        st.stop()
+    users_df = all_data['users']
 
     if users_df.empty:
         st.warning("登録されている選手がいません")
         st.stop()
 
+    # 性能パネル（URL に ?perf=1 を付けたときだけ表示）
+    if st.query_params.get("perf") == "1":
+        show_perf_panel()
+
+    # --- 注意が必要な選手 ---
+    # 読み込んだ daily / bowel のうち増えた・変わった行だけを反映し、今出ている注意だけを表示する
+    with metrics.timer('section_ms', app='admin', section='alerts'):
+        alerts.refresh(all_data)
+        alert_df = alerts.table()
+    with st.expander(f"⚠️ 注意が必要な選手（{len(alert_df)}件）", expanded=not alert_df.empty):
+        st.caption("ルール: " + " / ".join(alerts.describe_rules()))
+        if alert_df.empty:
+            st.info("今のところ注意が必要な選手はいません")
+        else:
+            st.dataframe(pd.DataFrame({
+                '名前': alert_df['name'],
+                '内容': alert_df['rule'].map(alerts.RULE_LABELS),
+                '日付': pd.to_datetime(alert_df['date']).dt.strftime('%Y-%m-%d').fillna(''),
+                '詳細': alert_df['message'],
+            }), use_container_width=True, hide_index=True)
+
     # --- サイドバー：メニュー ---
     st.sidebar.title("メニュー")
-    mode = st.sidebar.radio("表示モードを選択", ["📊 個別分析", "📅 日毎一覧", "🗑️ 選手管理（削除）"])
+    mode = st.sidebar.radio("表示モードを選択", ["📊 個別分析", "👥 チーム分析", "📅 日毎一覧", "🗑️ 選手管理（削除）"])
 
-    # DBから全データ読み込み
-    daily_df = db.load_data_from_sheet('daily')
-    meal_df = db.load_data_from_sheet('meal')
-    ex_df = db.load_data_from_sheet('exercise')
-    bowel_df = db.load_data_from_sheet('bowel')
+    daily_df = all_data['daily']
+    meal_df = all_data['meal']
+    ex_df = all_data['exercise']
+    bowel_df = all_data['bowel']
 
     # ==========================================
     # モードA: 個別分析
@@ -77,36 +189,22 @@ else:
         selected_user = st.selectbox("データを見たい選手を選択してください", users_df['name'].unique())
         st.divider()
         st.header(f"{selected_user} 選手の詳細データ")
+        for _, alert in alerts.for_player(selected_user).iterrows():
+            st.warning(f"{alerts.RULE_LABELS[alert['rule']]}: {alert['message']}", icon="⚠️")
         
         tab1, tab2, tab3, tab4 = st.tabs(["📊 コンディション推移", "🏃‍♂️ 運動履歴", "🍽️ 食事履歴", "🚻 排便履歴"])
         
         with tab1:
             if not daily_df.empty:
-                user_daily = daily_df[daily_df['name'] == selected_user].copy()
+                user_daily = archive.rows_for_player('daily', selected_user)  # 保管庫の古い記録も含む
                 if not user_daily.empty:
-                    user_daily['date'] = pd.to_datetime(user_daily['date'])
-                    user_daily = user_daily.sort_values('date')
+                    # 日付・数値の型は db の読み込み時に揃っていて、日付順に並んでいる
                     user_daily = user_daily.drop_duplicates(subset=['date'], keep='last')
-                    
-                    user_daily['weight'] = pd.to_numeric(user_daily['weight'], errors='coerce')
-                    user_daily['body_fat'] = pd.to_numeric(user_daily['body_fat'], errors='coerce')
-
-                    fig = go.Figure()
-                    fig.add_trace(go.Scatter(x=user_daily['date'], y=user_daily['weight'], mode='lines+markers', name='体重 (kg)', line=dict(color='#007bff', width=2)))
-                    fig.add_trace(go.Scatter(x=user_daily['date'], y=user_daily['body_fat'], mode='lines+markers', name='体脂肪率 (%)', line=dict(color='#28a745', width=2, dash='dot')))
-
-                    max_val = 100
-                    if not user_daily['weight'].dropna().empty:
-                        max_val = max(user_daily['weight'].max(), user_daily['body_fat'].max()) * 1.1
-
-                    fig.update_layout(
-                        height=400, margin=dict(l=20, r=20, t=20, b=20),
-                        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
-                        yaxis=dict(range=[0, max_val], fixedrange=True, title="値"),
-                        xaxis=dict(fixedrange=True, tickformat="%Y-%m-%d", dtick="D1"),
-                        hovermode="x unified"
-                    )
-                    st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False})
+
+                    window = st.radio("表示期間", list(charts.WINDOWS), index=list(charts.WINDOWS).index(charts.DEFAULT_WINDOW), horizontal=True, key="chart_window")
+                    with metrics.timer('section_ms', app='admin', section='chart'):
+                        fig = charts.cached_condition_figure(selected_user, user_daily, window, height=400, version=db.data_version(['daily']))
+                        st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False})
                     with st.expander("詳細データを見る"):
                         st.dataframe(user_daily, use_container_width=True)
                 else:
@@ -116,12 +214,11 @@ else:
 
         with tab2:
             if not ex_df.empty:
-                user_ex = ex_df[ex_df['name'] == selected_user].copy()
+                user_ex = archive.rows_for_player('exercise', selected_user)
                 if not user_ex.empty:
-                    user_ex['date'] = pd.to_datetime(user_ex['date'])
-                    user_ex = user_ex.sort_values(['date'], ascending=False)
+                    user_ex = user_ex.iloc[::-1]  # 新しい順
                     for i, row in user_ex.iterrows():
-                        date_str = row['date'].strftime('%Y-%m-%d')
+                        date_str = db.format_date(row['date'])
                         time_str = str(row['time'])[:5] if pd.notnull(row.get('time')) else ""
                         st.success(f"**{date_str}** | ⏱ {time_str} | {row['content']}")
                 else:
@@ -131,22 +228,20 @@ else:
 
         with tab3:
             if not meal_df.empty:
-                user_meal = meal_df[meal_df['name'] == selected_user].copy()
-                if not user_meal.empty:
-                    user_meal['date'] = pd.to_datetime(user_meal['date'])
-                    user_meal = user_meal.sort_values(['date'], ascending=False)
+                meal_total = archive.player_count('meal', selected_user)
+                if meal_total:
+                    page = page_selector(meal_total, key=f"meal_page_{selected_user}")
+                    user_meal, _ = archive.player_page('meal', selected_user, page, MEAL_PAGE_SIZE)  # 新しい順
                     for i, row in user_meal.iterrows():
-                        date_str = row['date'].strftime('%Y-%m-%d')
-                        time_display = str(row['time'])[:5] if pd.notnull(row.get('time')) else ""
+                        date_str = db.format_date(row['date'])
+                        time_display = db.format_time(row.get('time'))
                         with st.container():
                             c1, c2 = st.columns([2, 1])
                             with c1:
                                 st.info(f"📅 **{date_str} {time_display}** ({row['type']})\n\n{row['menu']}")
                             with c2:
                                 # 【修正箇所】URLが http で始まる場合のみ画像を表示する（空文字対策）
-                                img_url = row.get('image_url')
-                                if img_url and isinstance(img_url, str) and img_url.startswith("http"):
-                                    st.image(img_url, use_container_width=True)
+                                show_meal_photo(row.get('image_url'))
                             st.divider()
                 else:
                     st.warning("記録がありません")
@@ -155,13 +250,12 @@ else:
 
         with tab4:
             if not bowel_df.empty:
-                user_bowel = bowel_df[bowel_df['name'] == selected_user].copy()
+                user_bowel = archive.rows_for_player('bowel', selected_user)
                 if not user_bowel.empty:
-                    user_bowel['date'] = pd.to_datetime(user_bowel['date'])
-                    user_bowel = user_bowel.sort_values(['date'], ascending=False)
+                    user_bowel = user_bowel.iloc[::-1]  # 新しい順
                     for i, row in user_bowel.iterrows():
-                        date_str = row['date'].strftime('%Y-%m-%d')
-                        time_str = str(row['time'])[:5] if pd.notnull(row.get('time')) else ""
+                        date_str = db.format_date(row['date'])
+                        time_str = db.format_time(row.get('time'))
                         c1, c2, c3 = st.columns([2, 1, 1])
                         c1.write(f"📅 {date_str} {time_str}")
                         c2.write(f"量: {row['amount']} / 硬さ: {row['hardness']}")
@@ -173,22 +267,90 @@ else:
             else:
                 st.info("データがありません")
 
+    # ==========================================
+    # モードD: チーム分析
+    # ==========================================
+    elif mode == "👥 チーム分析":
+        st.subheader("👥 チーム全体の指標")
+        as_of = st.date_input("基準日", date.today(), key="team_as_of")
+
+        all_teams = len(shards) > 1 and st.checkbox("全チームをまとめて表示", key="team_all_shards")
+
+        # 全選手分を一度に集計（データが変わるまでは前回の結果を使う）
+        with metrics.timer('section_ms', app='admin', section='team_metrics'):
+            if all_teams:
+                team_df = cross_team_metrics(as_of)
+            else:
+                team_df = analytics.cached_team_metrics(all_data, as_of)
+        display_metrics = team_df.rename(columns={
+            'shard': 'チーム', 'name': '名前', 'last_date': '最終記録日', 'weight': '体重(kg)', 'weight_7d': '体重7日平均',
+            'weight_28d': '体重28日平均', 'weight_wow': '体重 前週比', 'body_fat': '体脂肪率(%)',
+            'body_fat_7d': '体脂肪7日平均', 'body_fat_28d': '体脂肪28日平均', 'bmi': 'BMI',
+            'sleep_debt_7d': '睡眠負債(h/7日)', 'exercise_min_7d': '運動(分/7日)',
+            'diarrhea_7d': '下痢(7日)', 'diarrhea_28d': '下痢(28日)',
+        })
+        st.caption("列名をクリックすると並べ替えできます")
+        # 最終記録日（日時の列）は丸めない
+        numeric_cols = display_metrics.select_dtypes('number').columns
+        st.dataframe(display_metrics.round({c: 2 for c in numeric_cols}), use_container_width=True, hide_index=True)
+
+        heat_labels = {"体重": 'weight', "体脂肪率": 'body_fat', "睡眠": 'sleep'}
+        heat_choice = st.radio("ヒートマップ（各選手の28日平均からのずれ %）", list(heat_labels), horizontal=True)
+        matrix = analytics.cached_daily_matrix(daily_df, heat_labels[heat_choice], as_of)
+        if not matrix.empty:
+            fig = go.Figure(go.Heatmap(
+                z=matrix.values, x=matrix.columns, y=matrix.index.astype(str),
+                colorscale='RdBu_r', zmid=0, colorbar=dict(title="%"),
+            ))
+            fig.update_layout(
+                height=max(300, 22 * len(matrix)), margin=dict(l=20, r=20, t=20, b=20),
+                xaxis=dict(fixedrange=True, tickformat="%m/%d"), yaxis=dict(fixedrange=True, autorange="reversed"),
+            )
+            st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False})
+        else:
+            st.info("データがありません")
+
     # ==========================================
     # モードB: 日毎一覧
     # ==========================================
     elif mode == "📅 日毎一覧":
         st.subheader("📅 日毎データ一覧")
-        from datetime import date
+        # 日付ごとのまとめは読み込んだ分だけ更新しておき、日付の切り替えはそこから引く
+        with metrics.timer('section_ms', app='admin', section='rollups'):
+            rollups.refresh(all_data)
         target_date = st.date_input("確認したい日付を選択", date.today())
-        target_date_str = str(target_date)
+        span = st.radio("表示期間", ["1日", "1週間", "1か月"], horizontal=True)
+
+        if span != "1日":
+            days = 7 if span == "1週間" else 28
+            start_date = pd.Timestamp(target_date) - pd.Timedelta(days=days - 1)
+            counts = rollups.submission_counts(start_date, target_date)
+            counts['date'] = counts['date'].dt.strftime('%m/%d')
+            counts.columns = ['日付', '提出', '未提出']
+            st.dataframe(counts.set_index('日付').T, use_container_width=True)
+
+            grid_item = st.selectbox("表示する項目", ["体重(kg)", "体脂肪率(%)", "睡眠(h)"])
+            grid_column = {"体重(kg)": 'weight', "体脂肪率(%)": 'body_fat', "睡眠(h)": 'sleep'}[grid_item]
+            grid = rollups.range_grid(start_date, target_date, grid_column)
+            grid.columns = [d.strftime('%m/%d') for d in grid.columns]
+            st.dataframe(grid.astype('float64').round(1).astype(object).where(grid.notna(), "未"), use_container_width=True)
+            st.stop()
+
+        day = rollups.day(target_date)
+        c_sub, c_miss = st.columns(2)
+        c_sub.metric("体調の提出", f"{len(day['submitted'])} / {len(day['submitted']) + len(day['missing'])} 人")
+        with c_miss:
+            if day['missing']:
+                st.warning("未提出: " + "、".join(day['missing']))
+            else:
+                st.success("全員提出済み")
 
         d_tab1, d_tab2, d_tab3, d_tab4 = st.tabs(["📊 体調一覧", "🏃‍♂️ 運動一覧", "🍽️ 食事一覧", "🚻 排便一覧"])
 
         with d_tab1:
             if not daily_df.empty:
-                day_daily = daily_df[daily_df['date'] == target_date_str].copy()
+                day_daily = day['daily']
                 if not day_daily.empty:
-                    day_daily = day_daily.drop_duplicates(subset=['name'], keep='last')
                     display_df = day_daily[['name', 'weight', 'body_fat', 'sleep']].copy()
                     display_df.columns = ['名前', '体重(kg)', '体脂肪率(%)', '睡眠(h)']
                     st.dataframe(display_df, use_container_width=True, hide_index=True)
@@ -199,7 +361,7 @@ else:
 
         with d_tab2:
             if not ex_df.empty:
-                day_ex = ex_df[ex_df['date'] == target_date_str].copy()
+                day_ex = day['exercise']
                 if not day_ex.empty:
                     display_ex = day_ex[['name', 'time', 'content']].copy()
                     display_ex['time'] = display_ex['time'].astype(str).str[:5]
@@ -212,10 +374,11 @@ else:
 
         with d_tab3:
             if not meal_df.empty:
-                day_meal = meal_df[meal_df['date'] == target_date_str].copy()
+                day_meal = day['meal']
                 if not day_meal.empty:
-                    for i, row in day_meal.iterrows():
-                        time_str = str(row['time'])[:5] if pd.notnull(row.get('time')) else ""
+                    page = page_selector(len(day_meal), key=f"day_meal_page_{target_date}")
+                    for i, row in day_meal.iloc[page * MEAL_PAGE_SIZE:(page + 1) * MEAL_PAGE_SIZE].iterrows():
+                        time_str = db.format_time(row.get('time'))
                         with st.container():
                             c_txt, c_img = st.columns([3, 1])
                             with c_txt:
@@ -223,9 +386,7 @@ else:
                                 st.info(row['menu'])
                             with c_img:
                                 # 【修正箇所】URLチェックを追加
-                                img_url = row.get('image_url')
-                                if img_url and isinstance(img_url, str) and img_url.startswith("http"):
-                                    st.image(img_url, use_container_width=True)
+                                show_meal_photo(row.get('image_url'))
                             st.divider()
                 else:
                     st.info("記録なし")
@@ -234,10 +395,13 @@ else:
 
         with d_tab4:
             if not bowel_df.empty:
-                day_bowel = bowel_df[bowel_df['date'] == target_date_str].copy()
+                day_bowel = day['bowel']
                 if not day_bowel.empty:
+                    summary = day['bowel_summary'].copy()
+                    summary.columns = ['名前', '回数', '下痢']
+                    st.dataframe(summary, use_container_width=True, hide_index=True)
                     display_bowel = day_bowel[['name', 'time', 'amount', 'hardness']].copy()
-                    display_bowel['time'] = display_bowel['time'].astype(str).str[:5]
+                    display_bowel['time'] = db.format_times(display_bowel['time'])
                     display_bowel.columns = ['名前', '時間', '量', '硬さ']
                     st.dataframe(display_bowel, use_container_width=True, hide_index=True)
                 else:
@@ -255,18 +419,20 @@ else:
         st.write("---")
         st.markdown(f"### 👤 {delete_target} さんのデータ概要")
         
-        user_info = users_df[users_df['name'] == delete_target].iloc[0]
+        user_info = db.rows_for_player('users', delete_target).iloc[0]
         
-        d_cnt = len(daily_df[daily_df['name'] == delete_target]) if not daily_df.empty else 0
-        m_cnt = len(meal_df[meal_df['name'] == delete_target]) if not meal_df.empty else 0
-        e_cnt = len(ex_df[ex_df['name'] == delete_target]) if not ex_df.empty else 0
-        b_cnt = len(bowel_df[bowel_df['name'] == delete_target]) if not bowel_df.empty else 0
+        # 読み込み済みのデータから件数を数える（再ダウンロードはしない）
+        counts = db.count_rows_where(['daily', 'meal', 'exercise', 'bowel'], 'name', delete_target)
+        d_cnt = counts['daily']
+        m_cnt = counts['meal']
+        e_cnt = counts['exercise']
+        b_cnt = counts['bowel']
 
         col_prof, col_stats = st.columns(2)
         with col_prof:
             st.info("**基本プロフィール**")
             st.write(f"**生年月日:** {user_info['dob']}")
-            st.write(f"**身長:** {user_info['height']} cm")
+            st.write(f"**身長:** {db.format_number(user_info['height'])} cm")
         with col_stats:
             st.error("**削除される記録**")
             st.write(f"📊 コンディション: {d_cnt} 件")
@@ -279,12 +445,19 @@ else:
         
         if st.button("🚫 データを削除する", type="primary", disabled=not agree):
             with st.spinner("スプレッドシートからデータを削除中..."):
+                # 該当する行だけを、全シート分まとめて1回のリクエストで削除
                 sheet_names = ['users', 'daily', 'meal', 'exercise', 'bowel']
-                for sheet in sheet_names:
-                    df = db.load_data_from_sheet(sheet)
-                    if not df.empty and 'name' in df.columns:
-                        df_new = df[df['name'] != delete_target]
-                        db.overwrite_sheet_data(sheet, df_new)
+                db.delete_rows_where(sheet_names, 'name', delete_target)
+                archive.delete_where(archive.ARCHIVE_SHEETS, 'name', delete_target)
             
             st.success(f"✅ {delete_target} さんのデータを削除しました。")
-            st.rerun()
\ No newline at end of file
+            st.rerun()
+
+        st.write("---")
+        with st.expander("🗄️ 古い記録の保管"):
+            st.caption("指定した日数より前の記録を、スプレッドシートから手元の保管庫へ移します（表示・分析には引き続き使われます）")
+            archive_days = st.number_input("何日より前の記録を移すか", min_value=30, value=int(archive.ARCHIVE_AFTER_DAYS), step=30)
+            if st.button("保管庫へ移す"):
+                with st.spinner("古い記録を移しています..."):
+                    moved = archive.archive_old_rows(archive_days)
+                st.success("移した行数: " + " / ".join(f"{name} {n} 行" for name, n in moved.items()))
\ No newline at end of file
@@ -0,0 +1,329 @@
+# alerts.py
+# 体調の注意（アラート）。daily / bowel に増えた行だけを読み、選手ごとの直近の状態
+# （体重の窓・下痢の日・最後の提出日・最新の睡眠）を持ち回して、ルールに当たったものを小さな表に残す。
+#
+# - 1行の反映・判定はその選手の状態（数日分）だけを見る。記録の全期間を見直さない
+# - 管理画面は table() で今出ている注意だけを受け取る（注意の件数に比例する手間）
+# - 状態はチーム・シーズン（db のシャード）ごとに持つ
+# - ルールは secrets.toml の [db.alert_rules] で変えられる。0 にしたルールは使わない
+#
+#   [db.alert_rules]
+#   weight_change_pct = 3.0   # weight_days 日の間に体重がこの % を超えて変わったら
+#   weight_days = 7
+#   diarrhea_days = 2         # 下痢がこの日数続いたら
+#   sleep_min_hours = 5.0     # 最新の睡眠がこの時間未満なら
+#   missing_days = 3          # 体調の記録がこの日数ないなら
+import bisect
+import threading
+import numpy as np
+import pandas as pd
+import db
+
+DIARRHEA = "下痢"
+APPEND_ONLY = ['bowel']
+STREAK_MAX_DAYS = 14  # 下痢が続いた日数はここまで数える（それより長ければ「14日以上」）
+DEFAULT_RULES = {
+    'weight_change_pct': 3.0,
+    'weight_days': 7,
+    'diarrhea_days': 2,
+    'sleep_min_hours': 5.0,
+    'missing_days': 3,
+}
+RULES = {**DEFAULT_RULES, **dict(db._config("alert_rules", {}))}
+RULE_ORDER = ['weight', 'diarrhea', 'sleep', 'missing']  # 表に出す順
+RULE_LABELS = {'weight': "体重の急な変化", 'diarrhea': "下痢が続いている", 'sleep': "睡眠不足", 'missing': "未提出"}
+COLUMNS = ['name', 'rule', 'date', 'value', 'message']
+# 差分を調べるときに比べる列（ほかの列だけが変わった行は読み直さない）
+WATCH_COLUMNS = {'daily': ['name', 'date', 'weight', 'sleep'], 'bowel': ['name', 'date', 'hardness']}
+_NEVER = pd.Timestamp.min  # 一度も提出していない選手の「最後の提出日」
+
+_lock = threading.Lock()
+_shards = {}  # シャード -> 状態（_state を参照）
+
+def _state():
+    shard = db.current_shard()
+    s = _shards.get(shard)
+    if s is None:
+        s = _shards[shard] = {
+            'players': {},  # 名前 -> 選手の状態
+            'alerts': {},   # (名前, ルール) -> 注意の行
+            'by_last': [],  # (最後の提出日, 名前) の昇順。未提出の判定用
+            'roster': None, # (users の DataFrame, 名前の集合)
+            'seen': {},     # sheet_name -> (前回の DataFrame, 行数, 最後の行, データの版)
+        }
+    return s
+
+def _days(n):
+    return pd.Timedelta(days=n)
+
+def _streak_days():
+    return max(int(RULES['diarrhea_days'] or 0), STREAK_MAX_DAYS)
+
+def _horizon():
+    # 判定に使う日数の上限。選手の最新日からこれより古い行は状態に影響しない
+    return max(int(RULES['weight_days'] or 0), _streak_days())
+
+# --- 選手ごとの状態 ---
+def _player(s, name):
+    p = s['players'].get(name)
+    if p is None:
+        p = s['players'][name] = {
+            'last_daily': None,  # 最後の体調の記録日
+            'weights': {},       # 日付 -> 体重（last_daily から weight_days 日分だけ）
+            'sleep': None,       # (日付, 時間) 最新の睡眠
+            'last_bowel': None,  # 最後の排便の記録日
+            'diarrhea': set(),   # 下痢の日（直近 _streak_days() 日分だけ）
+        }
+        bisect.insort(s['by_last'], (_NEVER, name))
+    return p
+
+def _set_last_daily(s, name, p, date):
+    if p['last_daily'] is not None and date <= p['last_daily']:
+        return
+    by_last = s['by_last']
+    old = (p['last_daily'] or _NEVER, name)
+    i = bisect.bisect_left(by_last, old)
+    if i < len(by_last) and by_last[i] == old:
+        del by_last[i]
+    bisect.insort(by_last, (date, name))
+    p['last_daily'] = date
+
+def _drop_player(s, name):
+    p = s['players'].pop(name, None)
+    if p is None:
+        return
+    entry = (p['last_daily'] or _NEVER, name)
+    i = bisect.bisect_left(s['by_last'], entry)
+    if i < len(s['by_last']) and s['by_last'][i] == entry:
+        del s['by_last'][i]
+    for rule in RULE_ORDER:
+        s['alerts'].pop((name, rule), None)
+
+def _add_daily(s, p, name, row, date):
+    _set_last_daily(s, name, p, date)
+    cutoff = p['last_daily'] - _days(int(RULES['weight_days'] or 0))
+    weights = p['weights']
+    weight = row.get('weight')
+    if date >= cutoff and pd.notna(weight):
+        weights[date] = float(weight)
+    for d in [d for d in weights if d < cutoff]:
+        del weights[d]
+    sleep = row.get('sleep')
+    if pd.notna(sleep) and (p['sleep'] is None or date >= p['sleep'][0]):
+        p['sleep'] = (date, float(sleep))
+
+def _add_bowel(p, row, date):
+    if p['last_bowel'] is None or date > p['last_bowel']:
+        p['last_bowel'] = date
+    days = p['diarrhea']
+    if str(row.get('hardness')) == DIARRHEA:
+        days.add(date)
+    if days:
+        cutoff = max(days) - _days(_streak_days())
+        for d in [d for d in days if d <= cutoff]:
+            days.discard(d)
+
+# --- 判定 ---
+def _set_alert(s, name, rule, hit, date=None, value=None, message=None):
+    key = (name, rule)
+    if hit:
+        s['alerts'][key] = {'name': name, 'rule': rule, 'date': date, 'value': value, 'message': message}
+    else:
+        s['alerts'].pop(key, None)
+
+def _evaluate(s, name, p):
+    # その選手の状態だけを見て、体重・下痢・睡眠のルールを判定し直す（未提出は table() で判定）
+    limit = RULES['weight_change_pct']
+    weights = p['weights']
+    hit = False
+    if limit and len(weights) >= 2:
+        first, last = min(weights), max(weights)
+        base, now = weights[first], weights[last]
+        if base > 0:
+            pct = (now - base) / base * 100
+            hit = abs(pct) > limit
+    if hit:
+        days = (last - first).days
+        _set_alert(s, name, 'weight', True, last, round(pct, 1),
+                   f"{days}日で体重が {pct:+.1f}%（{base:.1f} → {now:.1f} kg）")
+    else:
+        _set_alert(s, name, 'weight', False)
+
+    need = int(RULES['diarrhea_days'] or 0)
+    streak = 0
+    days = p['diarrhea']
+    if need and days:
+        latest = max(days)
+        # 最後の排便の記録が下痢の日のときだけ（その後にふつうの記録があれば治まったとみなす）
+        if latest == p['last_bowel']:
+            while latest - _days(streak) in days:
+                streak += 1
+    more = "以上" if streak >= _streak_days() else ""
+    _set_alert(s, name, 'diarrhea', need and streak >= need, p['last_bowel'], streak,
+               f"下痢が {streak}日{more}続いています")
+
+    minimum = RULES['sleep_min_hours']
+    sleep = p['sleep']
+    _set_alert(s, name, 'sleep', bool(minimum) and sleep is not None and sleep[1] < minimum,
+               sleep and sleep[0], sleep and sleep[1],
+               sleep and f"睡眠 {sleep[1]:.1f} 時間（{minimum:g} 時間未満）")
+
+def _observe(s, sheet_name, records):
+    touched = {}
+    for row in records:
+        name, date = row.get('name'), row.get('date')
+        if name is None or pd.isna(date):
+            continue
+        name = str(name)
+        roster = s['roster']
+        if roster is not None and name not in roster[1]:
+            continue  # 登録されていない（削除された）選手の行
+        date = pd.Timestamp(date).normalize()
+        p = touched[name] = _player(s, name)
+        if sheet_name == 'daily':
+            _add_daily(s, p, name, row, date)
+        else:
+            _add_bowel(p, row, date)
+    for name, p in touched.items():
+        _evaluate(s, name, p)
+    return len(touched)
+
+def observe(sheet_name, rows):
+    # 行（dict のリスト）をすぐに反映する。状態はこのプロセスの中だけにあるので、
+    # 管理画面と同じプロセスで保存した行にだけ使える（選手アプリの保存は refresh() で拾う）。
+    # 手間は行数 × その選手の状態の大きさ（数日分）だけ。同じ行を2回反映しても結果は変わらない。
+    # 戻り値は判定し直した選手の数
+    if sheet_name not in WATCH_COLUMNS:
+        return 0
+    with _lock:
+        return _observe(_state(), sheet_name, rows)
+
+# --- 読み込んだシートからの反映 ---
+def _last_row(df, n):
+    return tuple(str(v) for v in df.iloc[n - 1].tolist()) if n else None
+
+def _hashes(sheet_name, df):
+    columns = [c for c in WATCH_COLUMNS[sheet_name] if c in df.columns]
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+
+def _changed(sheet_name, old, df):
+    # 前回の DataFrame と同じ位置の行どうしを比べ、変わった行と増えた行だけを返す。
+    # 行が減った・列が変わったときは位置で比べられないので None
+    if len(old) > len(df) or list(old.columns) != list(df.columns):
+        return None
+    n = len(old)
+    same = np.ones(n, dtype=bool)
+    for c in [c for c in WATCH_COLUMNS[sheet_name] if c in df.columns]:
+        a, b = old[c].to_numpy(), df[c].to_numpy()[:n]
+        same &= (a == b) | (pd.isna(a) & pd.isna(b))
+    return pd.concat([df.iloc[:n][~same], df.iloc[n:]])
+
+def _recent(df):
+    # 各選手の最新日から _horizon() 日より古い行は状態に影響しないので読まない
+    dates = df['date']
+    newest = dates.groupby(df['name'].astype(object)).transform('max')
+    return df[dates >= newest - _days(_horizon())]
+
+def _sync_sheet(s, sheet_name, df):
+    # db の読み込みは毎回別の DataFrame（浅いコピー）を返すので、中身が変わったかはデータの版で見る
+    # （SQLite では版がないので毎回比べる）
+    version = db.data_version([sheet_name])
+    if version is not None and not version[-1]:
+        version = None  # まだ db のキャッシュにない（db から読んでいない DataFrame）
+    seen = s['seen'].get(sheet_name)
+    if seen is not None and version is not None and seen[3] == version:
+        return 0
+    if df.empty or 'date' not in df.columns:
+        s['seen'][sheet_name] = (df, 0, None, version)
+        return 0
+    n = len(df)
+    new = None
+    if (sheet_name in APPEND_ONLY and seen is not None and seen[1] <= n
+            and _last_row(df, seen[1]) == seen[2]):
+        # 前回の続き: 増えた行だけを読む
+        new = df.iloc[seen[1]:]
+    elif seen is not None and seen[1]:
+        # daily は同じ日の記録が途中の行で上書きされ、新しい日は末尾に足される。
+        # 前回と同じ位置の行を列ごとにまとめて比べ、変わった行と増えた行だけを読む。
+        # 行が減っていたら（削除・保管庫への移動）位置がずれるので、そのときだけ行のハッシュで比べる。
+        # 消えた行は取り消さない（選手の削除は users から、保管庫へ移した古い行は判定に使っていない）
+        new = _changed(sheet_name, seen[0], df)
+        if new is None:
+            new = df[~pd.Series(_hashes(sheet_name, df)).isin(_hashes(sheet_name, seen[0])).to_numpy()]
+    else:
+        new = df
+    new = new.dropna(subset=['date'])
+    count = _observe(s, sheet_name, _recent(new).to_dict('records')) if not new.empty else 0
+    s['seen'][sheet_name] = (df, n, _last_row(df, n), version)
+    return count
+
+def _sync_roster(s, users_df):
+    roster = s['roster']
+    if roster is not None and roster[0] is users_df:
+        return
+    names = set(users_df['name'].astype(str)) if not users_df.empty else set()
+    for name in set(s['players']) - names:
+        _drop_player(s, name)
+    for name in names:
+        _player(s, name)
+    s['roster'] = (users_df, names)
+
+def refresh(frames):
+    # frames: {'users': df, 'daily': df, 'bowel': df}（admin_app の all_data をそのまま渡せる）。
+    # 前回から変わったシートの、増えた・変わった行だけを反映する。戻り値は判定し直した選手の数
+    with _lock:
+        s = _state()
+        if frames.get('users') is not None:
+            _sync_roster(s, frames['users'])
+        return sum(_sync_sheet(s, sheet_name, frames[sheet_name])
+                   for sheet_name in WATCH_COLUMNS if frames.get(sheet_name) is not None)
+
+# --- 読み出し ---
+def _missing(s, as_of):
+    need = int(RULES['missing_days'] or 0)
+    if not need:
+        return []
+    rows = []
+    # 最後の提出日の古い順に、まだ期限を過ぎていない選手に当たるまで見る
+    for last, name in s['by_last']:
+        if last > as_of - _days(need):
+            break
+        if last == _NEVER:
+            rows.append({'name': name, 'rule': 'missing', 'date': None, 'value': None,
+                         'message': "体調の記録がまだありません"})
+        else:
+            days = (as_of - last).days
+            rows.append({'name': name, 'rule': 'missing', 'date': last, 'value': days,
+                         'message': f"{days}日間 体調の記録がありません"})
+    return rows
+
+def table(as_of=None):
+    # 今出ている注意の表（ルールの順 → 新しい順）。as_of は未提出の判定に使う基準日（省略時は今日）
+    as_of = pd.Timestamp(as_of if as_of is not None else pd.Timestamp.today()).normalize()
+    with _lock:
+        s = _state()
+        rows = list(s['alerts'].values()) + _missing(s, as_of)
+    rows.sort(key=lambda r: (RULE_ORDER.index(r['rule']), -(r['date'].value if r['date'] is not None else 0)))
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+def for_player(name, as_of=None):
+    # 1人分の注意（table() と同じ列）
+    as_of = pd.Timestamp(as_of if as_of is not None else pd.Timestamp.today()).normalize()
+    with _lock:
+        s = _state()
+        rows = [s['alerts'][(name, rule)] for rule in RULE_ORDER if (name, rule) in s['alerts']]
+        rows += [r for r in _missing(s, as_of) if r['name'] == name]
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+def describe_rules():
+    # 画面に出すルールの説明
+    out = []
+    if RULES['weight_change_pct']:
+        out.append(f"体重が{RULES['weight_days']}日で±{RULES['weight_change_pct']:g}%超")
+    if RULES['diarrhea_days']:
+        out.append(f"下痢が{RULES['diarrhea_days']}日以上続く")
+    if RULES['sleep_min_hours']:
+        out.append(f"睡眠{RULES['sleep_min_hours']:g}時間未満")
+    if RULES['missing_days']:
+        out.append(f"体調の記録が{RULES['missing_days']}日以上ない")
+    return out
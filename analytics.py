@@ -0,0 +1,134 @@
+# analytics.py
+# チーム全員分の指標を、選手ごとにループせず groupby でまとめて計算する（管理画面用）。
+# 結果は「データの版」（db.data_version）ごとに覚えておき、データが変わるまで再計算しない。
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import db
+
+SLEEP_TARGET_HOURS = db._config("sleep_target_hours", 8.0)
+DIARRHEA = "下痢"
+SHEETS = ['users', 'daily', 'exercise', 'bowel']
+METRIC_COLUMNS = [
+    'last_date', 'weight', 'weight_7d', 'weight_28d', 'weight_wow', 'body_fat', 'body_fat_7d',
+    'body_fat_28d', 'bmi', 'sleep_debt_7d', 'exercise_min_7d', 'diarrhea_7d', 'diarrhea_28d',
+]
+
+_lock = threading.Lock()
+_results = OrderedDict()  # (データの版, 種類, 条件...) -> 計算結果
+_RESULTS_MAX = 8
+
+def exercise_minutes(series):
+    # "30分" / "90分" -> 30.0 / 90.0（読めないものは NaN）
+    return pd.to_numeric(series.astype(str).str.extract(r'(\d+(?:\.\d+)?)', expand=False), errors='coerce')
+
+def _daily(daily_df):
+    # 1人1日1行（同じ日の記録は後のものを使う）、選手・日付順
+    d = daily_df.dropna(subset=['date'])
+    d = d.drop_duplicates(subset=['name', 'date'], keep='last')
+    return d.sort_values(['name', 'date'], kind='stable')
+
+def _rolling_latest(d, column, window):
+    # 選手ごとに日付基準の移動平均を取り、各選手の最新日の値を返す
+    rolled = d.groupby('name', observed=True).rolling(window, on='date')[column].mean()
+    return rolled.groupby(level=0, observed=True).last()
+
+def _window_mask(dates, as_of, days):
+    # as_of を含む直近 days 日
+    return (dates > as_of - pd.Timedelta(days=days)) & (dates <= as_of)
+
+def team_metrics(users_df, daily_df, ex_df, bowel_df, as_of=None):
+    # 1選手1行の指標表を返す
+    as_of = _as_of(as_of)
+    players = pd.Index(users_df['name'].astype(object).unique() if not users_df.empty else [], name='name')
+    out = pd.DataFrame(index=players)
+
+    if not daily_df.empty:
+        d = _daily(daily_df[daily_df['date'] <= as_of])
+        latest = d.groupby('name', observed=True).last()
+        out['last_date'] = latest['date']
+        out['weight'] = latest['weight']
+        out['body_fat'] = latest['body_fat']
+        for column in ['weight', 'body_fat']:
+            out[f'{column}_7d'] = _rolling_latest(d, column, '7D')
+            out[f'{column}_28d'] = _rolling_latest(d, column, '28D')
+
+        # 前週比: 直近7日の平均体重 − その前の7日の平均体重
+        days_ago = (as_of - d['date']).dt.days
+        week = days_ago // 7
+        recent = d[week.isin([0, 1])]
+        by_week = recent.assign(week=week[recent.index]).pivot_table(
+            index='name', columns='week', values='weight', aggfunc='mean', observed=True)
+        if 0 in by_week.columns and 1 in by_week.columns:
+            out['weight_wow'] = by_week[0] - by_week[1]
+
+        # 睡眠負債: 直近7日で目標時間に足りなかった分の合計
+        last7 = d[_window_mask(d['date'], as_of, 7)]
+        debt = (SLEEP_TARGET_HOURS - last7['sleep'].astype('float64')).clip(lower=0)
+        out['sleep_debt_7d'] = debt.groupby(last7['name'], observed=True).sum()
+
+    if not users_df.empty and 'height' in users_df.columns:
+        users = users_df.assign(name=users_df['name'].astype(object)).drop_duplicates('name', keep='last').set_index('name')
+        height_m = users['height'].astype('float64') / 100
+        if 'weight' in out.columns:
+            out['bmi'] = out['weight'].astype('float64') / (height_m.reindex(out.index) ** 2)
+
+    if not ex_df.empty:
+        e = ex_df[_window_mask(ex_df['date'], as_of, 7)]
+        out['exercise_min_7d'] = exercise_minutes(e['time']).groupby(e['name'].astype(object)).sum()
+
+    if not bowel_df.empty:
+        b = bowel_df[_window_mask(bowel_df['date'], as_of, 28)]
+        diarrhea = b['hardness'].astype(object) == DIARRHEA
+        recent7 = _window_mask(b['date'], as_of, 7)
+        names = b['name'].astype(object)
+        out['diarrhea_7d'] = (diarrhea & recent7).groupby(names).sum()
+        out['diarrhea_28d'] = diarrhea.groupby(names).sum()
+
+    # データがなくて計算できなかった列も、列としては必ず返す
+    out = out.reindex(columns=METRIC_COLUMNS)
+    for column in ['exercise_min_7d', 'diarrhea_7d', 'diarrhea_28d', 'sleep_debt_7d']:
+        out[column] = out[column].fillna(0)
+    return out.reset_index()
+
+def daily_matrix(daily_df, column, as_of=None, days=28):
+    # 選手 × 日付 の表（ヒートマップ用）。値は各選手の期間平均からのずれ(%)
+    as_of = _as_of(as_of)
+    if daily_df.empty:
+        return pd.DataFrame()
+    d = _daily(daily_df[_window_mask(daily_df['date'], as_of, days)])
+    matrix = d.pivot_table(index='name', columns='date', values=column, aggfunc='last', observed=True)
+    matrix = matrix.reindex(columns=pd.date_range(as_of - pd.Timedelta(days=days - 1), as_of))
+    base = matrix.mean(axis=1)
+    return (matrix.sub(base, axis=0).div(base.replace(0, np.nan), axis=0) * 100).astype('float32')
+
+def _memo(key, compute):
+    # データの版が分かるときだけ結果を覚えておく
+    if key[0] is None:
+        return compute()
+    with _lock:
+        if key in _results:
+            _results.move_to_end(key)
+            return _results[key]
+    result = compute()
+    with _lock:
+        _results[key] = result
+        while len(_results) > _RESULTS_MAX:
+            _results.popitem(last=False)
+    return result
+
+def _as_of(as_of):
+    return pd.Timestamp(as_of if as_of is not None else pd.Timestamp.today()).normalize()
+
+def cached_team_metrics(frames, as_of=None):
+    # frames: {'users': df, 'daily': df, 'exercise': df, 'bowel': df}
+    # 同じデータの版・同じ基準日なら前回の結果を返す
+    as_of = _as_of(as_of)
+    return _memo((db.data_version(SHEETS), 'metrics', as_of), lambda: team_metrics(
+        frames['users'], frames['daily'], frames['exercise'], frames['bowel'], as_of))
+
+def cached_daily_matrix(daily_df, column, as_of=None, days=28):
+    as_of = _as_of(as_of)
+    return _memo((db.data_version(['daily']), 'matrix', column, as_of, days),
+                 lambda: daily_matrix(daily_df, column, as_of, days))
@@ -0,0 +1,352 @@
+# archive.py
+# 古い記録の保管庫。daily / meal / exercise / bowel のうち、一定より古い行を
+# スプレッドシートから手元の列指向ファイル（Arrow IPC、月ごとに1ファイル）へ移す。
+#
+#   archive/daily/2023-04.arrow, archive/meal/2023-04.arrow, ...
+#   archive/shards/tigers/2025/daily/2023-04.arrow, ...   （チーム・シーズンごとのシャード）
+#
+# - 読み込みはファイルをメモリマップして、必要な列・必要な月だけを取り出す（全体を読み込まない）
+# - query() / rows_for_player() は保管庫とスプレッドシートの行をまとめて返すので、
+#   呼び出し側は行がどちらにあるかを気にしなくてよい
+# - 月ごと・選手ごとの行数を _players.json に持っておき、player_page() はそのページの行がある月だけを読む
+# - 移す処理は python archive.py --days 365 で（cron などから）実行できる
+import argparse
+import json
+import os
+import threading
+import pandas as pd
+import db
+
+ARCHIVE_DIR = db._config("archive_dir", "archive")
+ARCHIVE_SHEETS = ['daily', 'meal', 'exercise', 'bowel']
+ARCHIVE_AFTER_DAYS = db._config("archive_after_days", 365)
+MOVE_KEY = '_move_key'  # 保管した行の目印の列（画面には出さない）
+
+_lock = threading.Lock()
+
+def _pa():
+    # pyarrow は保管庫を使うときだけ読み込む
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.ipc
+    return pyarrow
+
+def _sheet_dir(sheet_name):
+    # チーム・シーズン（db のシャード）ごとに分ける。default はこれまでどおり直下
+    shard = db.current_shard()
+    if shard == db.DEFAULT_SHARD:
+        return os.path.join(ARCHIVE_DIR, sheet_name)
+    return os.path.join(ARCHIVE_DIR, "shards", *shard.split("/"), sheet_name)
+
+def _month_path(sheet_name, month):
+    return os.path.join(_sheet_dir(sheet_name), f"{month}.arrow")
+
+def months(sheet_name):
+    # 保管してある月（"YYYY-MM"）の一覧（古い順）
+    try:
+        names = os.listdir(_sheet_dir(sheet_name))
+    except FileNotFoundError:
+        return []
+    return sorted(n[:-len(".arrow")] for n in names if n.endswith(".arrow"))
+
+def has_archive(sheet_name):
+    return bool(months(sheet_name))
+
+# --- 書き込み ---
+def _read_month(sheet_name, month):
+    pa = _pa()
+    with pa.memory_map(_month_path(sheet_name, month)) as source:
+        return pa.ipc.open_file(source).read_all()
+
+def _write_month(sheet_name, month, df):
+    # 一時ファイルに書いてから置き換える（途中で止まっても壊れたファイルを残さない）
+    pa = _pa()
+    os.makedirs(_sheet_dir(sheet_name), exist_ok=True)
+    path = _month_path(sheet_name, month)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    tmp = path + ".tmp"
+    with pa.OSFile(tmp, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp, path)
+
+def _move_keys(df):
+    # 移した行の目印: 移す前の行の番号（_row）と中身から作る。移す処理をやり直して同じ行を
+    # 2回受け取っても同じ目印になり、同じ中身の別の行（同じ日の同じ練習を2回など）とは区別できる
+    columns = sorted(c for c in df.columns if c != '_row') + ['_row']
+    hashes = pd.util.hash_pandas_object(df[columns].astype(str), index=False)
+    return hashes.map('{:016x}'.format)
+
+def store(sheet_name, df):
+    # 行を月ごとのファイルに足す。_row 列（db.move_rows_before が付ける）があれば、
+    # すでに保管した行は足さない（移す処理をやり直しても二重にならない）。保管した行の目印を返す
+    if df.empty:
+        return []
+    df = db.apply_schema(sheet_name, df.dropna(subset=['date']))
+    if '_row' in df.columns:
+        df = df.assign(_move_key=_move_keys(df)).drop(columns='_row')
+    with _lock:
+        index = _load_index(sheet_name)
+        for month, rows in df.groupby(df['date'].dt.strftime('%Y-%m'), sort=True):
+            if os.path.exists(_month_path(sheet_name, month)):
+                old = _read_month(sheet_name, month).to_pandas()
+                if MOVE_KEY in old.columns and MOVE_KEY in rows.columns:
+                    rows = rows[~rows[MOVE_KEY].isin(old[MOVE_KEY].dropna())]
+                    if rows.empty:
+                        continue
+                rows = db._concat_typed(sheet_name, [old, rows])
+            _write_month(sheet_name, month, rows.sort_values('date', kind='stable').reset_index(drop=True))
+            counts = rows['name'].dropna().astype(str).value_counts()
+            index[month] = {'stamp': _stamp(sheet_name, month), 'players': {k: int(v) for k, v in counts.items()}}
+        _write_index(sheet_name, index)
+    return df[MOVE_KEY].tolist() if MOVE_KEY in df.columns else []
+
+# 選手ごとの行数の索引: {月: {'stamp': [大きさ, 更新時刻], 'players': {選手名: 行数}}}。
+# 保管するときに書く。ファイルの大きさ・更新時刻が索引と違う月（索引を書く前に止まった、
+# delete_where で書き換えたなど）は、読むときにその月だけ数え直す
+def _index_path(sheet_name):
+    return os.path.join(_sheet_dir(sheet_name), "_players.json")
+
+def _stamp(sheet_name, month):
+    stat = os.stat(_month_path(sheet_name, month))
+    return [stat.st_size, stat.st_mtime_ns]
+
+def _load_index(sheet_name):
+    try:
+        with open(_index_path(sheet_name), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _write_index(sheet_name, index):
+    path = _index_path(sheet_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+def _count_month(sheet_name, month):
+    pa = _pa()
+    table = _read_month(sheet_name, month)
+    if 'name' not in table.column_names:
+        return {}
+    counts = pa.compute.value_counts(table['name'].cast(pa.string()))
+    return {c['values']: int(c['counts']) for c in counts.to_pylist() if c['values'] is not None}
+
+def _player_months(sheet_name, name):
+    # その選手の {月: 行数}（古い順）。索引と合わない月は数え直して索引を書き直す
+    with _lock:
+        saved = _load_index(sheet_name)
+        index = {}
+        for month in months(sheet_name):
+            stamp = _stamp(sheet_name, month)
+            entry = saved.get(month)
+            if entry is None or entry.get('stamp') != stamp:
+                entry = {'stamp': stamp, 'players': _count_month(sheet_name, month)}
+            index[month] = entry
+        if index != saved:
+            _write_index(sheet_name, index)
+    name = str(name)
+    return {month: entry['players'][name] for month, entry in index.items() if entry['players'].get(name)}
+
+# 保管したが、スプレッドシートから消せたかまだ分からない行の目印。
+# 消せたら空にする。残っている間は query() でスプレッドシート側の同じ行を1回分ずつ除く
+def _pending_path(sheet_name):
+    return os.path.join(_sheet_dir(sheet_name), "_pending.json")
+
+def _pending(sheet_name):
+    try:
+        with open(_pending_path(sheet_name), encoding="utf-8") as f:
+            return set(json.load(f))
+    except (FileNotFoundError, ValueError):
+        return set()
+
+def _set_pending(sheet_name, keys):
+    path = _pending_path(sheet_name)
+    if not keys:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(sorted(keys), f)
+    os.replace(path + ".tmp", path)
+
+def archive_old_rows(days=None, sheet_names=None):
+    # days 日より前の行をスプレッドシートから保管庫へ移す。{シート名: 移した行数} を返す
+    days = ARCHIVE_AFTER_DAYS if days is None else days
+    cutoff = pd.Timestamp.today().normalize() - pd.Timedelta(days=days)
+    counts = {}
+    for sheet_name in sheet_names or ARCHIVE_SHEETS:
+        def _sink(df, sheet_name=sheet_name):
+            _set_pending(sheet_name, store(sheet_name, df))
+        counts[sheet_name] = db.move_rows_before(sheet_name, cutoff, _sink)
+        _set_pending(sheet_name, ())
+    return counts
+
+def delete_where(sheet_names, column, value):
+    # 選手の削除用。保管庫からも該当する行を消す。{シート名: 削除件数} を返す
+    pa = _pa()
+    counts = {}
+    with _lock:
+        for sheet_name in db._as_list(sheet_names):
+            counts[sheet_name] = 0
+            for month in months(sheet_name):
+                table = _read_month(sheet_name, month)
+                if column not in table.column_names:
+                    continue
+                keep = pa.compute.not_equal(table[column].cast(pa.string()), str(value))
+                kept = table.filter(keep)
+                if kept.num_rows == table.num_rows:
+                    continue
+                counts[sheet_name] += table.num_rows - kept.num_rows
+                df = kept.to_pandas()
+                del table, kept  # メモリマップを閉じてからファイルを置き換える
+                if df.empty:
+                    os.remove(_month_path(sheet_name, month))
+                else:
+                    _write_month(sheet_name, month, df)
+    return counts
+
+# --- 読み込み ---
+def _month_of(value):
+    return pd.Timestamp(value).strftime('%Y-%m')
+
+def _scan(sheet_name, name=None, start=None, end=None, columns=None, keys=False, only_months=None):
+    # 保管庫から、条件に合う行・列だけを取り出す。keys=True なら行の目印（MOVE_KEY）も付ける。
+    # only_months を渡すとその月のファイルだけを読む
+    pa = _pa()
+    pc = pa.compute
+    first = _month_of(start) if start is not None else None
+    last = _month_of(end) if end is not None else None
+    frames = []
+    for month in months(sheet_name) if only_months is None else sorted(only_months):
+        if (first and month < first) or (last and month > last):
+            continue
+        with pa.memory_map(_month_path(sheet_name, month)) as source:
+            table = pa.ipc.open_file(source).read_all()
+            if columns is not None:
+                # 絞り込みに使う列も一緒に取り出す
+                needed = list(dict.fromkeys(list(columns) + [c for c in ('name', 'date') if c in table.column_names]
+                                            + ([MOVE_KEY] if keys else [])))
+                table = table.select([c for c in needed if c in table.column_names])
+            mask = None
+            if name is not None:
+                mask = pc.equal(table['name'].cast(pa.string()), str(name))
+            if start is not None:
+                m = pc.greater_equal(table['date'], pa.scalar(pd.Timestamp(start).normalize(), table['date'].type))
+                mask = m if mask is None else pc.and_(mask, m)
+            if end is not None:
+                m = pc.less_equal(table['date'], pa.scalar(pd.Timestamp(end).normalize(), table['date'].type))
+                mask = m if mask is None else pc.and_(mask, m)
+            if mask is not None:
+                table = table.filter(mask)
+            if not keys and MOVE_KEY in table.column_names:
+                table = table.drop([MOVE_KEY])
+            if table.num_rows:
+                frames.append(table.to_pandas())
+    if not frames:
+        return pd.DataFrame()
+    return db._concat_typed(sheet_name, frames)
+
+def _live(sheet_name, name=None, start=None, end=None):
+    rows = db.rows_for_player(sheet_name, name) if name is not None else db.load_data_from_sheet(sheet_name)
+    if rows.empty or 'date' not in rows.columns:
+        return rows
+    if start is not None:
+        rows = rows[rows['date'] >= pd.Timestamp(start).normalize()]
+    if end is not None:
+        rows = rows[rows['date'] <= pd.Timestamp(end).normalize()]
+    return rows
+
+def query(sheet_name, name=None, start=None, end=None, columns=None):
+    # 保管庫とスプレッドシートの行をまとめて返す（日付の古い順）。
+    # name / start / end で絞り込み、columns を渡すとその列だけを返す
+    live = _live(sheet_name, name, start, end)
+    if sheet_name not in ARCHIVE_SHEETS or not has_archive(sheet_name):
+        return live if columns is None or live.empty else live[[c for c in columns if c in live.columns]]
+    old = _scan(sheet_name, name, start, end, columns, keys=True)
+    pending = _pending(sheet_name)
+    moving = None
+    if MOVE_KEY in old.columns:
+        moving = old[old[MOVE_KEY].isin(pending)] if pending else None
+        old = old.drop(columns=MOVE_KEY)
+    if old.empty:
+        merged = live
+    elif live.empty:
+        merged = old
+    else:
+        if columns is not None:
+            live = live[[c for c in old.columns if c in live.columns]]
+        if moving is not None and not moving.empty:
+            # 移している途中で止まった行は保管庫とスプレッドシートの両方にあるので、
+            # スプレッドシート側から同じ中身の行を、保管した行数分だけ除く
+            live = _without(live, moving.drop(columns=MOVE_KEY))
+        merged = db._concat_typed(sheet_name, [old, live])
+    if merged.empty or 'date' not in merged.columns:
+        return merged
+    merged = merged.sort_values('date', kind='stable').reset_index(drop=True)
+    if columns is not None:
+        merged = merged[[c for c in columns if c in merged.columns]]
+    return merged
+
+def _without(live, rows):
+    # live から rows と同じ中身の行を、rows にある数だけ除く（同じ中身の行がほかにもあれば残す）
+    columns = [c for c in live.columns if c in rows.columns]
+    live_keys = pd.util.hash_pandas_object(live[columns].astype(str), index=False)
+    counts = pd.util.hash_pandas_object(rows[columns].astype(str), index=False).value_counts()
+    seen = live_keys.groupby(live_keys).cumcount()
+    return live[(seen >= live_keys.map(counts).fillna(0)).to_numpy()]
+
+def rows_for_player(sheet_name, name, columns=None):
+    # db.rows_for_player の保管庫込み版
+    return query(sheet_name, name=name, columns=columns)
+
+def player_count(sheet_name, name):
+    # db.player_count の保管庫込み版
+    total = db.player_count(sheet_name, name)
+    if sheet_name not in ARCHIVE_SHEETS or not has_archive(sheet_name):
+        return total
+    return total + sum(_player_months(sheet_name, name).values())
+
+def player_page(sheet_name, name, page, page_size):
+    # db.player_page の保管庫込み版（新しい順）。スプレッドシートの行を先に、続きを保管庫から出す
+    rows, live_total = db.player_page(sheet_name, name, page, page_size)
+    if sheet_name not in ARCHIVE_SHEETS or not has_archive(sheet_name):
+        return rows, live_total
+    per_month = _player_months(sheet_name, name)  # 古い順
+    old_total = sum(per_month.values())
+    need = page_size - len(rows)
+    if need > 0 and old_total:
+        # 保管庫の行を古い順に並べたときの [lo, hi) が欲しい範囲。そこにかかる月だけを読む
+        skip = max(page * page_size - live_total, 0)
+        hi = max(old_total - skip, 0)
+        lo = max(hi - need, 0)
+        wanted, first, offset = [], None, 0
+        for month, n in per_month.items():
+            if offset < hi and offset + n > lo:
+                wanted.append(month)
+                first = offset if first is None else first
+            offset += n
+        if wanted:
+            old = _scan(sheet_name, name=name, only_months=wanted)
+            part = old.iloc[lo - first:hi - first].iloc[::-1]
+            rows = part if rows.empty else db._concat_typed(sheet_name, [rows, part])
+    return rows, live_total + old_total
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="古い記録をスプレッドシートから保管庫へ移す")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS, help="これより古い行を移す（日数）")
+    parser.add_argument("--sheets", default=",".join(ARCHIVE_SHEETS), help="対象のシート（カンマ区切り）")
+    parser.add_argument("--shards", help="対象のチーム/シーズン（カンマ区切り。省略時はすべて）")
+    args = parser.parse_args(argv)
+    sheet_names = [s for s in args.sheets.split(",") if s]
+    shards = [s for s in args.shards.split(",") if s] if args.shards else db.shard_keys()
+    for shard in shards:
+        with db.use_shard(shard):
+            counts = archive_old_rows(args.days, sheet_names)
+        for sheet_name, n in counts.items():
+            print(f"{shard} {sheet_name}: {n} 行を移しました")
+
+if __name__ == "__main__":
+    main()
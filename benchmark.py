@@ -0,0 +1,272 @@
+# benchmark.py
+# 読み込み・保存の速さを、手元のメモリ上のスプレッドシート（fake_sheets.py）で測る。
+# 選手数・記録期間を変えた架空のチームを作り、シナリオごとに
+#   所要時間 / API呼び出し回数 / 送受信バイト数 / ピークメモリ
+# を JSON で出力する。基準値（baseline）と比べて遅くなっていたら終了コード 1 で終わる。
+#
+#   python benchmark.py                                 # 10人×30日, 100人×365日
+#   python benchmark.py --players 10,100,500 --days 30,365,1095 --output result.json
+#   python benchmark.py --save-baseline bench_baseline.json
+#   python benchmark.py --baseline bench_baseline.json  # 遅くなっていたら失敗
+#
+# リポジトリの bench_baseline.json は既定の設定（引数なし）で取った基準値。速くした・遅くなるのを
+# 受け入れた変更では、同じ設定で取り直して一緒にコミットする（meta に取ったときの環境が入る）
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+import db
+import fake_sheets
+
+SHEETS = ['users', 'daily', 'meal', 'exercise', 'bowel']
+HEADERS = {
+    'users': ['name', 'dob', 'height'],
+    'daily': ['name', 'date', 'weight', 'body_fat', 'sleep'],
+    'meal': ['name', 'date', 'type', 'time', 'menu', 'image_url'],
+    'exercise': ['name', 'date', 'time', 'content'],
+    'bowel': ['name', 'date', 'time', 'amount', 'hardness'],
+}
+MEAL_TYPES = ["朝食", "昼食", "夕食"]
+WRITES_PER_RUN = 10  # 書き込み系シナリオで1回に行う保存の数
+
+# --- 架空のチーム ---
+def player_names(n_players):
+    return [f"選手{i:03d}" for i in range(n_players)]
+
+def make_team(n_players, n_days, seed=0):
+    # {シート名: [[ヘッダー], [行], ...]}。1人1日あたり 体調1・食事3・運動1・排便1 行
+    rng = random.Random(seed)
+    end = date(2024, 12, 31)
+    days = [str(end - timedelta(days=d)) for d in range(n_days - 1, -1, -1)]
+    names = player_names(n_players)
+    tables = {name: [HEADERS[name]] for name in SHEETS}
+    for name in names:
+        tables['users'].append([name, "2005-04-01", round(rng.uniform(160, 190), 1)])
+    for d in days:
+        for name in names:
+            tables['daily'].append([name, d, round(rng.uniform(55, 85), 1), round(rng.uniform(8, 20), 1), rng.choice([6, 6.5, 7, 7.5, 8])])
+            for i, meal_type in enumerate(MEAL_TYPES):
+                tables['meal'].append([name, d, meal_type, f"{7 + i * 5:02d}:30:00", "ご飯・味噌汁", ""])
+            tables['exercise'].append([name, d, f"{rng.choice([30, 60, 90])}分", "練習"])
+            tables['bowel'].append([name, d, "07:00:00", "普通", rng.choice(["普通", "普通", "硬い", "下痢"])])
+    return tables
+
+# --- シナリオ ---
+# setup(env) は計測の外、run(env) が計測の対象
+def _cold(env):
+    fake_sheets.reset_db_state()
+
+def _warm(env):
+    fake_sheets.reset_db_state()
+    db.load_many(SHEETS)
+
+def run_load_sheet(env):
+    for sheet_name in SHEETS:
+        db.load_data_from_sheet(sheet_name)
+
+def run_admin_load(env):
+    import analytics
+    import rollups
+    frames = db.load_many(SHEETS)
+    analytics.team_metrics(frames['users'], frames['daily'], frames['exercise'], frames['bowel'])
+    rollups.refresh(frames)
+
+def _setup_delta(env):
+    # 読み込み済みの状態で、他の選手の保存（数行）が後から届いた
+    _warm(env)
+    ws = env['client'].spreadsheet.worksheet_('meal')
+    with env['client'].lock:
+        for name in env['names'][:5]:
+            ws.rows.append([name, "2025-01-01", "朝食", "07:30:00", "パン", ""])
+    db.invalidate_cache()
+
+def run_admin_reload_delta(env):
+    db.load_many(SHEETS)
+
+def _next_day(env):
+    env['day'] = env.get('day', 0) + 1
+    return str(date(2025, 1, 1) + timedelta(days=env['day']))
+
+def run_append(env):
+    d = _next_day(env)
+    for name in env['names'][:WRITES_PER_RUN]:
+        db.append_data_to_sheet('exercise', {'name': name, 'date': d, 'time': "60分", 'content': "自主練"})
+
+def _setup_overwrite(env):
+    _cold(env)
+    env['users_df'] = db.load_data_from_sheet('users')
+
+def run_overwrite(env):
+    db.overwrite_sheet_data('users', env['users_df'])
+
+def _setup_patient_save(env):
+    # アップロード済みの写真の覚え（プロセス全体）も捨てる。残っていると前のケースで送った写真は
+    # アップロードされず、写真のアップロードが計測に入らない
+    _warm(env)
+    import photo_upload
+    with photo_upload._lock:
+        photo_upload._known_urls.clear()
+
+def run_patient_save(env):
+    # 保存ボタン（記録帳への書き込み）から、スプレッドシートに届くまで
+    import write_queue
+    d = _next_day(env)
+    acks = []
+    for i, name in enumerate(env['names'][:WRITES_PER_RUN]):
+        ops = [{'op': 'upsert', 'sheet': 'daily', 'key_columns': ['name', 'date'],
+                'rows': [{'name': name, 'date': d, 'weight': 65.5, 'body_fat': 12.0, 'sleep': 7.0}]},
+               {'op': 'append', 'sheet': 'exercise', 'rows': [{'name': name, 'date': d, 'time': "60分", 'content': "練習"}]},
+               {'op': 'append', 'sheet': 'meal', 'rows': [{'name': name, 'date': d, 'type': "朝食", 'time': "07:30",
+                                                           'menu': "ご飯", 'image_url': "", '_image': 0}]}]
+        image = f"photo {env['case']} {d} {name}".encode() * 1000
+        t = time.perf_counter()
+        write_queue.enqueue(name, ops, [image])
+        acks.append(time.perf_counter() - t)
+    while write_queue.pending_count():
+        time.sleep(0.01)
+    env['extra']['save_ack_seconds'] = statistics.median(acks)
+
+SCENARIOS = {
+    'load_sheet': (_cold, run_load_sheet),
+    'admin_load': (_cold, run_admin_load),
+    'admin_reload_delta': (_setup_delta, run_admin_reload_delta),
+    'append': (_cold, run_append),
+    'overwrite': (_setup_overwrite, run_overwrite),
+    'patient_save': (_setup_patient_save, run_patient_save),
+}
+
+# --- 計測 ---
+def measure(env, scenario, repeat):
+    setup, run = SCENARIOS[scenario]
+    client = env['client']
+    walls = []
+    for _ in range(repeat):
+        setup(env)
+        client.reset_stats()
+        env['extra'] = {}
+        t = time.perf_counter()
+        run(env)
+        walls.append(time.perf_counter() - t)
+    stats = client.stats()
+    extra = env['extra']
+
+    # メモリは別に1回測る（tracemalloc を入れると遅くなるため）
+    setup(env)
+    tracemalloc.start()
+    run(env)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(wall_seconds=statistics.median(walls), wall_seconds_min=min(walls),
+                peak_memory_bytes=peak, **stats, **extra)
+
+def run_suite(players, days, scenarios, repeat, latency, upload_latency, quota, seed):
+    import write_queue
+    results = []
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    uploader = fake_sheets.FakeUploader(latency=upload_latency)
+    write_queue.uploader = uploader
+    # 手元の交通整理は、代役の上限と同じにする（上限なしなら止めない）
+    db.READ_QUOTA_PER_MINUTE = db.WRITE_QUOTA_PER_MINUTE = quota or 10 ** 9
+    db._buckets.clear()
+
+    for n_players in players:
+        for n_days in days:
+            client = fake_sheets.FakeClient(latency=latency, read_quota=quota, write_quota=quota)
+            client.load(make_team(n_players, n_days, seed))
+            fake_sheets.install(client)
+            db.get_spreadsheet()  # 接続はプロセスで1回だけなので、計測の外で済ませておく
+            # 記録帳もチームごとに分ける（同じ内容の保存が「保存済み」扱いにならないように）
+            write_queue.JOURNAL_PATH = os.path.join(workdir, f"journal_{n_players}_{n_days}.db")
+            env = {'client': client, 'names': player_names(n_players), 'case': f"{n_players}x{n_days}"}
+            for scenario in scenarios:
+                uploads_before = uploader.uploads
+                result = measure(env, scenario, repeat)
+                result['uploads'] = uploader.uploads - uploads_before
+                case = f"players={n_players},days={n_days}/{scenario}"
+                results.append(dict(case=case, players=n_players, days=n_days, scenario=scenario, **result))
+                print(f"{case:45s} {result['wall_seconds']:8.3f}s  calls={result['api_calls_total']:4d}"
+                      f"  recv={result['bytes_received'] / 1e6:7.2f}MB  peak={result['peak_memory_bytes'] / 1e6:7.1f}MB",
+                      file=sys.stderr)
+    return results
+
+# --- 基準値との比較 ---
+def compare(results, baseline, tolerance, slack):
+    # 基準値より (1 + tolerance) 倍 + slack 秒以上遅いか、API呼び出しが増えていたら退行
+    base = {r['case']: r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        b = base.get(r['case'])
+        if b is None:
+            continue
+        limit = b['wall_seconds'] * (1 + tolerance) + slack
+        if r['wall_seconds'] > limit:
+            regressions.append(f"{r['case']}: {r['wall_seconds']:.3f}s > {limit:.3f}s (基準 {b['wall_seconds']:.3f}s)")
+        if r['api_calls_total'] > b['api_calls_total']:
+            regressions.append(f"{r['case']}: API呼び出し {r['api_calls_total']} 回 > 基準 {b['api_calls_total']} 回")
+    return regressions
+
+def _int_list(text):
+    return [int(v) for v in text.split(",") if v]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="スプレッドシートの代役を使った読み込み・保存のベンチマーク")
+    parser.add_argument("--players", type=_int_list, default=[10, 100], help="選手数（カンマ区切り）")
+    parser.add_argument("--days", type=_int_list, default=[30, 365], help="記録の日数（カンマ区切り）")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="実行するシナリオ（カンマ区切り）")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.05, help="API 1回あたりの待ち時間（秒）")
+    parser.add_argument("--upload-latency", type=float, default=0.2, help="写真1枚のアップロード時間（秒）")
+    parser.add_argument("--quota", type=int, default=0, help="読み込み・書き込みそれぞれの毎分の上限（0 = なし）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="結果の JSON を書き出すファイル（省略時は標準出力）")
+    parser.add_argument("--baseline", help="比較する基準値の JSON")
+    parser.add_argument("--save-baseline", help="今回の結果を基準値として保存するファイル")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="許容する遅れの割合")
+    parser.add_argument("--slack", type=float, default=0.05, help="許容する遅れの秒数（計測のゆらぎ分）")
+    args = parser.parse_args(argv)
+
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"不明なシナリオ: {', '.join(unknown)}")
+
+    results = run_suite(args.players, args.days, scenarios, args.repeat,
+                        args.latency, args.upload_latency, args.quota, args.seed)
+    report = {
+        'meta': {
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'latency': args.latency, 'upload_latency': args.upload_latency, 'quota': args.quota,
+            'repeat': args.repeat, 'created_at': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        'results': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.slack)
+        if regressions:
+            print("性能の退行があります:", file=sys.stderr)
+            for line in regressions:
+                print("  " + line, file=sys.stderr)
+            return 1
+        print("基準値との比較: 問題なし", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+# charts.py
+# 体重・体脂肪率のグラフ（選手用・管理者用で共通）。
+# 記録が何年分あっても、グラフに載せる点の数は MAX_POINTS 以下に抑える。
+#
+# - 表示期間（1か月 / 3か月 / 1年 / 全期間）で切り出す
+# - 点が多すぎるときは週平均にし、それでも多ければ LTTB で形を保ったまま間引く
+# - 目盛りの間隔は表示期間の長さに合わせて変える
+# - 作ったグラフは (選手, 期間, データの版) ごとに覚えておく
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import db
+
+WINDOWS = {"1か月": 30, "3か月": 91, "1年": 365, "全期間": None}
+DEFAULT_WINDOW = "3か月"
+MAX_POINTS = db._config("chart_max_points", 120)
+MARKER_POINTS = 60  # これより点が少なければ点も描く
+
+_lock = threading.Lock()
+_figures = OrderedDict()  # (選手, 期間, データの版, ...) -> Figure
+_FIGURES_MAX = 64
+
+def lttb(x, y, n_out):
+    # Largest-Triangle-Three-Buckets: 折れ線の形を保ったまま n_out 点に間引き、残す点の番号を返す
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = [0]
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # 次のバケツの平均点（最後は末尾の点）
+        nlo, nhi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        nx, ny = (x[nlo:nhi].mean(), y[nlo:nhi].mean()) if nhi > nlo else (x[-1], y[-1])
+        ax, ay = x[keep[-1]], y[keep[-1]]
+        area = np.abs((ax - nx) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (ny - ay))
+        keep.append(lo + int(np.argmax(area)))
+    keep.append(n - 1)
+    return np.asarray(keep)
+
+def _downsample(d, column):
+    # 1つの系列（欠損を除く）を MAX_POINTS 以下にする
+    s = d[['date', column]].dropna()
+    if len(s) <= MAX_POINTS:
+        return s['date'], s[column]
+    weekly = s.set_index('date')[column].astype('float64').resample('W').mean().dropna()
+    if len(weekly) <= MAX_POINTS:
+        return weekly.index.to_series(), weekly
+    x = weekly.index.asi8
+    idx = lttb(x, weekly.to_numpy(), MAX_POINTS)
+    return weekly.index[idx].to_series(), weekly.iloc[idx]
+
+def _ticks(span_days):
+    # 表示期間の長さに合わせた目盛り間隔と書式
+    if span_days <= 14:
+        return dict(dtick="D1", tickformat="%m/%d")
+    if span_days <= 62:
+        return dict(dtick=7 * 24 * 60 * 60 * 1000, tickformat="%m/%d")
+    if span_days <= 400:
+        return dict(dtick="M1", tickformat="%Y-%m")
+    return dict(dtick="M3", tickformat="%Y-%m")
+
+def condition_figure(daily_rows, window=DEFAULT_WINDOW, height=400, as_of=None):
+    # daily_rows: 1人分の体調の行（型は db で揃っているもの）
+    # Plotly は読み込みに時間がかかるので、グラフを初めて描くときに読み込む
+    import plotly.graph_objects as go
+    d = daily_rows.dropna(subset=['date']).sort_values('date', kind='stable')
+    d = d.drop_duplicates(subset=['date'], keep='last')
+    days = WINDOWS.get(window)
+    if days is not None and not d.empty:
+        end = pd.Timestamp(as_of).normalize() if as_of is not None else d['date'].max()
+        d = d[d['date'] > end - pd.Timedelta(days=days)]
+
+    fig = go.Figure()
+    series = {'weight': ('体重 (kg)', dict(color='#007bff', width=2)),
+              'body_fat': ('体脂肪率 (%)', dict(color='#28a745', width=2, dash='dot'))}
+    for column, (label, line) in series.items():
+        x, y = _downsample(d, column)
+        mode = 'lines+markers' if len(x) <= MARKER_POINTS else 'lines'
+        fig.add_trace(go.Scatter(x=x, y=y, mode=mode, name=label, line=line))
+
+    max_val = 100
+    if not d['weight'].dropna().empty:
+        max_val = max(d['weight'].max(), d['body_fat'].max()) * 1.1
+    span_days = (d['date'].max() - d['date'].min()).days if not d.empty else 0
+
+    fig.update_layout(
+        height=height, margin=dict(l=20, r=20, t=20, b=20),
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
+        yaxis=dict(range=[0, max_val], fixedrange=True, title="値"),
+        xaxis=dict(fixedrange=True, **_ticks(span_days)),
+        hovermode="x unified"
+    )
+    return fig
+
+def cached_condition_figure(name, daily_rows, window=DEFAULT_WINDOW, height=400, version=None):
+    # version: データの版（db.data_version(['daily']) など）。None のときは覚えずに毎回作る
+    if version is None:
+        return condition_figure(daily_rows, window, height)
+    # 送信待ちの行が混ざることもあるので、行数と最新日もキーに入れる
+    last_date = daily_rows['date'].max() if not daily_rows.empty else None
+    key = (name, window, height, version, len(daily_rows), last_date)
+    with _lock:
+        if key in _figures:
+            _figures.move_to_end(key)
+            return _figures[key]
+    fig = condition_figure(daily_rows, window, height)
+    with _lock:
+        _figures[key] = fig
+        while len(_figures) > _FIGURES_MAX:
+            _figures.popitem(last=False)
+    return fig
@@ -1,9 +1,21 @@
 # db.py
 import streamlit as st
-import gspread
+import contextvars
+import itertools
 import json
+import numbers
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from urllib.parse import parse_qs, unquote, urlparse
+import numpy as np
 import pandas as pd
-from google.oauth2.service_account import Credentials
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import metrics
 
 # --- 設定 ---
 # ここにあなたのスプレッドシートのURLを貼ってください
@@ -15,33 +27,974 @@ SCOPES = [
     "https://www.googleapis.com/auth/drive"
 ]
 
+# secrets.toml の [db] セクションで上書きできる設定値
+def _config(key, default):
+    try:
+        return st.secrets["db"][key]
+    except Exception:
+        return default
+
+# --- 保存先の切り替え ---
+# 既定はGoogleスプレッドシート。secrets.toml の [db] に backend = "sqlite" と書くと
+# ローカルのSQLite（sqlite_backend.py）に保存する。公開関数の名前・引数はどちらも同じ
+BACKEND = _config("backend", "sheets")
+SQLITE_PATH = _config("sqlite_path", "nutrition.db")
+
+def set_backend(name, sqlite_path=None):
+    # 負荷試験などでコードから切り替えるとき用
+    global BACKEND, SQLITE_PATH
+    BACKEND = name
+    if sqlite_path is not None:
+        SQLITE_PATH = sqlite_path
+    invalidate_cache()
+
+# 計測（metrics.py）。ふだんは止めておき、管理画面の性能パネルから有効にする
+if _config("metrics_enabled", False):
+    metrics.enable()
+if _config("metrics_log", False):
+    metrics.add_sink(metrics.LogSink())
+
+def _local_backend():
+    # SQLiteを使う設定ならそのモジュールを返す。スプレッドシートなら None
+    if BACKEND != "sqlite":
+        return None
+    import sqlite_backend
+    sqlite_backend.connect(SQLITE_PATH)
+    return sqlite_backend
+
+# gspread・google-auth は読み込みに時間がかかるので、初めて使うときまで読み込まない
+# （起動直後の画面を待たせない。startup.prewarm が裏で先に読み込んでおく）
+def _gspread():
+    import gspread
+    return gspread
+
 # --- 接続関数 ---
+# Streamlitは全セッションが同じプロセス内で動くので、認証済みクライアントと
+# スプレッドシート／ワークシートのハンドルはプロセス全体で1つだけ作って使い回す。
+# （毎回 認証 → open_by_url をすると、それだけで保存が遅くなるため）
+_pool_lock = threading.RLock()  # 下の表を触る間だけ持つ（通信の間は持たない）
+_auth_lock = threading.RLock()  # 認証・トークンの更新
+_creds = None
+_client = None
+_spreadsheets = {}  # URL -> Spreadsheet
+_worksheets = {}  # (URL, シート名) -> Worksheet
+_open_locks = {}  # URL / (URL, シート名) -> Lock（同じものを同時に二重に開かない）
+
 def get_connection():
-    # secrets.toml から鍵情報を読み込む
-    key_dict = json.loads(st.secrets["gcp"]["json"])
-    creds = Credentials.from_service_account_info(key_dict, scopes=SCOPES)
-    client = gspread.authorize(creds)
-    return client
+    global _creds, _client
+    with _auth_lock:
+        if _client is None:
+            from google.oauth2.service_account import Credentials
+            # secrets.toml から鍵情報を読み込む
+            with metrics.timer('auth_ms', step='authorize'):
+                key_dict = json.loads(st.secrets["gcp"]["json"])
+                _creds = Credentials.from_service_account_info(key_dict, scopes=SCOPES)
+                _client = _gspread().authorize(_creds)
+            # 実際に送ったHTTPリクエストを1件ずつ数える
+            _client.http_client.session.hooks['response'].append(_record_request)
+        elif not _creds.valid:
+            # トークンの期限が切れていたら、クライアントは作り直さずにその場で更新
+            from google.auth.transport.requests import Request
+            with metrics.timer('auth_ms', step='refresh'):
+                _creds.refresh(Request())
+        return _client
+
+def _request_labels(request):
+    # Sheets API の URL から (操作, シート名) を読み取る
+    # 例: GET .../values/'meal'!A1:F -> ('values.get', 'meal')
+    #     GET .../values:batchGet?ranges=... -> ('values.batchGet', 'meal,daily')
+    url = urlparse(request.url)
+    path = unquote(url.path)
+    if "/values/" in path:
+        range_part = path.split("/values/", 1)[1]
+        if range_part.endswith((":append", ":clear")):
+            action = range_part.rsplit(":", 1)[-1]
+        else:
+            action = "get" if request.method == "GET" else "update"
+        return "values." + action, range_part.split("!", 1)[0].strip("'")
+    if "/values:" in path:
+        op = "values." + path.rsplit(":", 1)[-1]
+    elif path.endswith(":batchUpdate"):
+        op = "batchUpdate"
+    else:
+        op = "metadata"
+    ranges = parse_qs(url.query).get("ranges", [])
+    sheet = ",".join(dict.fromkeys(r.split("!", 1)[0].strip("'") for r in ranges)) or "-"
+    return op, sheet
+
+def _record_request(response, *args, **kwargs):
+    if not metrics.enabled():
+        return
+    try:
+        op, sheet = _request_labels(response.request)
+        metrics.count('api_requests', op=op, sheet=sheet, status=response.status_code)
+        metrics.observe('api_request_ms', response.elapsed.total_seconds() * 1000, op=op)
+        metrics.count('api_bytes_sent', len(response.request.body or b""), op=op)
+        metrics.count('api_bytes_received', len(response.content or b""), op=op)
+    except Exception:
+        pass
+
+def _open_lock(key):
+    with _pool_lock:
+        if key not in _open_locks:
+            _open_locks[key] = threading.Lock()
+        return _open_locks[key]
+
+def _open(url):
+    # 開く通信は _pool_lock の外で行う（あるチームのスプレッドシートを開く間も、ほかのチームは待たない）
+    client = get_connection()
+    with _pool_lock:
+        spreadsheet = _spreadsheets.get(url)
+    if spreadsheet is not None:
+        return spreadsheet
+    with _open_lock(url):
+        with _pool_lock:
+            spreadsheet = _spreadsheets.get(url)
+        if spreadsheet is None:
+            with metrics.timer('open_by_url_ms'):
+                spreadsheet = _Metered(_run(lambda: _api('read', client.open_by_url, url), op='open_by_url'))
+            with _pool_lock:
+                _spreadsheets[url] = spreadsheet
+        return spreadsheet
+
+def get_spreadsheet():
+    # 今のシャード（下記）のスプレッドシート
+    return _open(shard_url())
+
+def get_worksheet(sheet_name):
+    url = shard_url()
+    key = (url, sheet_name)
+    with _pool_lock:
+        sheet = _worksheets.get(key)
+    if sheet is not None:
+        return sheet
+    spreadsheet = _open(url)
+    with _open_lock(key):
+        with _pool_lock:
+            sheet = _worksheets.get(key)
+        if sheet is None:
+            # 見つからない場合は WorksheetNotFound がそのまま上がる（キャッシュしない）
+            sheet = _run(lambda: spreadsheet.worksheet(sheet_name), op='worksheet')
+            with _pool_lock:
+                _worksheets[key] = sheet
+        return sheet
+
+def reset_connection():
+    # 認証エラー後などに、次回アクセスで一から接続し直す
+    global _creds, _client
+    with _auth_lock, _pool_lock:
+        _creds = None
+        _client = None
+        _spreadsheets.clear()
+        _worksheets.clear()
+
+# --- シャード（チーム・シーズンごとのスプレッドシート） ---
+# 全チーム・全シーズンを1つのスプレッドシートに入れると、書き込みのロック・
+# 全件読み込みの大きさをみんなで分け合うことになる。そこで (チーム, シーズン) ごとに
+# 別のスプレッドシートへ振り分ける。振り分け表は secrets.toml に書く:
+#
+#   [db.shards]
+#   "tigers/2025" = "https://docs.google.com/spreadsheets/d/..."
+#
+# 振り分け表にないときやチームを選んでいないときは "default"（SHEET_URL）を使う。
+# キャッシュ・差分同期・索引・ロックはシャードごとに分かれているので、
+# チームを足しても、別のチームの読み込みや保存の終わりを待つことはない。
+# ただし毎分の上限はサービスアカウント（プロジェクト）単位なので、全シャードで1つを分け合う
+# ※ SQLite に保存する設定では振り分けない（1つのファイルに全員分が入る）
+DEFAULT_SHARD = "default"
+SHARDS = dict(_config("shards", {}))
+SHARD_ROUTES_PATH = _config("shard_routes_path", "shard_routes.json")  # move_shard で移した先を覚えるファイル
+# move_shard と書き込みの間のロックファイルを置く場所（既定は shard_routes.json の隣）。
+# 起動したあとに作業ディレクトリが変わっても同じ場所を使うよう、ここで絶対パスにしておく
+SHARD_LOCK_DIR = os.path.abspath(_config("shard_lock_dir", os.path.join(os.path.dirname(SHARD_ROUTES_PATH), "shard_locks")))
+SHARD_WORKERS = _config("shard_workers", 4)
+CURRENT_SEASON = str(_config("season", time.strftime("%Y")))  # チームだけ指定したときのシーズン
+
+_shard_var = contextvars.ContextVar('db_shard', default=None)
+
+def shard_key(team, season=None):
+    return f"{team}/{CURRENT_SEASON if season is None else season}"
+
+def _load_routes():
+    try:
+        with open(SHARD_ROUTES_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _routes_mtime():
+    try:
+        return os.stat(SHARD_ROUTES_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+_routes = {**SHARDS, **_load_routes()}
+_routes_seen = _routes_mtime()
+
+def _refresh_routes():
+    # 別のプロセスが move_shard でファイルを書き換えたら読み直し、移ったシャードの状態を捨てる
+    global _routes_seen
+    mtime = _routes_mtime()
+    if mtime == _routes_seen:
+        return
+    routes = {**SHARDS, **_load_routes()}
+    with _pool_lock:
+        _routes_seen = mtime
+        moved = [key for key, url in routes.items() if _routes.get(key) != url]
+        _routes.clear()
+        _routes.update(routes)
+    for key in moved:
+        _forget_shard(key)
+
+def _save_route(key, url):
+    # 移した先は secrets.toml ではなくファイルに残す（再起動しても元に戻らないように）
+    global _routes_seen
+    with _pool_lock:
+        _routes[key] = url
+        saved = _load_routes()
+        saved[key] = url
+        tmp = SHARD_ROUTES_PATH + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(saved, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, SHARD_ROUTES_PATH)
+        _routes_seen = _routes_mtime()
+
+def shard_keys():
+    # 振り分け表にあるシャードの一覧（default が先頭）
+    if _local_backend() is not None:
+        return [DEFAULT_SHARD]
+    _refresh_routes()
+    with _pool_lock:
+        keys = sorted(k for k in _routes if k != DEFAULT_SHARD)
+    return [DEFAULT_SHARD] + keys
+
+def shard_url(key=None):
+    key = current_shard() if key is None else key
+    _refresh_routes()
+    with _pool_lock:
+        url = _routes.get(key)
+    if url is not None:
+        return url
+    if key == DEFAULT_SHARD:
+        return SHEET_URL
+    raise KeyError(f"振り分け表にないシャードです: {key}")
+
+def current_shard():
+    key = _shard_var.get()
+    if key is not None:
+        return key
+    # 画面で set_shard したもの（フラグメントだけの再実行でも引き継がれる）
+    if get_script_run_ctx(suppress_warning=True) is not None:
+        return st.session_state.get('db_shard', DEFAULT_SHARD)
+    return DEFAULT_SHARD
+
+def set_shard(key):
+    # 画面側から: このセッションの読み書きを key のシャードに向ける
+    shard_url(key)  # 振り分け表にないものはここで KeyError
+    st.session_state['db_shard'] = key
+
+@contextmanager
+def use_shard(key):
+    # with db.use_shard("tigers/2025"): ...  （裏のスレッド・コマンドラインからの処理用）
+    shard_url(key)
+    token = _shard_var.set(key)
+    try:
+        yield
+    finally:
+        _shard_var.reset(token)
+
+def _sk(sheet_name):
+    # シャードごとに分けて持つ状態（キャッシュ・索引・ロックなど）のキー
+    return (current_shard(), sheet_name)
+
+def _is_auth_error(e):
+    from google.auth.exceptions import RefreshError
+    if isinstance(e, RefreshError):
+        return True
+    if isinstance(e, _gspread().exceptions.APIError):
+        return e.response is not None and e.response.status_code == 401
+    return False
+
+# --- リクエストの交通整理（APIの毎分の上限対策） ---
+# シート操作はすべて _run を通す。
+# - 読み込み・書き込みそれぞれの毎分の上限を超えないよう、API のリクエスト1回ごとに
+#   直近60秒の回数を数えて順番待ちさせる（_Metered。1つの操作が何回リクエストを送っても、その回数分数える）
+# - 同じ読み込みが別のセッションで実行中なら、新しく送らずにその結果を待って使う
+# - 混雑(429)やサーバー側の一時エラー(5xx)は、ゆらぎ付きで間隔を伸ばしながら再試行する
+# - 認証エラーなら接続を作り直して1回だけやり直す
+READ_QUOTA_PER_MINUTE = _config("read_quota_per_minute", 60)
+WRITE_QUOTA_PER_MINUTE = _config("write_quota_per_minute", 60)
+MAX_RETRIES = _config("max_retries", 5)
+BACKOFF_BASE_SECONDS = _config("backoff_base_seconds", 1.0)
+BACKOFF_MAX_SECONDS = _config("backoff_max_seconds", 32.0)
+RETRY_STATUS = (500, 502, 503, 504)
+
+class SheetUnavailableError(Exception):
+    # 再試行してもシートを読めなかった（通信・サーバー・認証のエラー）。「シートが空」とは区別する
+    pass
+
+class ThrottledError(SheetUnavailableError):
+    # 混雑(429)で、再試行しても通らなかった
+    pass
+
+class _RateLimiter:
+    # 直近60秒に送った回数を数え、上限に達していたら一番古いものが60秒前になるまで待つ
+    # （Sheets API の上限は「どの60秒を取っても N 回まで」なので、貯めた枠をまとめて使うと超えてしまう）。
+    # 待っている呼び出しはシャードごとに並べ、空いた枠はシャードを順番に回して渡す。
+    # 上限は全体で1つでも、あるチームの大量の書き込みの後ろに別のチームが並ばされないようにする
+    WINDOW_SECONDS = 60.0
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.sent = deque()  # 直近60秒に枠を渡した時刻
+        self.cond = threading.Condition()
+        self.waiting = OrderedDict()  # シャード -> 待っている呼び出しの列（先頭のシャードが次の番）
+
+    def acquire(self, shard=None):
+        me = object()
+        with self.cond:
+            line = self.waiting.setdefault(shard, deque())
+            line.append(me)
+            while True:
+                now = time.monotonic()
+                while self.sent and now - self.sent[0] >= self.WINDOW_SECONDS:
+                    self.sent.popleft()
+                turn = line[0] is me and next(iter(self.waiting)) == shard
+                if turn and len(self.sent) < self.capacity:
+                    self.sent.append(now)
+                    line.popleft()
+                    if line:
+                        self.waiting.move_to_end(shard)
+                    else:
+                        del self.waiting[shard]
+                    self.cond.notify_all()
+                    return
+                # 自分の番なら一番古い枠が空くまで、そうでなければ番が回ってくるまで待つ
+                self.cond.wait(self.WINDOW_SECONDS - (now - self.sent[0]) if turn else None)
+
+# 上限（READ/WRITE_QUOTA_PER_MINUTE）は Sheets API ではサービスアカウント（プロジェクト）ごとに
+# かかるので、シャードに分けず全体で1つ。シャードごとに持つと、シャードの数だけ上限を超えて 429 になる
+_buckets = {}  # 'read' / 'write' -> _RateLimiter
+
+def _bucket(kind):
+    with _pool_lock:
+        if kind not in _buckets:
+            _buckets[kind] = _RateLimiter(READ_QUOTA_PER_MINUTE if kind == 'read' else WRITE_QUOTA_PER_MINUTE)
+        return _buckets[kind]
+
+def _api(kind, func, *args, **kwargs):
+    # API のリクエスト1回分: 上限の枠を1つ取ってから送る
+    _bucket(kind).acquire(current_shard())
+    return func(*args, **kwargs)
+
+# gspread のメソッドのうち、呼ぶと Sheets API へリクエストを1回送るもの
+_API_KINDS = {
+    'get_all_values': 'read', 'get_all_records': 'read', 'batch_get': 'read',
+    'values_batch_get': 'read', 'worksheet': 'read', 'worksheets': 'read',
+    'append_row': 'write', 'append_rows': 'write', 'batch_update': 'write', 'update': 'write',
+    'add_worksheet': 'write', 'resize': 'write', 'clear': 'write',
+}
+
+class _Metered:
+    # gspread の Spreadsheet / Worksheet を包み、API を呼ぶたびに上限の枠を1つ使う。
+    # それ以外の属性（title・id など）はそのまま返す
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        kind = _API_KINDS.get(name)
+        if kind is None:
+            return attr
+
+        def call(*args, **kwargs):
+            result = _api(kind, attr, *args, **kwargs)
+            if name in ('worksheet', 'add_worksheet'):
+                return _Metered(result)
+            if name == 'worksheets':
+                return [_Metered(ws) for ws in result]
+            return result
+        return call
+
+_inflight_lock = threading.Lock()
+_inflight = {}  # 読み込みのキー -> {'done': Event, 'result' / 'error'}
+_in_run = contextvars.ContextVar('db_in_run', default=False)
+
+def _status_of(e):
+    if isinstance(e, _gspread().exceptions.APIError) and e.response is not None:
+        return e.response.status_code
+    return None
+
+def _is_retryable(e, idempotent):
+    status = _status_of(e)
+    if status == 429:
+        # 429は受け付けられていないので、追加の書き込みでも再送してよい
+        return True
+    if not idempotent:
+        return False
+    import requests
+    return status in RETRY_STATUS or isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+def _call_with_retry(func, kind, idempotent, op):
+    if _in_run.get():
+        # _run の中から呼ばれた（例: 追加の途中で write_log を作る）。再試行は外側の _run がまとめて行う
+        return func()
+    token = _in_run.set(True)
+    try:
+        return _retry_loop(func, kind, idempotent, op)
+    finally:
+        _in_run.reset(token)
+
+def _retry_loop(func, kind, idempotent, op):
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            try:
+                with metrics.timer('db_call_ms', kind=kind, op=op):
+                    return func()
+            except Exception as e:
+                if not _is_auth_error(e):
+                    raise
+                reset_connection()
+                return func()
+        except Exception as e:
+            if not _is_retryable(e, idempotent) or attempt == MAX_RETRIES:
+                if _status_of(e) == 429:
+                    metrics.count('db_throttled', kind=kind, op=op)
+                    raise ThrottledError(f"Google Sheets API が混み合っています（{kind}）") from e
+                raise
+            metrics.count('db_retries', kind=kind, op=op, status=_status_of(e))
+            time.sleep(random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)))
+
+def _run(func, kind='read', key=None, idempotent=True, op='call'):
+    # func の中の API リクエストは1回ずつ上限の枠を使う（_Metered）。_run は再試行と相乗りを受け持つ
+    # kind: 'read' / 'write'（計測用）。key を渡した読み込みは、実行中の同じ読み込み（同じシャード）と相乗りする
+    # op: 計測用の操作名
+    # idempotent=False（行の追加など）は、二重書き込みを避けるため429以外では再送しない
+    if key is None:
+        return _call_with_retry(func, kind, idempotent, op)
+    key = (current_shard(),) + tuple(key)
+
+    with _inflight_lock:
+        waiter = _inflight.get(key)
+        owner = waiter is None
+        if owner:
+            waiter = _inflight[key] = {'done': threading.Event()}
+    if not owner:
+        metrics.count('db_shared_reads', op=op)
+        waiter['done'].wait()
+        if 'error' in waiter:
+            raise waiter['error']
+        return waiter['result']
+
+    try:
+        waiter['result'] = _call_with_retry(func, kind, idempotent, op)
+        return waiter['result']
+    except Exception as e:
+        waiter['error'] = e
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+        waiter['done'].set()
+
+# --- 列の型 ---
+# 読み込んだ時点で1回だけ型を揃える（各画面で毎回 to_datetime / to_numeric しない）。
+# 日付は datetime64、数値は float32、繰り返しの多い文字列は category、
+# 時刻は 0時からの経過時間（timedelta64）にする。
+# ※ exercise の time は「30分」のような運動時間なので文字列のまま
+COLUMN_TYPES = {
+    'users': {'name': 'category', 'height': 'float32'},
+    'daily': {'name': 'category', 'date': 'date', 'weight': 'float32', 'body_fat': 'float32', 'sleep': 'float32'},
+    'meal': {'name': 'category', 'date': 'date', 'type': 'category', 'time': 'time'},
+    'exercise': {'name': 'category', 'date': 'date'},
+    'bowel': {'name': 'category', 'date': 'date', 'time': 'time', 'amount': 'category', 'hardness': 'category'},
+}
+
+def _parse_times(series):
+    # "08:30:00" / "08:30" / "08:30:00.123456" -> timedelta
+    text = series.astype(str).str.strip()
+    text = text.where(~text.str.fullmatch(r"\d{1,2}:\d{2}"), text + ":00")
+    return pd.to_timedelta(text, errors='coerce')
+
+def apply_schema(sheet_name, df):
+    types = COLUMN_TYPES.get(sheet_name)
+    if not types or df.empty:
+        return df
+    df = df.copy(deep=False)
+    for col, kind in types.items():
+        if col not in df.columns:
+            continue
+        s = df[col]
+        if kind == 'date' and not pd.api.types.is_datetime64_any_dtype(s):
+            df[col] = pd.to_datetime(s, errors='coerce')
+        elif kind == 'time' and not pd.api.types.is_timedelta64_dtype(s):
+            df[col] = _parse_times(s)
+        elif kind == 'float32' and s.dtype != 'float32':
+            df[col] = pd.to_numeric(s, errors='coerce').astype('float32')
+        elif kind == 'category' and not isinstance(s.dtype, pd.CategoricalDtype):
+            df[col] = s.where(s.isna(), s.astype(str)).astype('category')
+    return df
+
+def _concat_typed(sheet_name, frames):
+    # category 同士を連結すると object に戻るので、連結後にもう一度型を揃える
+    return apply_schema(sheet_name, pd.concat(frames, ignore_index=True))
+
+def format_time(value):
+    # 時刻（timedelta）を "HH:MM" にする。空なら ""
+    if value is None or pd.isna(value):
+        return ""
+    minutes = int(pd.Timedelta(value).total_seconds() // 60)
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def format_date(value):
+    # 日付を "YYYY-MM-DD" にする。空・不正なら ""
+    if value is None or pd.isna(value):
+        return ""
+    return pd.Timestamp(value).strftime('%Y-%m-%d')
+
+def format_number(value, digits=1):
+    # float32 の数値を表示用にする（64.19999694824219 -> "64.2"）。空なら ""
+    if value is None or pd.isna(value):
+        return ""
+    return f"{float(value):.{digits}f}"
+
+def format_times(series):
+    return series.map(format_time)
+
+def _to_sheet_frame(df):
+    # 型付きの DataFrame を、スプレッドシートに書ける値（文字列・数値）に戻す
+    out = df.copy()
+    for col in out.columns:
+        s = out[col]
+        if pd.api.types.is_datetime64_any_dtype(s):
+            out[col] = s.dt.strftime('%Y-%m-%d')
+        elif pd.api.types.is_timedelta64_dtype(s):
+            out[col] = s.map(lambda v: "" if pd.isna(v) else str(pd.Timedelta(v)).split(" days ")[-1][:8])
+        elif isinstance(s.dtype, pd.CategoricalDtype):
+            out[col] = s.astype(object)
+        elif s.dtype == 'float32':
+            out[col] = s.astype('float64')
+    out = out.astype(object)
+    return out.where(out.notna(), "")
+
+# --- 読み込みキャッシュ ---
+# 両アプリとも操作のたびにスクリプト全体が再実行されるので、シートの中身を
+# プロセス全体で共有するキャッシュに一定時間(TTL)保持する。
+# 書き込み関数はキャッシュを直接書き換えるので、自分の保存結果はすぐに見える。
+CACHE_TTL_SECONDS = _config("cache_ttl_seconds", 60)
+CACHE_MAX_SHEETS = _config("cache_max_sheets", 16)
+
+_cache_lock = threading.Lock()
+_sheet_cache = OrderedDict()  # (シャード, sheet_name) -> (読み込んだ時刻, DataFrame)
+_versions = {}  # (シャード, sheet_name) -> 版番号（キャッシュの中身が変わるたびに増える）
+_version_seq = itertools.count(1)
+
+def _bump(key):
+    _versions[key] = next(_version_seq)
+
+def data_version(sheet_names):
+    # 集計結果などを「データの版」ごとにキャッシュするための値。
+    # どれか1つでも中身が変われば別の値になる（SQLiteではキャッシュしないので None）
+    if _local_backend() is not None:
+        return None
+    shard = current_shard()
+    with _cache_lock:
+        return (shard,) + tuple(_versions.get((shard, name), 0) for name in sheet_names)
+
+def _cache_get(sheet_name, allow_stale=False):
+    # allow_stale=True なら期限切れでも返す（混雑で読み込めないときの代わり）
+    key = _sk(sheet_name)
+    with _cache_lock:
+        entry = _sheet_cache.get(key)
+        if entry is not None and (allow_stale or time.monotonic() - entry[0] <= CACHE_TTL_SECONDS):
+            _sheet_cache.move_to_end(key)
+            df = entry[1]
+        else:
+            df = None
+    if not allow_stale:
+        metrics.count('cache_requests', sheet=sheet_name, result='hit' if df is not None else 'miss')
+    return df
+
+def _cache_put(sheet_name, df):
+    key = _sk(sheet_name)
+    with _cache_lock:
+        _sheet_cache[key] = (time.monotonic(), df)
+        _sheet_cache.move_to_end(key)
+        _bump(key)
+        # 上限はシャードごと。同じシャードの古いものから捨てる（別のチームの分は追い出さない）
+        same = [k for k in _sheet_cache if k[0] == key[0]]
+        for old in same[:max(len(same) - CACHE_MAX_SHEETS, 0)]:
+            del _sheet_cache[old]
+
+def _cache_append(sheet_name, rows):
+    # 追加した行をキャッシュにも足す。列が合わない場合は捨てて次回読み直す
+    key = _sk(sheet_name)
+    with _cache_lock:
+        entry = _sheet_cache.get(key)
+        if entry is None:
+            return
+        loaded_at, df = entry
+        if df.empty or any(list(r.keys()) != list(df.columns) for r in rows):
+            del _sheet_cache[key]
+            _bump(key)
+            return
+        _sheet_cache[key] = (loaded_at, _concat_typed(sheet_name, [df, pd.DataFrame(rows)]))
+        _bump(key)
+
+def _cache_upsert(sheet_name, key_columns, rows):
+    # シートの upsert と同じ並びにする: 同じキーの行はその位置で差し替え、新しいキーの行は末尾に足す
+    # （行の位置で前回と比べる rollups / alerts が、差し替えた1行だけを変わった行として見られるように）
+    key = _sk(sheet_name)
+    with _cache_lock:
+        entry = _sheet_cache.get(key)
+        if entry is None:
+            return
+        loaded_at, df = entry
+        if df.empty or any(list(r.keys()) != list(df.columns) for r in rows):
+            del _sheet_cache[key]
+            _bump(key)
+            return
+        latest = {tuple(str(r[c]) for c in key_columns): r for r in rows}  # 同じキーは後の行が正
+        new_keys = list(latest)
+        position = {k: j for j, k in enumerate(new_keys)}
+        old_keys = df[list(key_columns)].astype(str).apply(tuple, axis=1)
+        last = (~old_keys.duplicated(keep='last')).to_numpy()
+        n = len(df)
+        order, replaced = [], set()
+        for i, (k, is_last) in enumerate(zip(old_keys, last)):
+            j = position.get(k)
+            if j is None:
+                order.append(i)
+            elif is_last:
+                # 同じキーが何行もあれば、最後の行を差し替えてそれより前は落とす
+                order.append(n + j)
+                replaced.add(j)
+        order += [n + j for j in range(len(new_keys)) if j not in replaced]
+        combined = _concat_typed(sheet_name, [df, pd.DataFrame(list(latest.values()))])
+        _sheet_cache[key] = (loaded_at, combined.iloc[order].reset_index(drop=True))
+        _bump(key)
+
+def invalidate_cache(sheet_name=None):
+    # sheet_name を省略すると全シャード・全シート分を捨てる
+    with _cache_lock:
+        if sheet_name is None:
+            for key in _sheet_cache:
+                _bump(key)
+            _sheet_cache.clear()
+        else:
+            key = _sk(sheet_name)
+            _sheet_cache.pop(key, None)
+            _bump(key)
+
+# --- 追記専用シートの差分同期 ---
+# meal / exercise / bowel は選手アプリから末尾に追加されるだけなので、
+# 前回読んだ行数（ウォーターマーク）より後ろの行だけを範囲指定で読み足す。
+# 最後に読んだ行の中身が変わっていたら（管理画面での削除・書き直しなど）全件読み直す。
+INCREMENTAL_SHEETS = _config("incremental_sheets", ['meal', 'exercise', 'bowel'])
+
+_sync_state = {}  # (シャード, sheet_name) -> {'header', 'n_rows', 'last_row', 'df'}
+
+def _col_letter(col):
+    return _gspread().utils.rowcol_to_a1(1, col)[:-1]
+
+def _trim(values_row):
+    # APIは末尾の空セルを省略して返すので、比較の前に揃える
+    values_row = list(values_row)
+    while values_row and values_row[-1] == "":
+        values_row.pop()
+    return values_row
+
+def _values_to_df(header, rows):
+    # get_all_records と同じく、数値に見える文字列は数値に変換する
+    records = []
+    for values_row in rows:
+        values_row = list(values_row)[:len(header)]
+        values_row += [""] * (len(header) - len(values_row))
+        records.append(dict(zip(header, _gspread().utils.numericise_all(values_row))))
+    return pd.DataFrame(records)
+
+def _store_full(sheet_name, values):
+    header, rows = (values[0], values[1:]) if values else ([], [])
+    df = apply_schema(sheet_name, _values_to_df(header, rows))
+    _sync_state[_sk(sheet_name)] = {
+        'header': header, 'n_rows': len(rows),
+        'last_row': _trim(rows[-1] if rows else header), 'df': df,
+    }
+    return df
+
+def _full_sync(sheet_name):
+    return _store_full(sheet_name, get_worksheet(sheet_name).get_all_values())
+
+def _delta_ranges(state):
+    # 最後に読んだ行（ヘッダーが1行目）と、その次の行以降
+    last_col = _col_letter(len(state['header']))
+    mark = state['n_rows'] + 1
+    return [f"A{mark}:{last_col}{mark}", f"A{mark + 1}:{last_col}"]
+
+def _apply_delta(sheet_name, state, check, new_rows):
+    # 最後に読んだ行が変わっていたら None（全件読み直しが必要）
+    if _trim(check[0] if check else []) != state['last_row']:
+        return None
+    if not new_rows:
+        return state['df']
+    df = _concat_typed(sheet_name, [state['df'], _values_to_df(state['header'], new_rows)])
+    state.update({'n_rows': state['n_rows'] + len(new_rows), 'last_row': _trim(new_rows[-1]), 'df': df})
+    return df
+
+def _sync_incremental(sheet_name):
+    state = _sync_state.get(_sk(sheet_name))
+    if state is None or not state['header']:
+        return _full_sync(sheet_name)
+    check, new_rows = get_worksheet(sheet_name).batch_get(_delta_ranges(state))
+    df = _apply_delta(sheet_name, state, check, new_rows)
+    if df is None:
+        return _full_sync(sheet_name)
+    return df
+
+def _forget_sync(sheet_name):
+    # 行の位置が変わる書き込みをしたら、差分同期の状態は捨てて次回全件読み直す
+    _sync_state.pop(_sk(sheet_name), None)
 
 # --- データ読み込み ---
 def load_data_from_sheet(sheet_name):
+    local = _local_backend()
+    if local is not None:
+        return apply_schema(sheet_name, local.load_data_from_sheet(sheet_name))
+    cached = _cache_get(sheet_name)
+    if cached is not None:
+        # 呼び出し側で列を足されてもキャッシュが汚れないよう浅いコピーを返す
+        return cached.copy(deep=False)
     try:
-        client = get_connection()
-        sheet = client.open_by_url(SHEET_URL).worksheet(sheet_name)
-        data = sheet.get_all_records()
-        df = pd.DataFrame(data)
-        return df
-    except gspread.exceptions.WorksheetNotFound:
+        if sheet_name in INCREMENTAL_SHEETS:
+            with _sheet_lock(sheet_name):
+                df = _run(lambda: _sync_incremental(sheet_name), op='sync')
+        else:
+            data = _run(lambda: get_worksheet(sheet_name).get_all_records(), key=('load', sheet_name), op='load')
+            df = apply_schema(sheet_name, pd.DataFrame(data))
+        metrics.count('rows_read', len(df), sheet=sheet_name)
+        _cache_put(sheet_name, df)
+        return df.copy(deep=False)
+    except _gspread().exceptions.WorksheetNotFound:
         return pd.DataFrame()
+    except ThrottledError as e:
+        return _stale_or_raise(sheet_name, e)
     except Exception as e:
-        # シートが空の場合などのエラー対策
+        # 空の DataFrame は返さない（登録済みの選手を「未登録」と見てしまう）
+        return _stale_or_raise(sheet_name, SheetUnavailableError(f"{sheet_name} を読み込めませんでした: {e!r}"), e)
+
+def _stale_or_raise(sheet_name, error, cause=None):
+    # 読めないときは、期限切れでも手元のデータがあればそれを返す。なければ error（SheetUnavailableError）
+    stale = _cache_get(sheet_name, allow_stale=True)
+    if stale is None:
+        if cause is not None:
+            raise error from cause
+        raise error
+    return stale.copy(deep=False)
+
+# --- 複数シートの一括読み込み（管理画面用） ---
+LOAD_WORKERS = _config("load_workers", 5)
+
+def _batch_load(sheet_names):
+    # キャッシュにないシートを values_batch_get 1回でまとめて取得する。
+    # 差分同期の対象シートは、新しく増えた行の範囲だけを同じリクエストに入れる
+    plans = []
+    ranges = []
+    for sheet_name in sheet_names:
+        state = _sync_state.get(_sk(sheet_name)) if sheet_name in INCREMENTAL_SHEETS else None
+        if state is not None and state['header']:
+            plans.append((sheet_name, state, len(ranges)))
+            ranges += [_gspread().utils.absolute_range_name(sheet_name, r) for r in _delta_ranges(state)]
+        else:
+            plans.append((sheet_name, None, len(ranges)))
+            ranges.append(_gspread().utils.absolute_range_name(sheet_name))
+
+    res = get_spreadsheet().values_batch_get(ranges)
+    value_ranges = [vr.get('values', []) for vr in res.get('valueRanges', [])]
+
+    result = {}
+    for sheet_name, state, pos in plans:
+        if state is not None:
+            df = _apply_delta(sheet_name, state, value_ranges[pos], value_ranges[pos + 1])
+            if df is None:
+                df = _full_sync(sheet_name)
+        elif sheet_name in INCREMENTAL_SHEETS:
+            df = _store_full(sheet_name, value_ranges[pos])
+        else:
+            values = value_ranges[pos]
+            df = apply_schema(sheet_name, _values_to_df(values[0], values[1:])) if values else pd.DataFrame()
+        result[sheet_name] = df
+    return result
+
+def load_many(sheet_names):
+    # {シート名: DataFrame} を返す。通信はできるだけ1往復にまとめる
+    local = _local_backend()
+    if local is not None:
+        return {name: apply_schema(name, local.load_data_from_sheet(name)) for name in sheet_names}
+
+    result = {}
+    missing = []
+    for sheet_name in sheet_names:
+        cached = _cache_get(sheet_name)
+        if cached is not None:
+            result[sheet_name] = cached.copy(deep=False)
+        else:
+            missing.append(sheet_name)
+    if not missing:
+        return result
+
+    try:
+        # 差分同期の状態を触るので、対象シートのロックを（順番を揃えて）取ってから読む
+        with ExitStack() as stack:
+            for sheet_name in sorted(missing):
+                stack.enter_context(_sheet_lock(sheet_name))
+            loaded = _run(lambda: _batch_load(missing), op='load_many')
+        for sheet_name, df in loaded.items():
+            metrics.count('rows_read', len(df), sheet=sheet_name)
+            _cache_put(sheet_name, df)
+            result[sheet_name] = df.copy(deep=False)
+    except ThrottledError as e:
+        for sheet_name in missing:
+            result[sheet_name] = _stale_or_raise(sheet_name, e)
+    except Exception:
+        # 存在しないシートが混ざっている場合などは、シートごとに並列で読む
+        shard = current_shard()
+        def _load_one(sheet_name):
+            with use_shard(shard):
+                return load_data_from_sheet(sheet_name)
+        with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as pool:
+            for sheet_name, df in zip(missing, pool.map(_load_one, missing)):
+                result[sheet_name] = df
+    return result
+
+# --- 選手別・日付別の索引 ---
+# 毎回 df[df['name'] == 選手] のように全行を調べる代わりに、読み込んだシートの版ごとに
+# 1回だけ「選手・日付順に並べた表」と「日付順に並べた表」を作り、
+# 選手ごと・日付ごとの行の範囲（開始・終了位置）を覚えておく。
+# 検索はその範囲を切り出すだけなので、件数に比例した時間で済み、コピーもしない。
+_indexes = {}  # (シャード, sheet_name) -> (索引を作ったときの DataFrame, 索引)
+_index_lock = threading.Lock()
+
+def _runs(values):
+    # 並べ替え済みの値から {値: (開始, 終了)} を作る
+    if len(values) == 0:
+        return {}
+    change = np.flatnonzero(values[1:] != values[:-1]) + 1
+    starts = np.r_[0, change]
+    ends = np.r_[change, len(values)]
+    return {values[s]: (s, e) for s, e in zip(starts, ends) if not pd.isna(values[s])}
+
+def _build_index(df):
+    has_date = 'date' in df.columns
+    by_player = df.sort_values(['name', 'date'] if has_date else ['name'], kind='stable')
+    index = {
+        'by_player': by_player,
+        'players': _runs(by_player['name'].astype(object).to_numpy()),
+        'by_date': None,
+        'dates': {},
+    }
+    if has_date:
+        by_date = df.sort_values('date', kind='stable')
+        index['by_date'] = by_date
+        index['dates'] = _runs(by_date['date'].to_numpy())
+    return index
+
+def _get_index(sheet_name):
+    load_data_from_sheet(sheet_name)
+    df = _cache_get(sheet_name, allow_stale=True)
+    if df is None or df.empty or 'name' not in df.columns:
+        return None
+    key = _sk(sheet_name)
+    with _index_lock:
+        entry = _indexes.get(key)
+        if entry is None or entry[0] is not df:
+            with metrics.timer('index_build_ms', sheet=sheet_name):
+                entry = _indexes[key] = (df, _build_index(df))
+        return entry[1]
+
+def rows_for_player(sheet_name, name):
+    # その選手の行（日付の古い順）
+    local = _local_backend()
+    if local is not None:
+        return query_rows(sheet_name, name=name)
+    index = _get_index(sheet_name)
+    if index is None:
         return pd.DataFrame()
+    start, end = index['players'].get(name, (0, 0))
+    return index['by_player'].iloc[start:end]
+
+def rows_for_date(sheet_name, date):
+    # その日付の行（全選手）。date は "YYYY-MM-DD" / date / Timestamp
+    local = _local_backend()
+    if local is not None:
+        return query_rows(sheet_name, date=format_date(date))
+    index = _get_index(sheet_name)
+    if index is None or index['by_date'] is None:
+        return pd.DataFrame()
+    start, end = index['dates'].get(pd.Timestamp(date).to_datetime64(), (0, 0))
+    return index['by_date'].iloc[start:end]
+
+def last_n(sheet_name, name, n):
+    # その選手の新しい方から n 件（並びは古い順のまま）
+    rows = rows_for_player(sheet_name, name)
+    return rows.iloc[max(len(rows) - n, 0):]
+
+def player_count(sheet_name, name):
+    # その選手の行数（ページ数を出す用）
+    local = _local_backend()
+    if local is not None:
+        return local.player_count(sheet_name, name)
+    index = _get_index(sheet_name)
+    if index is None:
+        return 0
+    start, end = index['players'].get(name, (0, 0))
+    return end - start
+
+def player_page(sheet_name, name, page, page_size):
+    # その選手の行を新しい順に並べたときの page ページ目（0始まり）。戻り値: (行, 全件数)
+    # 索引の選手の範囲から後ろ側を切り出すだけなので、全体を並べ替え直さない
+    local = _local_backend()
+    if local is not None:
+        rows, total = local.player_page(sheet_name, name, page * page_size, page_size)
+        return apply_schema(sheet_name, rows), total
+    index = _get_index(sheet_name)
+    if index is None:
+        return pd.DataFrame(), 0
+    start, end = index['players'].get(name, (0, 0))
+    hi = max(end - page * page_size, start)
+    lo = max(hi - page_size, start)
+    return index['by_player'].iloc[lo:hi].iloc[::-1], end - start
+
+def latest_for_player(sheet_name, name):
+    # その選手の一番新しい行。なければ None
+    rows = rows_for_player(sheet_name, name)
+    if rows.empty:
+        return None
+    return rows.iloc[-1]
+
+def query_rows(sheet_name, name=None, date=None):
+    # 選手名・日付で絞り込んだ行を返す（SQLiteではテーブルのインデックス、
+    # スプレッドシートでは上の索引で検索する）
+    local = _local_backend()
+    if local is not None:
+        return apply_schema(sheet_name, local.query_rows(sheet_name, name=name, date=date))
+    if name is not None:
+        rows = rows_for_player(sheet_name, name)
+        if date is not None and not rows.empty:
+            # 選手の行は日付順なので、二分探索で範囲を切り出す
+            dates = rows['date'].to_numpy()
+            target = pd.Timestamp(date).to_datetime64()
+            rows = rows.iloc[np.searchsorted(dates, target, 'left'):np.searchsorted(dates, target, 'right')]
+        return rows
+    if date is not None:
+        return rows_for_date(sheet_name, date)
+    return load_data_from_sheet(sheet_name)
 
 # --- データ追加（1行追加） ---
 def append_data_to_sheet(sheet_name, data_dict):
-    client = get_connection()
-    sheet = client.open_by_url(SHEET_URL).worksheet(sheet_name)
-    
+    local = _local_backend()
+    if local is not None:
+        return local.append_data_to_sheet(sheet_name, data_dict)
+
     # データフレームの列順序を守るため、既存ヘッダーを確認してもよいが
     # 簡易的に値のリストを作って追加する
     # ※初回はヘッダーがないとズレるので、スプレッドシートの1行目に
@@ -50,14 +1003,549 @@ def append_data_to_sheet(sheet_name, data_dict):
     
     # 辞書の値をリストに変換
     row = list(data_dict.values())
-    sheet.append_row(row)
+    with _write_gate().writing():
+        _run(lambda: get_worksheet(sheet_name).append_row(row), kind='write', idempotent=False, op='append_row')
+    metrics.count('rows_written', 1, sheet=sheet_name)
+    _row_index.pop(_sk(sheet_name), None)
+    _cache_append(sheet_name, [data_dict])
+
+# --- データ追加（複数シート・複数行をまとめて追加） ---
+def _to_cell(value):
+    # appendCells 用のセル表現に変換（append_row と同じく数値は数値、それ以外は文字列）
+    if isinstance(value, bool):
+        return {"userEnteredValue": {"boolValue": value}}
+    if value is None or (isinstance(value, numbers.Number) and pd.isna(value)):
+        return {"userEnteredValue": {"stringValue": ""}}
+    if isinstance(value, numbers.Number):
+        return {"userEnteredValue": {"numberValue": float(value)}}
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+# --- 追加の記録（再送で行が二重にならないように） ---
+# 行の追加は、返事が届かなかった（タイムアウト・5xx）ときに本当は書き込まれていることがある。
+# そこで追加と同じ batch_update で、保存のキーを write_log シートにも1行ずつ足しておく。
+# batch_update は全部通るか全部通らないかなので、キーがあればその保存の行は届いている
+WRITE_LOG_SHEET = _config("write_log_sheet", "write_log")
+WRITE_LOG_HEADER = ['key', 'saved_at']
+
+def _log_worksheet():
+    try:
+        return get_worksheet(WRITE_LOG_SHEET)
+    except _gspread().exceptions.WorksheetNotFound:
+        pass
+    spreadsheet = get_spreadsheet()
+    try:
+        sheet = _run(lambda: spreadsheet.add_worksheet(WRITE_LOG_SHEET, rows=1, cols=len(WRITE_LOG_HEADER)),
+                     kind='write', idempotent=False, op='add_worksheet')
+        _run(lambda: sheet.update([WRITE_LOG_HEADER], "A1"), kind='write', op='update')
+    except _gspread().exceptions.APIError:
+        # 別のプロセスが先に作った
+        pass
+    return get_worksheet(WRITE_LOG_SHEET)
+
+def _log_rows(log_keys):
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    return [{'key': key, 'saved_at': now} for key in log_keys]
+
+def applied_keys(keys):
+    # keys のうち、write_log にある（行の追加まで届いている）もの。送れたか分からない保存の確認用
+    keys = set(keys)
+    if not keys:
+        return set()
+    local = _local_backend()
+    if local is not None:
+        logged = local.load_data_from_sheet(WRITE_LOG_SHEET)
+        return keys & set(logged['key']) if not logged.empty else set()
+    try:
+        sheet = get_worksheet(WRITE_LOG_SHEET)
+    except _gspread().exceptions.WorksheetNotFound:
+        return set()
+    values = _run(lambda: sheet.get_all_values(), kind='read', op='get_all_values')
+    return keys & {row[0] for row in values if row}
+
+def append_rows_to_sheets(rows_by_sheet, log_keys=()):
+    # rows_by_sheet: {'meal': [dict, dict, ...], 'exercise': [...], ...}
+    # 全シート分を appendCells にまとめて、スプレッドシートへ1回のリクエストで送る。
+    # log_keys を渡すと、同じリクエストで write_log にも記録する（applied_keys で確かめられる）
+    rows_by_sheet = {name: rows for name, rows in rows_by_sheet.items() if rows}
+    local = _local_backend()
+    if local is not None:
+        if rows_by_sheet and log_keys:
+            return local.append_rows_to_sheets({**rows_by_sheet, WRITE_LOG_SHEET: _log_rows(log_keys)})
+        return local.append_rows_to_sheets(rows_by_sheet)
+    if not rows_by_sheet:
+        return
+
+    def _append():
+        requests = []
+        for sheet_name, rows in rows_by_sheet.items():
+            requests.append({
+                "appendCells": {
+                    "sheetId": get_worksheet(sheet_name).id,
+                    "rows": [{"values": [_to_cell(v) for v in r.values()]} for r in rows],
+                    "fields": "userEnteredValue",
+                }
+            })
+        if log_keys:
+            requests.append({
+                "appendCells": {
+                    "sheetId": _log_worksheet().id,
+                    "rows": [{"values": [_to_cell(v) for v in r.values()]} for r in _log_rows(log_keys)],
+                    "fields": "userEnteredValue",
+                }
+            })
+        get_spreadsheet().batch_update({"requests": requests})
+    with _write_gate().writing():
+        _run(_append, kind='write', idempotent=False, op='append_rows')
+
+    for sheet_name, rows in rows_by_sheet.items():
+        metrics.count('rows_written', len(rows), sheet=sheet_name)
+        _row_index.pop(_sk(sheet_name), None)
+        _cache_append(sheet_name, rows)
+
+# --- キー指定の上書き（upsert） ---
+# シート全体を消して書き直すのではなく、キー（例: name, date）が一致する行だけを
+# その場で書き換え、新しいキーは末尾に追加する。
+# キー → 行番号 の対応表はシートごとに保持し、書き込みのたびに更新する。
+_row_index = {}  # (シャード, sheet_name) -> {'key_columns', 'header', 'rows': {key: 行番号}}
+_sheet_locks = {}  # (シャード, sheet_name) -> Lock
+
+def _sheet_lock(sheet_name):
+    key = _sk(sheet_name)
+    with _pool_lock:
+        if key not in _sheet_locks:
+            _sheet_locks[key] = threading.Lock()
+        return _sheet_locks[key]
+
+@contextmanager
+def _shard_file_lock(key, exclusive=False):
+    # 同じマシンのほかのプロセス（選手用・管理用の画面、コマンドラインなど）との間の読み書きロック。
+    # 書き込みは共有、move_shard の切り替えは排他で取る。fcntl のない環境ではプロセスの中だけで止める
+    # ※ flock が効くのは同じマシンの中だけ。別のマシンで動かしている画面の書き込みは止められないので、
+    #    複数のマシンから書き込むときは、move_shard の間はほかのマシンの画面を止めておくこと
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    os.makedirs(SHARD_LOCK_DIR, exist_ok=True)
+    path = os.path.join(SHARD_LOCK_DIR, f"{key.replace('/', '_')}.lock")
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+class _WriteGate:
+    # シャードへの書き込みは何本でも同時に通し、move_shard の切り替えの間だけ止める。
+    # ほかのプロセスの書き込みも _shard_file_lock で止める
+    def __init__(self, key):
+        self.key = key
+        self.cond = threading.Condition()
+        self.active = 0
+        self.closed = False
+
+    @contextmanager
+    def writing(self):
+        with self.cond:
+            while self.closed:
+                self.cond.wait()
+            self.active += 1
+        try:
+            with _shard_file_lock(self.key):
+                # 切り替えを待っていた場合は、ここで新しい振り分け先を読み直してから書く
+                _refresh_routes()
+                yield
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.cond.notify_all()
+
+    @contextmanager
+    def closing(self):
+        # 新しい書き込みを止め、書き込み中のもの（ほかのプロセスの分も）が終わるのを待つ
+        with self.cond:
+            while self.closed:
+                self.cond.wait()
+            self.closed = True
+            while self.active:
+                self.cond.wait()
+        try:
+            with _shard_file_lock(self.key, exclusive=True):
+                yield
+        finally:
+            with self.cond:
+                self.closed = False
+                self.cond.notify_all()
+
+_gates = {}  # シャード -> _WriteGate
+
+def _write_gate(key=None):
+    key = current_shard() if key is None else key
+    with _pool_lock:
+        if key not in _gates:
+            _gates[key] = _WriteGate(key)
+        return _gates[key]
+
+def _row_key(values, positions):
+    return tuple(str(values[p]) if p < len(values) else "" for p in positions)
+
+def _build_row_index(sheet_name, key_columns):
+    values = get_worksheet(sheet_name).get_all_values()
+    header = values[0] if values else []
+    index = {'key_columns': key_columns, 'header': header, 'rows': {}}
+    if header:
+        positions = [header.index(c) for c in key_columns]
+        for row_number, values_row in enumerate(values[1:], start=2):
+            # 重複キーがある場合は、読み込み側と同じく後ろの行を正とする
+            index['rows'][_row_key(values_row, positions)] = row_number
+    _row_index[_sk(sheet_name)] = index
+    return index
+
+def _find_conflicts(sheet, index, targets):
+    # 対応表の行番号に、まだ同じキーの行があるかを1回の読み込みでまとめて確認する
+    # （他の人が行を削除・並べ替えた場合は位置がずれている）
+    if not targets:
+        return False
+    header = index['header']
+    positions = [header.index(c) for c in index['key_columns']]
+    last_col = _col_letter(len(header))
+    ranges = [f"A{row_number}:{last_col}{row_number}" for _, row_number in targets]
+    current = sheet.batch_get(ranges)
+    for (key, _), value_range in zip(targets, current):
+        values_row = value_range[0] if value_range else []
+        if _row_key(values_row, positions) != key:
+            return True
+    return False
+
+def _upsert(sheet_name, key_columns, rows, fresh=False):
+    # fresh=True: 対応表を使わずシートから作り直す（再送時。前の送信で追加済みの行を上書きにするため）
+    sheet = get_worksheet(sheet_name)
+    index = None if fresh else _row_index.get(_sk(sheet_name))
+    if index is None or index['key_columns'] != key_columns:
+        index = _build_row_index(sheet_name, key_columns)
+
+    if not index['header']:
+        # 空のシートならヘッダーから作る
+        index['header'] = list(rows[0].keys())
+        sheet.append_row(index['header'])
+
+    keyed = [(tuple(str(r[c]) for c in key_columns), r) for r in rows]
+    targets = [(key, index['rows'][key]) for key, _ in keyed if key in index['rows']]
+    if _find_conflicts(sheet, index, targets):
+        # 位置がずれていたら対応表を作り直してから書き込む（他人の行を上書きしない）
+        index = _build_row_index(sheet_name, key_columns)
+
+    header = index['header']
+    updates, appends, appended_keys = [], [], []
+    for key, r in keyed:
+        values_row = [r.get(h, "") for h in header]
+        if key in index['rows']:
+            row_number = index['rows'][key]
+            last_cell = _gspread().utils.rowcol_to_a1(row_number, len(header))
+            updates.append({'range': f"A{row_number}:{last_cell}", 'values': [values_row]})
+        else:
+            appends.append(values_row)
+            appended_keys.append(key)
+
+    if updates:
+        sheet.batch_update(updates)
+    if appends:
+        res = sheet.append_rows(appends)
+        # 追加された位置（例: daily!A120:E121）から新しい行番号を対応表に登録
+        start = _gspread().utils.a1_range_to_grid_range(res['updates']['updatedRange'].split("!")[-1])['startRowIndex'] + 1
+        for offset, key in enumerate(appended_keys):
+            index['rows'][key] = start + offset
+
+def upsert_rows(sheet_name, key_columns, rows):
+    # rows: [dict, ...]  key_columns が一致する既存行は上書き、なければ追加
+    if not rows:
+        return
+    local = _local_backend()
+    if local is not None:
+        return local.upsert_rows(sheet_name, list(key_columns), rows)
+    key_columns = tuple(key_columns)
+    with _write_gate().writing(), _sheet_lock(sheet_name):
+        attempts = []
+        def send():
+            # 5xx やタイムアウトでも、実際には追加まで届いていることがある。
+            # 再送では対応表をシートから作り直し、届いていた行は追加せず上書きにする
+            attempts.append(1)
+            _upsert(sheet_name, key_columns, rows, fresh=len(attempts) > 1)
+        try:
+            _run(send, kind='write', op='upsert')
+            metrics.count('rows_written', len(rows), sheet=sheet_name)
+        except Exception:
+            # 途中で失敗した場合は対応表が信用できないので捨てる
+            _row_index.pop(_sk(sheet_name), None)
+            raise
+        finally:
+            # 既存行をその場で書き換えるので、差分同期では拾えない
+            _forget_sync(sheet_name)
+    _cache_upsert(sheet_name, key_columns, rows)
+
+# --- 条件に一致する行の削除（選手削除用） ---
+# シートを丸ごと書き直すのではなく、一致する行だけを deleteDimension で消す。
+# 連続した行は1つの範囲にまとめ、全シート分を1回の batch_update で送る。
+def _as_list(sheet_names):
+    return [sheet_names] if isinstance(sheet_names, str) else list(sheet_names)
+
+def count_rows_where(sheet_names, column, value):
+    # 削除前の件数確認用。読み込み済み（キャッシュ）のデータから数えるので再ダウンロードしない
+    counts = {}
+    for sheet_name, df in load_many(_as_list(sheet_names)).items():
+        if df.empty or column not in df.columns:
+            counts[sheet_name] = 0
+        else:
+            counts[sheet_name] = int((df[column].astype(str) == str(value)).sum())
+    return counts
+
+def _headers(sheet_names):
+    # 列の位置を知るためのヘッダー。読み込み済みならそれを使い、なければ1行目だけ読む
+    headers = {}
+    for sheet_name in sheet_names:
+        cached = _cache_get(sheet_name)
+        if cached is not None and not cached.empty:
+            headers[sheet_name] = list(cached.columns)
+    missing = [name for name in sheet_names if name not in headers]
+    if missing:
+        res = get_spreadsheet().values_batch_get(
+            [_gspread().utils.absolute_range_name(name, "1:1") for name in missing])
+        for sheet_name, vr in zip(missing, res.get('valueRanges', [])):
+            values = vr.get('values', [])
+            headers[sheet_name] = values[0] if values else []
+    return headers
+
+def _merge_runs(row_numbers):
+    # [3, 4, 5, 9] -> [(3, 5), (9, 9)]
+    runs = []
+    for n in sorted(row_numbers):
+        if runs and runs[-1][1] == n - 1:
+            runs[-1][1] = n
+        else:
+            runs.append([n, n])
+    return [tuple(r) for r in runs]
+
+def _delete_where(sheet_names, column, value):
+    headers = _headers(sheet_names)
+    targets = [name for name in sheet_names if column in headers[name]]
+    if not targets:
+        return {name: 0 for name in sheet_names}
+
+    # 対象の列だけをまとめて読み、一致する行番号を探す
+    ranges = []
+    for sheet_name in targets:
+        col = _col_letter(headers[sheet_name].index(column) + 1)
+        ranges.append(_gspread().utils.absolute_range_name(sheet_name, f"{col}:{col}"))
+    res = get_spreadsheet().values_batch_get(ranges)
+
+    counts = {name: 0 for name in sheet_names}
+    requests = []
+    for sheet_name, vr in zip(targets, res.get('valueRanges', [])):
+        values = vr.get('values', [])
+        matched = [i + 1 for i, cell in enumerate(values)
+                   if i > 0 and cell and str(cell[0]) == str(value)]
+        counts[sheet_name] = len(matched)
+        sheet_id = get_worksheet(sheet_name).id
+        # 下の行から消せば、上の行番号はずれない
+        for start, end in reversed(_merge_runs(matched)):
+            requests.append({
+                "deleteDimension": {
+                    "range": {"sheetId": sheet_id, "dimension": "ROWS",
+                              "startIndex": start - 1, "endIndex": end}
+                }
+            })
+    if requests:
+        get_spreadsheet().batch_update({"requests": requests})
+    return counts
+
+def delete_rows_where(sheet_names, column, value):
+    # sheet_names はシート名1つ、またはリスト。{シート名: 削除件数} を返す
+    sheet_names = _as_list(sheet_names)
+    local = _local_backend()
+    if local is not None:
+        return local.delete_rows_where(sheet_names, column, value)
+
+    with ExitStack() as stack:
+        stack.enter_context(_write_gate().writing())
+        for sheet_name in sorted(sheet_names):
+            stack.enter_context(_sheet_lock(sheet_name))
+        try:
+            return _run(lambda: _delete_where(sheet_names, column, value), kind='write', op='delete')
+        finally:
+            # 行の位置が変わるので、キャッシュ・対応表・差分同期の状態はすべて捨てる
+            for sheet_name in sheet_names:
+                invalidate_cache(sheet_name)
+                _row_index.pop(_sk(sheet_name), None)
+                _forget_sync(sheet_name)
+
+# --- 古い行の移動（アーカイブ用） ---
+def _move_before(sheet_name, cutoff, sink):
+    values = get_worksheet(sheet_name).get_all_values()
+    if len(values) < 2:
+        return 0
+    df = apply_schema(sheet_name, _values_to_df(values[0], values[1:]))
+    if 'date' not in df.columns:
+        return 0
+    mask = (df['date'] < cutoff).to_numpy()  # 日付が読めない行は残す
+    matched = [int(i) + 2 for i in np.flatnonzero(mask)]
+    if not matched:
+        return 0
+    # 先に移し先へ書き、成功してからシートの行を消す。行の番号も _row 列で渡す
+    df['_row'] = np.arange(2, len(df) + 2)
+    sink(df[mask].reset_index(drop=True))
+    sheet_id = get_worksheet(sheet_name).id
+    requests = [{
+        "deleteDimension": {
+            "range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": start - 1, "endIndex": end}
+        }
+    } for start, end in reversed(_merge_runs(matched))]
+    get_spreadsheet().batch_update({"requests": requests})
+    return len(matched)
+
+def move_rows_before(sheet_name, cutoff, sink):
+    # date が cutoff より前の行を sink(DataFrame) に渡し、成功したらシートから削除する。
+    # sink が失敗したときは何も削除しない。sink は同じ行を2回受け取っても大丈夫なようにしておく
+    # （429 で再試行した場合や、削除の前に止まった場合）。そのために DataFrame には
+    # 行の番号（スプレッドシートの行番号 / SQLite の rowid）を _row 列で付けて渡す。戻り値: 移した行数
+    cutoff = pd.Timestamp(cutoff).normalize()
+    local = _local_backend()
+    if local is not None:
+        return local.move_rows_before(sheet_name, format_date(cutoff), lambda df: sink(apply_schema(sheet_name, df)))
+    with _write_gate().writing(), _sheet_lock(sheet_name):
+        try:
+            return _run(lambda: _move_before(sheet_name, cutoff, sink), kind='write', op='archive')
+        finally:
+            # 行の位置が変わるので、キャッシュ・対応表・差分同期の状態は捨てる
+            invalidate_cache(sheet_name)
+            _row_index.pop(_sk(sheet_name), None)
+            _forget_sync(sheet_name)
 
 # --- データ全洗い替え（削除機能用） ---
 def overwrite_sheet_data(sheet_name, df):
-    client = get_connection()
-    sheet = client.open_by_url(SHEET_URL).worksheet(sheet_name)
-    sheet.clear() # 全消去
-    
-    # ヘッダーとデータを書き込み
-    # gspreadのupdate機能を使う
-    sheet.update([df.columns.values.tolist()] + df.values.tolist())
\ No newline at end of file
+    # 型付きで読み込んだ DataFrame もそのまま渡せるよう、書ける値に戻してから書く
+    values_df = _to_sheet_frame(df)
+    local = _local_backend()
+    if local is not None:
+        return local.overwrite_sheet_data(sheet_name, values_df)
+
+    def _overwrite():
+        sheet = get_worksheet(sheet_name)
+        sheet.clear() # 全消去
+
+        # ヘッダーとデータを書き込み
+        # gspreadのupdate機能を使う
+        sheet.update([values_df.columns.values.tolist()] + values_df.values.tolist())
+    with _write_gate().writing(), _sheet_lock(sheet_name):
+        _run(_overwrite, kind='write', op='overwrite')
+        metrics.count('rows_written', len(values_df), sheet=sheet_name)
+        # 行の位置が変わるので upsert 用の対応表・差分同期の状態は作り直し
+        _row_index.pop(_sk(sheet_name), None)
+        _forget_sync(sheet_name)
+    _cache_put(sheet_name, apply_schema(sheet_name, df.reset_index(drop=True)))
+# --- シャードをまたぐ処理（管理画面の全チーム表示など） ---
+def fan_out(func, keys=None):
+    # func() を各シャードで並列に実行する。戻り値: ({シャード: 結果}, {シャード: 例外})
+    # 1つのシャードが失敗・混雑していても、ほかのシャードの結果は返す
+    keys = shard_keys() if keys is None else list(keys)
+    results, errors = {}, {}
+    if not keys:
+        return results, errors
+
+    def _one(key):
+        with use_shard(key):
+            return func()
+    with ThreadPoolExecutor(max_workers=min(SHARD_WORKERS, len(keys))) as pool:
+        futures = {key: pool.submit(_one, key) for key in keys}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                errors[key] = e
+    return results, errors
+
+def load_across_shards(sheet_names, keys=None):
+    # 各シャードの同じシートを並列に読み、'shard' 列を足して1つにまとめる。
+    # 戻り値: ({シート名: DataFrame}, {読めなかったシャード: 例外})
+    results, errors = fan_out(lambda: load_many(sheet_names), keys)
+    merged = {}
+    for sheet_name in sheet_names:
+        frames = [data[sheet_name].assign(shard=key) for key, data in results.items() if not data[sheet_name].empty]
+        merged[sheet_name] = _concat_typed(sheet_name, frames) if frames else pd.DataFrame()
+    return merged, errors
+
+# --- シャードの引っ越し ---
+def _read_values(spreadsheet, sheet_names):
+    # 各シートの中身を、画面が読むのと同じ表示用の値で1回にまとめて読む
+    res = spreadsheet.values_batch_get([_gspread().utils.absolute_range_name(name) for name in sheet_names])
+    return {name: vr.get('values', []) for name, vr in zip(sheet_names, res.get('valueRanges', []))}
+
+def _write_values(spreadsheet, values_by_sheet):
+    # 各シートを丸ごと書き直す（なければ作る）。何度やり直しても同じ結果になる
+    existing = {ws.title: ws for ws in spreadsheet.worksheets()}
+    for sheet_name, values in values_by_sheet.items():
+        rows = max(len(values), 1)
+        cols = max((len(r) for r in values), default=1)
+        sheet = existing.get(sheet_name)
+        if sheet is None:
+            sheet = spreadsheet.add_worksheet(sheet_name, rows=rows, cols=cols)
+        else:
+            sheet.clear()
+            sheet.resize(rows=rows, cols=cols)
+        if values:
+            # 読んだのは表示用の値なので、手で入力したのと同じ扱いで書く（日付・数値が文字列のまま残らないように）
+            sheet.update(values, value_input_option='USER_ENTERED')
+
+def _forget_shard(key):
+    # そのシャードのキャッシュ・差分同期・索引・対応表をすべて捨てる
+    with _cache_lock:
+        for cache_key in [k for k in _sheet_cache if k[0] == key]:
+            del _sheet_cache[cache_key]
+            _bump(cache_key)
+    for state in (_sync_state, _row_index):
+        for state_key in [k for k in state if k[0] == key]:
+            state.pop(state_key, None)
+    with _index_lock:
+        for index_key in [k for k in _indexes if k[0] == key]:
+            del _indexes[index_key]
+
+def move_shard(key, new_url, sheet_names=None):
+    # シャード key を new_url のスプレッドシートへ、画面を止めずに移す:
+    # 1. 全シートを写す（この間の読み書きは今までどおり元のスプレッドシートへ）
+    # 2. そのシャードへの書き込みを止め、1 の後に変わったシートだけ写し直す
+    # 3. 振り分け表を new_url に切り替え、キャッシュなどを捨ててから書き込みを再開する
+    # 2〜3 の間の保存は待たされるだけで失われない（選手の保存は記録帳経由なので画面は待たない）。
+    # 同じマシンのほかのプロセスの書き込みも、振り分け表のファイルの横のロックファイルで止め、
+    # 再開後はファイルの更新を見て新しい振り分け先へ書く。別のマシンで動いているプロセスは止められないので、
+    # アプリと同じマシンで（振り分け表のファイルを共有して）実行すること。
+    # 元のスプレッドシートは消さない。戻り値: {'sheets': [写したシート], 'recopied': [写し直したシート]}
+    if _local_backend() is not None:
+        raise RuntimeError("SQLite に保存する設定ではシャードを移せません")
+    with use_shard(key):
+        src, dst = get_spreadsheet(), _open(new_url)
+        names = list(sheet_names) if sheet_names else [ws.title for ws in _run(src.worksheets, op='move_shard')]
+        first = _run(lambda: _read_values(src, names), op='move_shard')
+        _run(lambda: _write_values(dst, first), kind='write', op='move_shard')
+        with _write_gate().closing():
+            current = _run(lambda: _read_values(src, names), op='move_shard')
+            changed = {name: values for name, values in current.items() if values != first[name]}
+            if changed:
+                _run(lambda: _write_values(dst, changed), kind='write', op='move_shard')
+            _save_route(key, new_url)
+            _forget_shard(key)
+    return {'sheets': names, 'recopied': list(changed)}
+
+def main(argv=None):
+    # python db.py tigers/2025 https://docs.google.com/spreadsheets/d/...
+    # （アプリと同じマシン・同じ作業フォルダで実行する。上の move_shard を参照）
+    import argparse
+    parser = argparse.ArgumentParser(description="シャード（チーム/シーズン）を別のスプレッドシートへ移す")
+    parser.add_argument("shard", help="移すシャード（例: tigers/2025）")
+    parser.add_argument("url", help="移し先のスプレッドシートの URL")
+    parser.add_argument("--sheets", help="移すシート（カンマ区切り。省略時はすべて）")
+    args = parser.parse_args(argv)
+    result = move_shard(args.shard, args.url, [s for s in args.sheets.split(",") if s] if args.sheets else None)
+    print(f"{args.shard}: {len(result['sheets'])} シートを写しました（写し直し: {', '.join(result['recopied']) or 'なし'}）")
+
+if __name__ == "__main__":
+    main()
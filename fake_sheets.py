@@ -0,0 +1,310 @@
+# fake_sheets.py
+# ベンチマーク・負荷試験用の、メモリ上で動く Google スプレッドシート／Cloudinary の代役。
+# db.py が使う gspread の呼び出しだけを実装し、1回ごとの待ち時間と毎分の上限（超えたら 429）を
+# 設定できる。呼び出し回数と送受信バイト数（JSON換算の目安）を数える。
+#
+#   client = fake_sheets.FakeClient(latency=0.05, read_quota=60, write_quota=60)
+#   client.load({'users': [[header...], [row...]], ...})
+#   fake_sheets.install(client)   # 以後 db の関数はこの代役に読み書きする
+#
+# URL を指定して load すると、そのURL用に別のスプレッドシートができる（シャードの確認用）。
+# 指定のないURLはすべて既定のスプレッドシート（client.spreadsheet）を開く。
+import hashlib
+import json
+import threading
+import time
+from collections import Counter, deque
+import gspread
+import requests
+import db
+
+class _Quota:
+    # 直近60秒の呼び出し回数が上限を超えたら 429 を返す（0 なら上限なし）
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.calls = deque()
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def check(self):
+        if not self.per_minute:
+            return
+        with self.lock:
+            now = time.monotonic()
+            while self.calls and now - self.calls[0] > 60:
+                self.calls.popleft()
+            if len(self.calls) >= self.per_minute:
+                self.rejected += 1
+                raise _api_error(429, "Quota exceeded", "RESOURCE_EXHAUSTED")
+            self.calls.append(now)
+
+def _api_error(code, message, status):
+    res = requests.Response()
+    res.status_code = code
+    res._content = json.dumps({"error": {"code": code, "message": message, "status": status}}).encode()
+    return gspread.exceptions.APIError(res)
+
+def _size(obj):
+    return len(json.dumps(obj, ensure_ascii=False, default=str).encode())
+
+def _cell_text(value):
+    # スプレッドシートと同じく、表示用の文字列で保存する（65.0 -> "65"）
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, float):
+        return ("%.10f" % value).rstrip("0").rstrip(".")
+    return "" if value is None else str(value)
+
+def _trim_values(rows):
+    # APIと同じく、行末の空セルと末尾の空行は返さない
+    out = []
+    for r in rows:
+        r = list(r)
+        while r and r[-1] == "":
+            r.pop()
+        out.append(r)
+    while out and not out[-1]:
+        out.pop()
+    return out
+
+def _split_range(range_name):
+    # "'meal'!A10:F" -> ('meal', 'A10:F')
+    if "!" in range_name:
+        sheet, a1 = range_name.rsplit("!", 1)
+    else:
+        sheet, a1 = range_name, ""
+    return sheet.strip("'"), a1
+
+class FakeClient:
+    def __init__(self, latency=0.0, read_quota=0, write_quota=0):
+        self.latency = latency
+        self.quotas = {'read': _Quota(read_quota), 'write': _Quota(write_quota)}
+        self.lock = threading.RLock()
+        self.stats_lock = threading.Lock()
+        self.spreadsheet = FakeSpreadsheet(self)
+        self.spreadsheets = {}  # URL -> FakeSpreadsheet
+        self.reset_stats()
+
+    # --- 計測 ---
+    def reset_stats(self):
+        with self.stats_lock:
+            self.calls = Counter()
+            self.bytes_sent = 0
+            self.bytes_received = 0
+        for quota in self.quotas.values():
+            with quota.lock:
+                quota.rejected = 0
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'api_calls': dict(self.calls),
+                'api_calls_total': sum(self.calls.values()),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'quota_rejections': {kind: q.rejected for kind, q in self.quotas.items()},
+            }
+
+    def _call(self, op, kind, sent, func):
+        # 1回のAPI呼び出し: 上限の確認 → 待ち時間 → 実行 → 計測
+        self.quotas[kind].check()
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            result = func()
+        with self.stats_lock:
+            self.calls[op] += 1
+            self.bytes_sent += _size(sent)
+            self.bytes_received += _size(result)
+        return result
+
+    # --- データの出し入れ ---
+    def spreadsheet_for(self, url=None):
+        if url is None:
+            return self.spreadsheet
+        with self.lock:
+            if url not in self.spreadsheets:
+                self.spreadsheets[url] = FakeSpreadsheet(self)
+            return self.spreadsheets[url]
+
+    def load(self, tables, url=None):
+        # tables: {シート名: [[ヘッダー], [行], ...]}
+        spreadsheet = self.spreadsheet_for(url)
+        with self.lock:
+            for title, rows in tables.items():
+                spreadsheet.add_worksheet_(title).rows = [[_cell_text(v) for v in r] for r in rows]
+
+    def dump(self, title, url=None):
+        with self.lock:
+            return [list(r) for r in self.spreadsheet_for(url).worksheet_(title).rows]
+
+    # --- gspread.Client の代わり ---
+    def open_by_url(self, url):
+        return self._call('open_by_url', 'read', url, lambda: self.spreadsheets.get(url, self.spreadsheet))
+
+class FakeSpreadsheet:
+    def __init__(self, client):
+        self.client = client
+        self.sheets = {}
+
+    def add_worksheet_(self, title):
+        if title not in self.sheets:
+            self.sheets[title] = FakeWorksheet(self.client, title, len(self.sheets) + 1)
+        return self.sheets[title]
+
+    # --- gspread.Spreadsheet の代わり ---
+    def worksheets(self):
+        return self.client._call('worksheets', 'read', "", lambda: list(self.sheets.values()))
+
+    def add_worksheet(self, title, rows=1000, cols=26):
+        return self.client._call('add_worksheet', 'write', title, lambda: self.add_worksheet_(title))
+
+    def worksheet_(self, title):
+        if title not in self.sheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.sheets[title]
+
+    def worksheet(self, title):
+        return self.client._call('worksheet', 'read', title, lambda: self.worksheet_(title))
+
+    def _by_id(self, sheet_id):
+        return next(ws for ws in self.sheets.values() if ws.id == sheet_id)
+
+    def values_batch_get(self, ranges, params=None):
+        def _get():
+            value_ranges = []
+            for range_name in ranges:
+                title, a1 = _split_range(range_name)
+                value_ranges.append({'range': range_name, 'values': self.worksheet_(title).read(a1)})
+            return {'valueRanges': value_ranges}
+        return self.client._call('values_batch_get', 'read', ranges, _get)
+
+    def batch_update(self, body):
+        def _update():
+            for req in body.get('requests', []):
+                if 'appendCells' in req:
+                    ac = req['appendCells']
+                    ws = self._by_id(ac['sheetId'])
+                    for row in ac['rows']:
+                        ws.rows.append([_cell_text(next(iter(c['userEnteredValue'].values()))) for c in row['values']])
+                elif 'deleteDimension' in req:
+                    r = req['deleteDimension']['range']
+                    ws = self._by_id(r['sheetId'])
+                    del ws.rows[r['startIndex']:r['endIndex']]
+                else:
+                    raise _api_error(400, f"unsupported request: {list(req)}", "INVALID_ARGUMENT")
+            return {'replies': [{} for _ in body.get('requests', [])]}
+        return self.client._call('batch_update', 'write', body, _update)
+
+class FakeWorksheet:
+    def __init__(self, client, title, sheet_id):
+        self.client = client
+        self.title = title
+        self.id = sheet_id
+        self.rows = []
+
+    def read(self, a1=""):
+        if not a1:
+            return _trim_values(self.rows)
+        grid = gspread.utils.a1_range_to_grid_range(a1)
+        r0, r1 = grid.get('startRowIndex', 0), grid.get('endRowIndex', len(self.rows))
+        c0, c1 = grid.get('startColumnIndex', 0), grid.get('endColumnIndex')
+        return _trim_values(r[c0:c1] for r in self.rows[r0:r1])
+
+    def _write(self, row_number, values_row):
+        while len(self.rows) < row_number:
+            self.rows.append([])
+        self.rows[row_number - 1] = [_cell_text(v) for v in values_row]
+
+    # --- gspread.Worksheet の代わり ---
+    def get_all_values(self):
+        return self.client._call('get_all_values', 'read', self.title, lambda: self.read())
+
+    def get_all_records(self):
+        def _records():
+            values = self.read()
+            if not values:
+                return []
+            header = values[0]
+            return [dict(zip(header, gspread.utils.numericise_all(r + [""] * (len(header) - len(r)))))
+                    for r in values[1:]]
+        return self.client._call('get_all_records', 'read', self.title, _records)
+
+    def batch_get(self, ranges):
+        return self.client._call('batch_get', 'read', ranges, lambda: [self.read(a1) for a1 in ranges])
+
+    def append_row(self, values_row):
+        return self.append_rows([values_row], op='append_row')
+
+    def append_rows(self, rows, op='append_rows'):
+        def _append():
+            start = len(self.rows) + 1
+            for r in rows:
+                self._write(len(self.rows) + 1, r)
+            end = len(self.rows)
+            last = gspread.utils.rowcol_to_a1(end, max((len(r) for r in rows), default=1))
+            return {'updates': {'updatedRange': f"'{self.title}'!A{start}:{last}", 'updatedRows': len(rows)}}
+        return self.client._call(op, 'write', rows, _append)
+
+    def batch_update(self, data):
+        def _update():
+            for item in data:
+                grid = gspread.utils.a1_range_to_grid_range(item['range'])
+                for offset, values_row in enumerate(item['values']):
+                    self._write(grid.get('startRowIndex', 0) + offset + 1, values_row)
+            return {'totalUpdatedRows': sum(len(item['values']) for item in data)}
+        return self.client._call('batch_update', 'write', data, _update)
+
+    def update(self, values, range_name=None, value_input_option=None):
+        def _update():
+            for row_number, values_row in enumerate(values, start=1):
+                self._write(row_number, values_row)
+            return {'updatedRows': len(values)}
+        return self.client._call('update', 'write', values, _update)
+
+    def resize(self, rows=None, cols=None):
+        def _resize():
+            if rows is not None:
+                del self.rows[rows:]
+            return {}
+        return self.client._call('resize', 'write', [rows, cols], _resize)
+
+    def clear(self):
+        def _clear():
+            self.rows = []
+            return {}
+        return self.client._call('clear', 'write', self.title, _clear)
+
+class _Creds:
+    valid = True
+
+def install(client):
+    # db の接続を代役に差し替え、キャッシュ・索引・差分同期の状態を空にする
+    db.set_backend("sheets")
+    db.reset_connection()
+    with db._pool_lock:
+        db._client = client
+        db._creds = _Creds()
+    reset_db_state()
+
+def reset_db_state():
+    db.invalidate_cache()
+    db._sync_state.clear()
+    db._row_index.clear()
+    db._indexes.clear()
+
+class FakeUploader:
+    # Cloudinary の代役。1枚ごとに待ち時間を入れ、中身のハッシュから URL を作る
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.uploads = 0
+        self.bytes_sent = 0
+
+    def __call__(self, data):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.uploads += 1
+            self.bytes_sent += len(data)
+        return f"https://res.cloudinary.com/fake/image/upload/v1/{hashlib.sha256(data).hexdigest()[:16]}.jpg"
@@ -0,0 +1,309 @@
+# loadtest.py
+# 朝の体重測定の時間帯（数分のうちに 30〜100 人が保存ボタンを押す）を、ブラウザなしで再現する負荷試験。
+# 選手 N 人と管理画面を見ている人 M 人を同時に動かし、手元のメモリ上のスプレッドシート／Cloudinary
+# （fake_sheets.py。API 1回ごとの待ち時間・毎分の上限あり）に対して保存・閲覧を行う。
+#
+# 結果として出すもの:
+#   - 保存の所要時間 p50 / p95 / p99（画面に返るまで・スプレッドシートに届くまで）と、1秒あたりの保存数
+#   - 上限超過（429）で断られた回数、再試行・諦めた回数
+#   - 最後にシートの中身を送った内容と突き合わせ、消えた行・二重になった行の数
+# 消えた・二重になった行があれば終了コード 1 で終わる。
+#
+#   python loadtest.py                                   # 30人 + 管理者2人、60秒のうちに保存
+#   python loadtest.py --players 100 --admins 5 --ramp 180 --quota 60 --output result.json
+#   python loadtest.py --mode direct                     # 記録帳を通さず、その場で書き込む場合
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import date
+import db
+import fake_sheets
+import metrics
+import write_queue
+from benchmark import SHEETS, make_team, player_names
+
+APPEND_SHEETS = ['meal', 'exercise', 'bowel']
+
+# --- 保存の中身 ---
+def save_ops(name, day, token, rng):
+    # 選手アプリの保存ボタン1回分と同じ形。追加行には token（保存ごとに別の値）を入れて、後で数える
+    return [
+        {'op': 'upsert', 'sheet': 'daily', 'key_columns': ['name', 'date'],
+         'rows': [{'name': name, 'date': day, 'weight': round(rng.uniform(55, 85), 1),
+                   'body_fat': round(rng.uniform(8, 20), 1), 'sleep': rng.choice([6, 6.5, 7, 7.5, 8])}]},
+        {'op': 'append', 'sheet': 'exercise', 'rows': [{'name': name, 'date': day, 'time': "60分", 'content': token}]},
+        {'op': 'append', 'sheet': 'meal', 'rows': [{'name': name, 'date': day, 'type': "朝食", 'time': "07:30",
+                                                    'menu': token, 'image_url': "", '_image': 0}]},
+        {'op': 'append', 'sheet': 'bowel', 'rows': [{'name': name, 'date': day, 'time': "07:00", 'amount': "普通",
+                                                     'hardness': token}]},
+    ]
+
+TOKEN_COLUMNS = {'exercise': 3, 'meal': 4, 'bowel': 4}  # token を入れた列の位置
+
+def _save_direct(ops, image, uploader):
+    # 記録帳を通さない保存（写真のアップロード → upsert → 追加行をまとめて1回）
+    url = uploader(image)
+    appends = {}
+    for op in ops:
+        rows = []
+        for r in op['rows']:
+            r = dict(r)
+            if r.pop('_image', None) is not None:
+                r['image_url'] = url
+            rows.append(r)
+        if op['op'] == 'upsert':
+            db.upsert_rows(op['sheet'], op['key_columns'], rows)
+        else:
+            appends.setdefault(op['sheet'], []).extend(rows)
+    db.append_rows_to_sheets(appends)
+
+# --- 同時に動かす人 ---
+class Run:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.saves = []  # {'shard', 'name', 'day', 'token', 'ops', 'key', 'start', 'ack', 'done', 'error'}
+        self.admin_views = []  # 秒
+        self.admin_errors = 0
+        self.stop = threading.Event()
+
+    def player(self, shard, name, rng, uploader):
+        args = self.args
+        time.sleep(rng.uniform(0, args.ramp))
+        for k in range(args.saves):
+            token = f"{shard}:{name}:{k}"
+            day = str(date(2025, 1, 1 + k % 28))
+            ops = save_ops(name, day, token, rng)
+            image = f"photo {token}".encode() * 500
+            record = {'shard': shard, 'name': name, 'day': day, 'token': token,
+                      'daily': dict(ops[0]['rows'][0]), 'key': None, 'done': None, 'error': None}
+            record['start'] = time.perf_counter()
+            try:
+                with db.use_shard(shard):
+                    if args.mode == 'queue':
+                        record['key'], _ = write_queue.enqueue(name, ops, [image], token=token)
+                    else:
+                        _save_direct(ops, image, uploader)
+                        record['done'] = time.perf_counter()
+            except Exception as e:
+                record['error'] = repr(e)
+            record['ack'] = time.perf_counter()
+            with self.lock:
+                self.saves.append(record)
+            if k + 1 < args.saves:
+                time.sleep(rng.uniform(0.5, 1.5) * args.think)
+
+    def admin(self, shards, rng):
+        import analytics
+        while not self.stop.is_set():
+            t = time.perf_counter()
+            try:
+                with db.use_shard(rng.choice(shards)):
+                    frames = db.load_many(SHEETS)
+                    analytics.cached_team_metrics(frames)
+                with self.lock:
+                    self.admin_views.append(time.perf_counter() - t)
+            except Exception:
+                with self.lock:
+                    self.admin_errors += 1
+            self.stop.wait(rng.uniform(0.5, 1.5) * self.args.admin_think)
+
+    def watch_journal(self):
+        # 記録帳で「送信済み」になった時刻を拾う（スプレッドシートに届くまでの時間）
+        while True:
+            with self.lock:
+                waiting = {r['key']: r for r in self.saves if r['key'] and r['done'] is None}
+            if waiting:
+                conn = write_queue._connect()
+                try:
+                    marks = ", ".join("?" for _ in waiting)
+                    done = [k for (k,) in conn.execute(
+                        f"SELECT idem_key FROM journal WHERE status = 'done' AND idem_key IN ({marks})", list(waiting))]
+                finally:
+                    conn.close()
+                now = time.perf_counter()
+                for key in done:
+                    waiting[key]['done'] = now
+            if self.stop.is_set() and not waiting:
+                return
+            time.sleep(0.05)
+
+# --- 突き合わせ ---
+def verify(client, urls, saves):
+    # 送った内容と、最後のシートの中身を比べる
+    lost, duplicated, stale = [], [], []
+    by_shard = {}
+    for r in saves:
+        if r['error'] is None:
+            by_shard.setdefault(r['shard'], []).append(r)
+    for shard, records in by_shard.items():
+        url = urls[shard]
+        for sheet_name in APPEND_SHEETS:
+            col = TOKEN_COLUMNS[sheet_name]
+            counts = {}
+            for row in client.dump(sheet_name, url)[1:]:
+                if len(row) > col:
+                    counts[row[col]] = counts.get(row[col], 0) + 1
+            for r in records:
+                n = counts.get(r['token'], 0)
+                if n == 0:
+                    lost.append(f"{sheet_name} {r['token']}")
+                elif n > 1:
+                    duplicated.append(f"{sheet_name} {r['token']} x{n}")
+        # daily は (name, date) ごとに1行で、最後に保存した値になっているはず
+        rows = {}
+        for row in client.dump('daily', url)[1:]:
+            rows.setdefault((row[0], row[1]), []).append(row)
+        last = {}
+        for r in sorted(records, key=lambda r: r['start']):
+            last[(r['name'], r['day'])] = r
+        for key, r in last.items():
+            found = rows.get(key, [])
+            if not found:
+                lost.append(f"daily {key}")
+            elif len(found) > 1:
+                duplicated.append(f"daily {key} x{len(found)}")
+            elif float(found[0][2]) != float(r['daily']['weight']):
+                stale.append(f"daily {key}: {found[0][2]} != {r['daily']['weight']}")
+    return {'lost': lost, 'duplicated': duplicated, 'stale': stale}
+
+def percentiles(values):
+    if not values:
+        return {'count': 0, 'p50': None, 'p95': None, 'p99': None, 'max': None}
+    if len(values) == 1:
+        q = values * 99
+    else:
+        q = statistics.quantiles(values, n=100, method='inclusive')
+    return {'count': len(values), 'p50': q[49], 'p95': q[94], 'p99': q[98], 'max': max(values)}
+
+def _counter_total(name):
+    counters, _ = metrics.prometheus.snapshot()
+    return sum(c['value'] for c in counters if c['name'] == name)
+
+# --- 実行 ---
+def run(args):
+    rng = random.Random(args.seed)
+    client = fake_sheets.FakeClient(latency=args.latency, read_quota=args.quota, write_quota=args.quota)
+    # 選手を teams 個のシャードに振り分ける（1つなら default だけ）
+    shards = [db.DEFAULT_SHARD] + [f"team{i}/2025" for i in range(1, args.teams)]
+    urls = {shard: None if shard == db.DEFAULT_SHARD else f"loadtest://{shard}" for shard in shards}
+    players = {shard: player_names(len(range(i, args.players, len(shards)))) for i, shard in enumerate(shards)}
+    for i, shard in enumerate(shards):
+        if urls[shard]:
+            db._routes[shard] = urls[shard]
+        client.load(make_team(len(players[shard]), args.history_days, args.seed + i), url=urls[shard])
+    fake_sheets.install(client)
+    db.READ_QUOTA_PER_MINUTE = db.WRITE_QUOTA_PER_MINUTE = args.quota or 10 ** 9
+    db._buckets.clear()
+    for shard in shards:
+        with db.use_shard(shard):
+            db.get_spreadsheet()  # 接続はプロセスで1回だけなので、計測の外で済ませておく
+
+    uploader = fake_sheets.FakeUploader(latency=args.upload_latency)
+    write_queue.uploader = uploader
+    write_queue.JOURNAL_PATH = os.path.join(tempfile.mkdtemp(prefix="loadtest_"), "journal.db")
+    metrics.enable()
+    metrics.reset()
+    client.reset_stats()
+
+    state = Run(args)
+    threads = [threading.Thread(target=state.player, args=(shard, name, random.Random(rng.random()), uploader))
+               for shard in shards for name in players[shard]]
+    admins = [threading.Thread(target=state.admin, args=(shards, random.Random(rng.random())), daemon=True)
+              for _ in range(args.admins)]
+    watcher = threading.Thread(target=state.watch_journal, daemon=True)
+
+    started = time.perf_counter()
+    for t in threads + admins + [watcher]:
+        t.start()
+    for t in threads:
+        t.join()
+    submitted_at = time.perf_counter()
+    # 記録帳の送信が終わるまで待つ
+    deadline = time.monotonic() + args.drain_timeout
+    while args.mode == 'queue' and write_queue.pending_count() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    finished = time.perf_counter()
+    state.stop.set()
+    watcher.join(timeout=5)
+    for t in admins:
+        t.join(timeout=args.admin_think * 2 + 5)
+
+    saves = state.saves
+    ok = [r for r in saves if r['error'] is None]
+    delivered = [r for r in ok if r['done'] is not None]
+    result = {
+        'config': {k: v for k, v in vars(args).items() if k != 'output'},
+        'saves': {
+            'submitted': len(saves), 'errors': len(saves) - len(ok), 'delivered': len(delivered),
+            'pending': write_queue.pending_count() if args.mode == 'queue' else 0,
+            'ack_seconds': percentiles([r['ack'] - r['start'] for r in ok]),
+            'delivery_seconds': percentiles([r['done'] - r['start'] for r in delivered]),
+            'throughput_per_second': len(delivered) / max(finished - started, 1e-9),
+            'submit_window_seconds': submitted_at - started,
+            'total_seconds': finished - started,
+            'error_samples': [r['error'] for r in saves if r['error']][:5],
+        },
+        'admin': {'views': percentiles(state.admin_views), 'errors': state.admin_errors},
+        'api': {**client.stats(), 'retries': _counter_total('db_retries'), 'throttled': _counter_total('db_throttled'),
+                'uploads': uploader.uploads},
+        'integrity': verify(client, urls, saves),
+    }
+    metrics.enable(False)
+    return result
+
+def _fmt(p):
+    if not p['count']:
+        return "（なし）"
+    return f"p50 {p['p50']:.3f}s  p95 {p['p95']:.3f}s  p99 {p['p99']:.3f}s  max {p['max']:.3f}s  (n={p['count']})"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="選手の同時保存と管理画面の閲覧を再現する負荷試験（ブラウザ不要）")
+    parser.add_argument("--players", type=int, default=30, help="同時に保存する選手の数")
+    parser.add_argument("--admins", type=int, default=2, help="管理画面を見ている人の数")
+    parser.add_argument("--teams", type=int, default=1, help="選手を分けるチーム（シャード）の数")
+    parser.add_argument("--saves", type=int, default=1, help="選手1人あたりの保存回数")
+    parser.add_argument("--ramp", type=float, default=60, help="全員が保存し始めるまでの秒数（この間にばらける）")
+    parser.add_argument("--think", type=float, default=20, help="同じ選手の保存の間隔（秒）")
+    parser.add_argument("--admin-think", type=float, default=5, help="管理画面の再読み込みの間隔（秒）")
+    parser.add_argument("--mode", choices=['queue', 'direct'], default='queue',
+                        help="queue: 記録帳を通す（選手アプリと同じ） / direct: その場で書き込む")
+    parser.add_argument("--latency", type=float, default=0.3, help="API 1回あたりの待ち時間（秒）")
+    parser.add_argument("--upload-latency", type=float, default=1.0, help="写真1枚のアップロード時間（秒）")
+    parser.add_argument("--quota", type=int, default=60, help="読み込み・書き込みそれぞれの毎分の上限（0 = なし）")
+    parser.add_argument("--history-days", type=int, default=90, help="最初から入っている記録の日数")
+    parser.add_argument("--drain-timeout", type=float, default=600, help="記録帳の送信を待つ最大の秒数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="結果の JSON を書き出すファイル")
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    s, integrity = result['saves'], result['integrity']
+    print(f"保存: {s['submitted']} 件（失敗 {s['errors']}・未送信 {s['pending']}）、{s['total_seconds']:.1f} 秒、"
+          f"{s['throughput_per_second']:.2f} 件/秒")
+    print(f"  画面に返るまで     {_fmt(s['ack_seconds'])}")
+    print(f"  シートに届くまで   {_fmt(s['delivery_seconds'])}")
+    print(f"管理画面: {_fmt(result['admin']['views'])}  失敗 {result['admin']['errors']}")
+    api = result['api']
+    print(f"API: {api['api_calls_total']} 回、上限超過 {api['quota_rejections']}、再試行 {api['retries']:g}、"
+          f"諦めた {api['throttled']:g}、写真 {api['uploads']} 枚")
+    print(f"突き合わせ: 消えた {len(integrity['lost'])}・二重 {len(integrity['duplicated'])}・"
+          f"古い値のまま {len(integrity['stale'])}")
+    for line in (integrity['lost'] + integrity['duplicated'] + integrity['stale'])[:10]:
+        print("  " + line)
+    bad = integrity['lost'] or integrity['duplicated'] or integrity['stale'] or s['pending']
+    return 1 if bad else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
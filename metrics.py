@@ -0,0 +1,198 @@
+# metrics.py
+# 処理時間・API呼び出し回数・読み書きした行数/バイト数・キャッシュの当たり率の計測。
+# 計測値は「出力先（sink）」に渡す。出力先は差し替え・追加できる:
+#   - PrometheusSink : 集計して Prometheus のテキスト形式で出す（管理画面の性能パネルもこれを見る）
+#   - RingBufferSink : 直近の計測値をそのまま N 件だけ覚えておく
+#   - LogSink        : 1件ずつ JSON の1行としてログに書く
+# 計測はふだんは止めてあり、止めている間は timer / count はほぼ何もしない。
+import json
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, math.inf)
+
+_enabled = False
+_lock = threading.Lock()
+
+def enabled():
+    return _enabled
+
+def enable(flag=True):
+    global _enabled
+    _enabled = bool(flag)
+
+# --- 出力先 ---
+class PrometheusSink:
+    # カウンタは合計、時間はヒストグラム（BUCKETS_MS ごとの件数）にまとめる
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}    # (名前, ラベル) -> 合計
+            self.histograms = {}  # (名前, ラベル) -> [バケツごとの件数, 合計, 件数]
+
+    def emit(self, event):
+        key = (event['name'], tuple(sorted(event['labels'].items())))
+        with self.lock:
+            if event['type'] == 'count':
+                self.counters[key] = self.counters.get(key, 0) + event['value']
+                return
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [[0] * len(BUCKETS_MS), 0.0, 0]
+            for i, bound in enumerate(BUCKETS_MS):
+                if event['value'] <= bound:
+                    h[0][i] += 1
+                    break
+            h[1] += event['value']
+            h[2] += 1
+
+    def snapshot(self):
+        # 画面表示用: ([{name, labels, value}], [{name, labels, count, sum, p50, p95}])
+        with self.lock:
+            counters = [{'name': n, 'labels': dict(l), 'value': v} for (n, l), v in self.counters.items()]
+            histograms = [{'name': n, 'labels': dict(l), 'count': h[2], 'sum': h[1],
+                           'p50': _quantile(h[0], h[2], 0.5), 'p95': _quantile(h[0], h[2], 0.95)}
+                          for (n, l), h in self.histograms.items()]
+        return counters, histograms
+
+    def text(self):
+        lines = []
+        with self.lock:
+            for name in sorted({n for n, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f"{name}{_labels(labels)} {_number(value)}")
+            for name in sorted({n for n, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (n, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, c in zip(BUCKETS_MS, buckets):
+                        cumulative += c
+                        le = "+Inf" if bound == math.inf else _number(bound)
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+                    lines.append(f"{name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+class RingBufferSink:
+    def __init__(self, maxlen=1000):
+        self.buffer = deque(maxlen=maxlen)
+
+    def emit(self, event):
+        self.buffer.append(event)
+
+    def reset(self):
+        self.buffer.clear()
+
+    def events(self):
+        return list(self.buffer)
+
+class LogSink:
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger("metrics")
+        self.level = level
+
+    def emit(self, event):
+        self.logger.log(self.level, json.dumps(event, ensure_ascii=False, default=str))
+
+    def reset(self):
+        pass
+
+def _quantile(buckets, count, q):
+    # ヒストグラムから分位点の目安（そのバケツの上限）を返す
+    if not count:
+        return None
+    target = q * count
+    cumulative = 0
+    for bound, c in zip(BUCKETS_MS, buckets):
+        cumulative += c
+        if cumulative >= target:
+            return bound
+    return math.inf
+
+def _labels(labels):
+    if not labels:
+        return ""
+    body = ",".join(f'{k}="{str(v)}"'.replace("\n", " ") for k, v in labels)
+    return "{" + body + "}"
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+prometheus = PrometheusSink()
+recent = RingBufferSink()
+_sinks = [prometheus, recent]
+
+def add_sink(sink):
+    with _lock:
+        _sinks.append(sink)
+
+def remove_sink(sink):
+    with _lock:
+        if sink in _sinks:
+            _sinks.remove(sink)
+
+def reset():
+    for sink in list(_sinks):
+        sink.reset()
+
+# --- 計測 ---
+def _emit(kind, name, value, labels):
+    event = {'ts': time.time(), 'type': kind, 'name': name, 'labels': labels, 'value': value}
+    for sink in list(_sinks):
+        try:
+            sink.emit(event)
+        except Exception:
+            # 計測の失敗で本来の処理を止めない
+            pass
+
+def count(name, value=1, **labels):
+    if _enabled:
+        _emit('count', name, value, labels)
+
+def observe(name, ms, **labels):
+    if _enabled:
+        _emit('timer', name, ms, labels)
+
+class _Timer:
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.labels['error'] = exc_type.__name__
+        _emit('timer', self.name, (time.perf_counter() - self.start) * 1000, self.labels)
+        return False
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+def timer(name, **labels):
+    # with metrics.timer('db_call_ms', op='load'): ...  （ミリ秒で記録）
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name, labels)
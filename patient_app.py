@@ -2,10 +2,12 @@ import streamlit as st
 import pandas as pd
 import unicodedata
 from datetime import datetime, date
-import cloudinary
-import cloudinary.uploader
-import plotly.graph_objects as go
 import db
+import charts
+import write_queue
+import metrics
+import archive
+import startup
 
 # --- 1. 画面構成設定 ---
 st.set_page_config(page_title="選手用入力アプリ", layout="centered")
@@ -30,14 +32,45 @@ def normalize_to_float(text):
     except ValueError:
         return 0.0
 
+def load_my_rows(sheet_name, user_name):
+    # 送信待ち（まだスプレッドシートに届いていない）分と、保管庫の古い記録も含めて自分の行を返す
+    try:
+        sent = archive.rows_for_player(sheet_name, user_name)
+    except db.ThrottledError:
+        st.warning("アクセスが集中しているため、送信済みの記録を表示できません")
+        sent = pd.DataFrame()
+    except db.SheetUnavailableError:
+        st.warning("送信済みの記録を読み込めませんでした。少し待ってから開き直してください")
+        sent = pd.DataFrame()
+    pending = write_queue.pending_rows(sheet_name, user_name)
+    if pending.empty:
+        return sent
+    return db.apply_schema(sheet_name, pd.concat([sent, pending], ignore_index=True))
+
 # CSS適用
 local_css("style.css")
 
 st.title("🏃‍♂️ コンディション記録")
 
-# --- 3. セッション管理 ---
+# --- 3. チーム（シャード）の選択 ---
+# チームごとの URL（?team=tigers）から開くと、そのチームの今シーズンのスプレッドシートに保存する
+team = st.query_params.get("team")
+try:
+    db.set_shard(db.shard_key(team) if team else db.DEFAULT_SHARD)
+except KeyError:
+    st.error("このチームは登録されていません。配られた URL を確認してください")
+    st.stop()
+
+# 最初の選手がログインする前に、裏で認証・スプレッドシートを開く・users の読み込みを済ませておく
+startup.prewarm(db.current_shard())
+# 前のプロセスで送りきれなかった保存（記録帳の残り）を、次の保存を待たずに送り始める
+write_queue.start()
+
+# --- 4. セッション管理 ---
 if 'current_user' not in st.session_state:
     st.session_state.current_user = None
+if 'registered_user' not in st.session_state:
+    st.session_state.registered_user = None
 
 if 'meal_count' not in st.session_state:
     st.session_state.meal_count = 1
@@ -50,6 +83,202 @@ def add_meal(): st.session_state.meal_count += 1
 def add_exercise(): st.session_state.exercise_count += 1
 def add_bowel(): st.session_state.bowel_count += 1
 
+# --- 入力欄（それぞれ部分更新） ---
+# 値は key で session_state に入るので、保存ボタンはそこから集める
+@st.fragment
+def condition_section():
+    st.date_input("日付", date.today(), key="input_date")
+    
+    st.write("---")
+    st.subheader("📊 体調入力")
+    
+    c1, c2 = st.columns(2)
+    with c1:
+        st.text_input("体重 (kg)", placeholder="例: 65.5", key="weight_input")
+    with c2:
+        st.text_input("体脂肪率 (%)", placeholder="例: 12.3", key="fat_input")
+    
+    sleep_options = [x * 0.5 for x in range(0, 49)]
+    st.selectbox("睡眠時間 (h)", sleep_options, index=14, key="sleep_input")
+
+@st.fragment
+def bowel_section():
+    st.write("---")
+    st.subheader("🚻 排便記録")
+    had_bowel = st.radio("今日は排便がありましたか？", ["あり", "なし"], horizontal=True, index=1, key="had_bowel_check")
+    
+    if had_bowel == "あり":
+        st.caption("回数分だけ追加できます")
+        for i in range(st.session_state.bowel_count):
+            st.markdown(f"**排便 {i+1}**")
+            bc1, bc2, bc3 = st.columns(3)
+            with bc1:
+                st.time_input("時間", value=datetime.now().time(), key=f"bowel_time_{i}")
+            with bc2:
+                st.selectbox("量", ["普通", "少ない", "多い"], key=f"bowel_amount_{i}")
+            with bc3:
+                st.selectbox("硬さ", ["普通", "柔らかい", "下痢", "硬い"], key=f"bowel_hardness_{i}")
+        st.button("＋ 排便枠を追加", on_click=add_bowel)
+
+@st.fragment
+def exercise_section():
+    st.write("---")
+    st.subheader("🏃‍♂️ 運動記録")
+    exercise_time_options = [f"{x}分" for x in range(0, 190, 10)]
+
+    for i in range(st.session_state.exercise_count):
+        st.markdown(f"**運動 {i+1}**")
+        ec1, ec2 = st.columns([1, 2])
+        with ec1:
+            st.selectbox("時間", exercise_time_options, index=3, key=f"ex_time_{i}") 
+        with ec2:
+            st.text_input("運動内容", placeholder="例：ジョグ、ベンチプレスなど", key=f"ex_content_{i}")
+    st.button("＋ 運動枠を追加", on_click=add_exercise)
+
+@st.fragment
+def meal_section():
+    st.write("---")
+    st.subheader("🍽️ 食事記録")
+    for i in range(st.session_state.meal_count):
+        st.markdown(f"**食事 {i+1}**")
+        mc1, mc2 = st.columns([1, 1])
+        with mc1:
+            st.selectbox("種類", ["朝食", "昼食", "夕食", "間食"], key=f"meal_type_{i}")
+        with mc2:
+            st.time_input("時間", value=datetime.now().time(), key=f"meal_time_{i}")
+        st.file_uploader("写真", type=['png', 'jpg'], key=f"meal_img_{i}")
+        st.text_area("メニュー", height=68, key=f"meal_menu_{i}")
+        st.divider()
+    st.button("＋ 食事枠を追加", on_click=add_meal)
+
+@st.fragment
+def save_section(user_name):
+    # --- 保存ボタン ---
+    # 保存1回分の目印。中身を変えずに押し直した（連打・再送）ときは同じ目印のままなので1回分になり、
+    # 中身が変われば新しい目印にする（前と同じ値に戻した保存も別の保存として登録される）
+    if 'save_token' not in st.session_state:
+        st.session_state.save_token = write_queue.new_token()
+        st.session_state.save_fingerprint = None
+    if st.button("✅ 今日の記録をすべて保存する", type="primary", use_container_width=True):
+        s = st.session_state
+        str_date = str(s.input_date)
+        weight_val = normalize_to_float(s.weight_input)
+        fat_val = normalize_to_float(s.fat_input)
+        
+        if weight_val > 0:
+            # 記録帳に書き込んだらすぐ完了。スプレッドシートへの送信と
+            # 写真のアップロードは write_queue のワーカーが裏で行う
+            # 1. コンディション (同じ名前・日付の行だけを上書き)
+            ops = [{'op': 'upsert', 'sheet': 'daily', 'key_columns': ['name', 'date'], 'rows': [{
+                'name': user_name, 'date': str_date,
+                'weight': weight_val, 'body_fat': fat_val, 'sleep': s.sleep_input
+            }]}]
+
+            # 2〜4. 排便・運動・食事は追加
+            bowel_rows = []
+            if s.had_bowel_check == "あり":
+                for i in range(s.bowel_count):
+                    bowel_rows.append({
+                        'name': user_name, 'date': str_date,
+                        'time': str(s[f"bowel_time_{i}"]), 'amount': s[f"bowel_amount_{i}"], 'hardness': s[f"bowel_hardness_{i}"]
+                    })
+
+            exercise_rows = []
+            for i in range(s.exercise_count):
+                if s[f"ex_content_{i}"]:
+                    exercise_rows.append({
+                        'name': user_name, 'date': str_date,
+                        'time': s[f"ex_time_{i}"], 'content': s[f"ex_content_{i}"]
+                    })
+
+            meal_rows = []
+            images = []
+            for i in range(s.meal_count):
+                image_file = s[f"meal_img_{i}"]
+                if not s[f"meal_menu_{i}"] and not image_file:
+                    continue
+                row = {
+                    'name': user_name, 'date': str_date,
+                    'type': s[f"meal_type_{i}"], 'time': str(s[f"meal_time_{i}"]),
+                    'menu': s[f"meal_menu_{i}"], 'image_url': ""
+                }
+                if image_file:
+                    row['_image'] = len(images)
+                    images.append(image_file.getvalue())
+                meal_rows.append(row)
+
+            for sheet_name, rows in [('bowel', bowel_rows), ('exercise', exercise_rows), ('meal', meal_rows)]:
+                if rows:
+                    ops.append({'op': 'append', 'sheet': sheet_name, 'rows': rows})
+
+            content = write_queue.fingerprint(ops, images)
+            if s.save_fingerprint not in (None, content):
+                s.save_token = write_queue.new_token()
+            s.save_fingerprint = content
+            with metrics.timer('section_ms', app='patient', section='save'):
+                _, is_new = write_queue.enqueue(user_name, ops, images, token=s.save_token)
+            if is_new:
+                st.toast("保存完了", icon="✅")
+            else:
+                st.toast("この内容はすでに保存済みです", icon="ℹ️")
+        else:
+            st.error("体重を正しく入力してください")
+
+@st.fragment
+def review_section(user_name):
+    st.subheader("📊 コンディション分析")
+    with metrics.timer('section_ms', app='patient', section='review_load'):
+        my_daily = load_my_rows('daily', user_name)
+    pending_cnt = write_queue.pending_count(user_name)
+    if pending_cnt:
+        st.caption(f"⏳ 送信待ちの記録が {pending_cnt} 件あります（表示には含まれています）")
+    failed_cnt = write_queue.failed_upload_count(user_name)
+    if failed_cnt:
+        st.warning(f"写真 {failed_cnt} 枚のアップロードに失敗しました。自動で再送します")
+    lost_cnt = write_queue.lost_photo_count(user_name)
+    if lost_cnt:
+        st.warning(f"写真 {lost_cnt} 枚はアップロードできなかったため、写真なしで保存しました")
+    
+    if not my_daily.empty:
+        my_data = my_daily.copy()
+        if not my_data.empty:
+            # 日付・数値の型は db の読み込み時に揃っている
+            my_data = my_data.sort_values('date', kind='stable')
+            my_data = my_data.drop_duplicates(subset=['date'], keep='last')
+            
+            latest = my_data.iloc[-1]
+            col1, col2 = st.columns(2)
+            with col1:
+                st.metric("現在の体重", f"{db.format_number(latest['weight'])} kg")
+            with col2:
+                st.metric("体脂肪率", f"{db.format_number(latest['body_fat'])} %")
+            
+            # Plotlyグラフ（長い期間は間引いて表示）
+            window = st.radio("表示期間", list(charts.WINDOWS), index=list(charts.WINDOWS).index(charts.DEFAULT_WINDOW), horizontal=True, key="chart_window")
+            with metrics.timer('section_ms', app='patient', section='chart'):
+                fig = charts.cached_condition_figure(user_name, my_data, window, height=350, version=db.data_version(['daily']))
+                st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False})
+
+            # 履歴表示
+            st.divider()
+            c_ex, c_bowel = st.columns(2)
+            with c_ex:
+                st.write("🏃‍♂️ 最近の運動")
+                my_ex = load_my_rows('exercise', user_name).tail(3)
+                if not my_ex.empty:
+                    for _, row in my_ex.iterrows():
+                        st.success(f"{db.format_date(row['date'])} : {row['content']}")
+            with c_bowel:
+                st.write("🚻 最近の排便")
+                my_bowel = load_my_rows('bowel', user_name).tail(3)
+                if not my_bowel.empty:
+                    for _, row in my_bowel.iterrows():
+                        st.info(f"{db.format_date(row['date'])} : {row['amount']} / {row['hardness']}")
+        else:
+            st.info("データなし")
+    else:
+        st.info("データなし")
+
 # ==========================================
 # A. ログイン画面
 # ==========================================
@@ -75,19 +304,29 @@ else:
     with col2:
         if st.button("ログアウト"):
             st.session_state.current_user = None
+            st.session_state.registered_user = None
             st.session_state.meal_count = 1
             st.session_state.exercise_count = 1
             st.session_state.bowel_count = 1
             st.rerun()
 
-    # スプレッドシートからユーザー一覧を取得
-    users_df = db.load_data_from_sheet('users')
-    
+    # 登録済みかどうかはセッションごとに1回だけ確認する（入力のたびに users を読まない）
+    if st.session_state.registered_user != user_name:
+        try:
+            with metrics.timer('section_ms', app='patient', section='users'):
+                users_df = db.load_data_from_sheet('users')
+        except db.ThrottledError:
+            st.warning("アクセスが集中しています。少し待ってからもう一度お試しください")
+            st.stop()
+        except db.SheetUnavailableError:
+            # 読めないまま「未登録」として登録画面を出さない
+            st.warning("選手の一覧を読み込めませんでした。少し待ってからもう一度お試しください")
+            st.stop()
+        if not users_df.empty and user_name in users_df['name'].values:
+            st.session_state.registered_user = user_name
+
     # --- B-1. 初回登録 ---
-    is_registered = False
-    if not users_df.empty:
-        if user_name in users_df['name'].values:
-            is_registered = True
+    is_registered = st.session_state.registered_user == user_name
 
     if not is_registered:
         st.warning("初回登録が必要です。")
@@ -104,205 +343,26 @@ else:
                         'height': height_val
                     }
                     db.append_data_to_sheet('users', new_user_data)
+                    st.session_state.registered_user = user_name
                     st.rerun()
                 else:
                     st.error("身長を正しく入力してください")
 
     # --- B-2. 日々の入力 ---
     else:
-        tab_input, tab_review = st.tabs(["📝 今日の入力", "📊 自分の記録"])
+        # 振り返りタブ（グラフ・履歴の読み込み）は開いたときだけ実行する
+        tab_input, tab_review = st.tabs(["📝 今日の入力", "📊 自分の記録"], key="patient_tab", on_change="rerun")
         
+        # 各入力欄は部分更新（fragment）にしてあり、入力しても再描画されるのはその欄だけ
+        # （書きかけの入力が消えないよう、入力タブは閉じていても描く）
         with tab_input:
-            input_date = st.date_input("日付", date.today())
-            str_date = str(input_date)
-            
-            st.write("---")
-            st.subheader("📊 体調入力")
-            
-            c1, c2 = st.columns(2)
-            with c1:
-                weight_str = st.text_input("体重 (kg)", placeholder="例: 65.5", key="weight_input")
-            with c2:
-                fat_str = st.text_input("体脂肪率 (%)", placeholder="例: 12.3", key="fat_input")
-            
-            sleep_options = [x * 0.5 for x in range(0, 49)]
-            sleep = st.selectbox("睡眠時間 (h)", sleep_options, index=14, key="sleep_input")
-
-            # --- 排便記録 ---
-            st.write("---")
-            st.subheader("🚻 排便記録")
-            had_bowel = st.radio("今日は排便がありましたか？", ["あり", "なし"], horizontal=True, index=1, key="had_bowel_check")
-            
-            bowel_data_list = []
-            if had_bowel == "あり":
-                st.caption("回数分だけ追加できます")
-                for i in range(st.session_state.bowel_count):
-                    st.markdown(f"**排便 {i+1}**")
-                    bc1, bc2, bc3 = st.columns(3)
-                    with bc1:
-                        b_time = st.time_input("時間", value=datetime.now().time(), key=f"bowel_time_{i}")
-                    with bc2:
-                        b_amount = st.selectbox("量", ["普通", "少ない", "多い"], key=f"bowel_amount_{i}")
-                    with bc3:
-                        b_hardness = st.selectbox("硬さ", ["普通", "柔らかい", "下痢", "硬い"], key=f"bowel_hardness_{i}")
-                    
-                    bowel_data_list.append({'time': str(b_time), 'amount': b_amount, 'hardness': b_hardness})
-                st.button("＋ 排便枠を追加", on_click=add_bowel)
-
-            # --- 運動記録 ---
-            st.write("---")
-            st.subheader("🏃‍♂️ 運動記録")
-            exercise_data_list = []
-            exercise_time_options = [f"{x}分" for x in range(0, 190, 10)]
-
-            for i in range(st.session_state.exercise_count):
-                st.markdown(f"**運動 {i+1}**")
-                ec1, ec2 = st.columns([1, 2])
-                with ec1:
-                    ex_time = st.selectbox("時間", exercise_time_options, index=3, key=f"ex_time_{i}") 
-                with ec2:
-                    ex_content = st.text_input("運動内容", placeholder="例：ジョグ、ベンチプレスなど", key=f"ex_content_{i}")
-                
-                if ex_content:
-                    exercise_data_list.append({'time': ex_time, 'content': ex_content})
-            st.button("＋ 運動枠を追加", on_click=add_exercise)
-
-            # --- 食事記録 ---
-            st.write("---")
-            st.subheader("🍽️ 食事記録")
-            meal_data_list = []
-            for i in range(st.session_state.meal_count):
-                st.markdown(f"**食事 {i+1}**")
-                mc1, mc2 = st.columns([1, 1])
-                with mc1:
-                    m_type = st.selectbox("種類", ["朝食", "昼食", "夕食", "間食"], key=f"meal_type_{i}")
-                with mc2:
-                    m_time = st.time_input("時間", value=datetime.now().time(), key=f"meal_time_{i}")
-                m_img = st.file_uploader("写真", type=['png', 'jpg'], key=f"meal_img_{i}")
-                m_menu = st.text_area("メニュー", height=68, key=f"meal_menu_{i}")
-                
-                meal_data_list.append({'type': m_type, 'time': str(m_time), 'menu': m_menu, 'image_file': m_img})
-                st.divider()
-            st.button("＋ 食事枠を追加", on_click=add_meal)
-
-            # --- 保存ボタン ---
-            if st.button("✅ 今日の記録をすべて保存する", type="primary", use_container_width=True):
-                weight_val = normalize_to_float(weight_str)
-                fat_val = normalize_to_float(fat_str)
-                
-                if weight_val > 0:
-                    # 【修正箇所】メッセージをシンプルに変更
-                    with st.spinner("保存中..."):
-                        # 1. コンディション保存 (上書きロジック)
-                        daily_df = db.load_data_from_sheet('daily')
-                        if not daily_df.empty:
-                            daily_df = daily_df[~((daily_df['name'] == user_name) & (daily_df['date'] == str_date))]
-                        
-                        new_row = pd.DataFrame([{
-                            'name': user_name, 'date': str_date, 
-                            'weight': weight_val, 'body_fat': fat_val, 'sleep': sleep
-                        }])
-                        updated_daily_df = pd.concat([daily_df, new_row], ignore_index=True)
-                        db.overwrite_sheet_data('daily', updated_daily_df)
-                        
-                        # 2. 排便データの保存
-                        if had_bowel == "あり" and bowel_data_list:
-                            for b in bowel_data_list:
-                                db.append_data_to_sheet('bowel', {
-                                    'name': user_name, 'date': str_date,
-                                    'time': b['time'], 'amount': b['amount'], 'hardness': b['hardness']
-                                })
-
-                        # 3. 運動データの保存
-                        if exercise_data_list:
-                            for ex in exercise_data_list:
-                                db.append_data_to_sheet('exercise', {
-                                    'name': user_name, 'date': str_date,
-                                    'time': ex['time'], 'content': ex['content']
-                                })
-
-                        # 4. 食事保存
-                        if any(m['menu'] or m['image_file'] for m in meal_data_list):
-                            for meal in meal_data_list:
-                                if not meal['menu'] and not meal['image_file']:
-                                    continue
-                                image_url = ""
-                                if meal['image_file']:
-                                    try:
-                                        res = cloudinary.uploader.upload(meal['image_file'])
-                                        image_url = res['secure_url']
-                                    except:
-                                        pass
-                                
-                                db.append_data_to_sheet('meal', {
-                                    'name': user_name, 'date': str_date,
-                                    'type': meal['type'], 'time': meal['time'],
-                                    'menu': meal['menu'], 'image_url': image_url
-                                })
-                    
-                    # 【修正箇所】メッセージをシンプルに変更
-                    st.toast("保存完了", icon="✅")
-                else:
-                    st.error("体重を正しく入力してください")
+            condition_section()
+            bowel_section()
+            exercise_section()
+            meal_section()
+            save_section(user_name)
 
         # --- 振り返りタブ ---
         with tab_review:
-            st.subheader("📊 コンディション分析")
-            daily_df = db.load_data_from_sheet('daily')
-            
-            if not daily_df.empty:
-                my_data = daily_df[daily_df['name'] == user_name].copy()
-                if not my_data.empty:
-                    my_data['date'] = pd.to_datetime(my_data['date'])
-                    my_data = my_data.sort_values('date')
-                    my_data = my_data.drop_duplicates(subset=['date'], keep='last')
-                    
-                    my_data['weight'] = pd.to_numeric(my_data['weight'], errors='coerce')
-                    my_data['body_fat'] = pd.to_numeric(my_data['body_fat'], errors='coerce')
-                    
-                    latest = my_data.iloc[-1]
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        st.metric("現在の体重", f"{latest['weight']} kg")
-                    with col2:
-                        st.metric("体脂肪率", f"{latest['body_fat']} %")
-                    
-                    # Plotlyグラフ
-                    fig = go.Figure()
-                    fig.add_trace(go.Scatter(x=my_data['date'], y=my_data['weight'], mode='lines+markers', name='体重 (kg)', line=dict(color='#007bff', width=2)))
-                    fig.add_trace(go.Scatter(x=my_data['date'], y=my_data['body_fat'], mode='lines+markers', name='体脂肪率 (%)', line=dict(color='#28a745', width=2, dash='dot')))
-
-                    max_val = 100
-                    if not my_data['weight'].dropna().empty:
-                        max_val = max(my_data['weight'].max(), my_data['body_fat'].max()) * 1.1
-
-                    fig.update_layout(
-                        height=350, margin=dict(l=20, r=20, t=20, b=20),
-                        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
-                        yaxis=dict(range=[0, max_val], fixedrange=True, title="値"),
-                        xaxis=dict(fixedrange=True, tickformat="%Y-%m-%d", dtick="D1"),
-                        hovermode="x unified"
-                    )
-                    st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False})
-
-                    # 履歴表示
-                    st.divider()
-                    c_ex, c_bowel = st.columns(2)
-                    with c_ex:
-                        st.write("🏃‍♂️ 最近の運動")
-                        ex_df = db.load_data_from_sheet('exercise')
-                        if not ex_df.empty:
-                            my_ex = ex_df[ex_df['name'] == user_name].tail(3)
-                            for _, row in my_ex.iterrows():
-                                st.success(f"{row['date']} : {row['content']}")
-                    with c_bowel:
-                        st.write("🚻 最近の排便")
-                        bowel_df = db.load_data_from_sheet('bowel')
-                        if not bowel_df.empty:
-                            my_bowel = bowel_df[bowel_df['name'] == user_name].tail(3)
-                            for _, row in my_bowel.iterrows():
-                                st.info(f"{row['date']} : {row['amount']} / {row['hardness']}")
-                else:
-                    st.info("データなし")
-            else:
-                st.info("データなし")
\ No newline at end of file
+            if tab_review.open:
+                review_section(user_name)
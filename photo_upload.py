@@ -0,0 +1,105 @@
+# photo_upload.py
+# 食事写真のアップロード。スマホの元画像は大きいので、送る前に手元で縮小・再圧縮し、
+# 複数枚を同時にアップロードする。同じ写真（中身が同じ）は2回アップロードしない。
+# アップロード先は関数で差し替えられるので、負荷試験では手元の偽物を使う。
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import db
+
+MAX_SIDE = db._config("photo_max_side", 1600)      # 長い辺の最大ピクセル数
+JPEG_QUALITY = db._config("photo_jpeg_quality", 80)
+UPLOAD_WORKERS = db._config("photo_upload_workers", 4)
+THUMB_WIDTH = db._config("photo_thumb_width", 320)     # 一覧に出す縮小版の幅
+KNOWN_URLS_MAX = 1000
+
+_lock = threading.Lock()
+_known_urls = OrderedDict()  # 写真の中身のハッシュ -> アップロード済みのURL
+
+def upload_to_cloudinary(data):
+    import cloudinary.uploader
+    res = cloudinary.uploader.upload(io.BytesIO(data))
+    return res['secure_url']
+
+def thumbnail_url(url, width=None):
+    # Cloudinary の URL に変換指定を入れて、縮小版を配信してもらう
+    # （例: .../image/upload/v1/abc.jpg -> .../image/upload/c_limit,w_320,q_auto,f_auto/v1/abc.jpg）
+    # Cloudinary 以外の URL はそのまま返す
+    width = width or THUMB_WIDTH
+    marker = "/image/upload/"
+    if not isinstance(url, str) or "res.cloudinary.com" not in url or marker not in url:
+        return url
+    head, tail = url.split(marker, 1)
+    return f"{head}{marker}c_limit,w_{width},q_auto,f_auto/{tail}"
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def compress_image(data, max_side=None, quality=None):
+    # 縮小してJPEGにする。画像として読めない場合はそのまま返す
+    from PIL import Image, ImageOps
+    max_side = max_side or MAX_SIDE
+    quality = quality or JPEG_QUALITY
+    try:
+        img = Image.open(io.BytesIO(data))
+        img = ImageOps.exif_transpose(img)  # スマホ写真の向きを直す
+    except Exception:
+        return data
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    img.thumbnail((max_side, max_side))
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=quality, optimize=True)
+    # 元の方が小さければ元のまま送る
+    return out.getvalue() if out.tell() < len(data) else data
+
+def _known_url(h):
+    with _lock:
+        url = _known_urls.get(h)
+        if url is not None:
+            _known_urls.move_to_end(h)
+        return url
+
+def _remember(h, url):
+    with _lock:
+        _known_urls[h] = url
+        while len(_known_urls) > KNOWN_URLS_MAX:
+            _known_urls.popitem(last=False)
+
+def upload_images(images, uploader=None, compress=True):
+    # images: {番号: 画像のbytes}。compress=False なら縮小済みとしてそのまま送る
+    # 戻り値: {番号: (URL, None)} 成功 / {番号: (None, 例外)} 失敗 を1枚ずつ返す
+    uploader = uploader or upload_to_cloudinary
+    by_hash = {}
+    for idx, data in images.items():
+        by_hash.setdefault(content_hash(data), []).append(idx)
+
+    results = {}
+    todo = {}
+    for h, idxs in by_hash.items():
+        url = _known_url(h)
+        if url is not None:
+            for idx in idxs:
+                results[idx] = (url, None)
+        else:
+            todo[h] = images[idxs[0]]
+    if not todo:
+        return results
+
+    def _upload(h):
+        return uploader(compress_image(todo[h]) if compress else todo[h])
+
+    with ThreadPoolExecutor(max_workers=min(UPLOAD_WORKERS, len(todo))) as pool:
+        futures = {h: pool.submit(_upload, h) for h in todo}
+        for h, future in futures.items():
+            try:
+                url = future.result()
+                _remember(h, url)
+                result = (url, None)
+            except Exception as e:
+                result = (None, e)
+            for idx in by_hash[h]:
+                results[idx] = result
+    return results
@@ -0,0 +1,180 @@
+# rollups.py
+# 「📅 日毎一覧」用に、日付ごとのまとめ（選手ごとの最新の体調・運動・食事・排便・未提出者）を
+# あらかじめ作っておく。日付を切り替えるときは、日付をキーに引くだけで済む。
+#
+# - meal / exercise / bowel は追記されるだけなので、前回から増えた行だけを足していく
+# - daily は同じ日の記録が途中の行で上書きされるので、前回と比べて変わった行・増えた行の
+#   （日付, 名前）だけを作り直す（db のキャッシュもシートと同じく、上書きした行はその位置のまま）
+# - シートの中身が変わったかは db.data_version で見る。変わっていなければ何もしない
+# - 週・月の一覧表も、シートを調べ直さずにこのまとめから作る
+# - まとめはチーム・シーズン（db のシャード）ごとに持つ
+import threading
+import numpy as np
+import pandas as pd
+import db
+
+APPEND_ONLY = ['meal', 'exercise', 'bowel']
+DIARRHEA = "下痢"
+
+_lock = threading.Lock()
+_shards = {}  # シャード -> まとめ（_state を参照）
+
+def _state():
+    shard = db.current_shard()
+    s = _shards.get(shard)
+    if s is None:
+        s = _shards[shard] = {
+            'days': {},     # 日付(Timestamp) -> {'daily': {名前: 行}, 'meal': [行], 'exercise': [行], 'bowel': [行]}
+            'seen': {},     # sheet_name -> (前回の DataFrame, 行数, 最後の行, データの版)
+            'columns': {},  # sheet_name -> 列名
+            'players': [],
+        }
+    return s
+
+def _last_row(df, n):
+    return tuple(str(v) for v in df.iloc[n - 1].tolist()) if n else None
+
+def _day(s, date):
+    entry = s['days'].get(date)
+    if entry is None:
+        entry = s['days'][date] = {'daily': {}, 'meal': [], 'exercise': [], 'bowel': []}
+    return entry
+
+def _add_rows(s, sheet_name, df):
+    df = df.dropna(subset=['date'])
+    for date, group in df.groupby('date', sort=False):
+        records = group.to_dict('records')
+        if sheet_name == 'daily':
+            # 同じ選手の同じ日は後の行が正
+            _day(s, date)['daily'].update((r['name'], r) for r in records)
+        else:
+            _day(s, date)[sheet_name].extend(records)
+
+def _clear_sheet(s, sheet_name):
+    for entry in s['days'].values():
+        entry[sheet_name] = {} if sheet_name == 'daily' else []
+
+def _changed(old, df):
+    # 前回の DataFrame と同じ位置の行どうしを比べ、変わった行と増えた行の位置を返す。
+    # 行が減った・列が変わったときは位置で比べられないので None
+    if len(old) > len(df) or list(old.columns) != list(df.columns):
+        return None
+    n = len(old)
+    same = np.ones(n, dtype=bool)
+    for c in df.columns:
+        a, b = old[c].to_numpy(), df[c].to_numpy()[:n]
+        same &= (a == b) | (pd.isna(a) & pd.isna(b))
+    return np.r_[np.flatnonzero(~same), np.arange(n, len(df))]
+
+def _patch_daily(s, old, df, changed):
+    # 変わった行の前後の（日付, 名前）を消し、その組み合わせの行だけを今の DataFrame から入れ直す
+    keys = set()
+    for frame, rows in [(old, changed[changed < len(old)]), (df, changed)]:
+        part = frame.iloc[rows]
+        keys.update(zip(part['date'], part['name'].astype(object)))
+    for date, name in keys:
+        if date in s['days']:
+            s['days'][date]['daily'].pop(name, None)
+    dates = {date for date, _ in keys}
+    names = {name for _, name in keys}
+    # 日付と名前で絞った行（同じ選手・同じ日は後の行が正なので、上書きしても結果は同じ）
+    _add_rows(s, 'daily', df[df['date'].isin(dates).to_numpy() & df['name'].astype(object).isin(names).to_numpy()])
+
+def _sync_sheet(s, sheet_name, df):
+    # db の読み込みは毎回別の DataFrame（浅いコピー）を返すので、中身が変わったかはデータの版で見る
+    # （SQLite・db から読んでいない DataFrame では版がないので毎回比べる）
+    version = db.data_version([sheet_name])
+    if version is not None and not version[-1]:
+        version = None
+    seen = s['seen'].get(sheet_name)
+    if seen is not None and version is not None and seen[3] == version:
+        return
+    if df.empty or 'date' not in df.columns:
+        _clear_sheet(s, sheet_name)
+        s['seen'][sheet_name] = (df, 0, None, version)
+        return
+
+    n = len(df)
+    s['columns'][sheet_name] = list(df.columns)
+    if (sheet_name in APPEND_ONLY and seen is not None and seen[1] <= n
+            and _last_row(df, seen[1]) == seen[2]):
+        # 前回の続き: 増えた行だけを足す
+        _add_rows(s, sheet_name, df.iloc[seen[1]:])
+    elif sheet_name == 'daily' and seen is not None and seen[1]:
+        changed = _changed(seen[0], df)
+        if changed is None:
+            # 行が減った（削除・保管庫への移動）ときは作り直す
+            _clear_sheet(s, sheet_name)
+            _add_rows(s, sheet_name, df)
+        elif len(changed):
+            _patch_daily(s, seen[0], df, changed)
+    else:
+        _clear_sheet(s, sheet_name)
+        _add_rows(s, sheet_name, df)
+    s['seen'][sheet_name] = (df, n, _last_row(df, n), version)
+
+def refresh(frames):
+    # frames: {'users': df, 'daily': df, 'meal': df, 'exercise': df, 'bowel': df}
+    # 前回から変わったシートの分だけまとめを更新する
+    with _lock:
+        s = _state()
+        users_df = frames.get('users')
+        if users_df is not None and not users_df.empty:
+            s['players'] = list(users_df['name'].astype(object).unique())
+        for sheet_name in ['daily'] + APPEND_ONLY:
+            if sheet_name in frames:
+                _sync_sheet(s, sheet_name, frames[sheet_name])
+
+def _frame(s, sheet_name, records):
+    return pd.DataFrame(records, columns=s['columns'].get(sheet_name))
+
+def day(date):
+    # その日のまとめを返す
+    date = pd.Timestamp(date).normalize()
+    with _lock:
+        s = _state()
+        entry = s['days'].get(date) or {'daily': {}, 'meal': [], 'exercise': [], 'bowel': []}
+        daily = _frame(s, 'daily', list(entry['daily'].values()))
+        bowel = _frame(s, 'bowel', list(entry['bowel']))
+        submitted = [name for name in s['players'] if name in entry['daily']]
+        missing = [name for name in s['players'] if name not in entry['daily']]
+        result = {
+            'daily': daily,
+            'exercise': _frame(s, 'exercise', list(entry['exercise'])),
+            'meal': _frame(s, 'meal', list(entry['meal'])),
+            'bowel': bowel,
+            'submitted': submitted,
+            'missing': missing,
+        }
+    if not bowel.empty:
+        diarrhea = bowel['hardness'].astype(object) == DIARRHEA
+        result['bowel_summary'] = pd.DataFrame({
+            'count': bowel.groupby(bowel['name'].astype(object)).size(),
+            'diarrhea': diarrhea.groupby(bowel['name'].astype(object)).sum(),
+        }).reset_index(names='name')
+    else:
+        result['bowel_summary'] = pd.DataFrame(columns=['name', 'count', 'diarrhea'])
+    return result
+
+def range_grid(start, end, column='weight'):
+    # 選手 × 日付 の一覧（週・月の表示用）。体調の記録があれば column の値、なければ NaN
+    dates = pd.date_range(pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize())
+    with _lock:
+        s = _state()
+        days = s['days']
+        grid = {
+            date: {name: r.get(column) for name, r in days[date]['daily'].items()} if date in days else {}
+            for date in dates
+        }
+        players = list(s['players'])
+    return pd.DataFrame(grid, index=players, columns=dates)
+
+def submission_counts(start, end):
+    # 日付ごとの 提出人数 / 未提出人数
+    dates = pd.date_range(pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize())
+    with _lock:
+        s = _state()
+        days = s['days']
+        total = len(s['players'])
+        submitted = [sum(1 for name in s['players'] if date in days and name in days[date]['daily']) for date in dates]
+    return pd.DataFrame({'date': dates, 'submitted': submitted, 'missing': [total - s for s in submitted]})
@@ -0,0 +1,174 @@
+# sqlite_backend.py
+# Googleスプレッドシートの代わりにローカルのSQLiteへ保存するバックエンド。
+# db.py の公開関数と同じ名前・引数で実装しているので、
+# secrets.toml の [db] に backend = "sqlite" と書くだけで切り替えられる。
+# （スプレッドシートなしでの動作確認や、負荷試験の手元の代役として使う）
+import sqlite3
+import threading
+import pandas as pd
+
+# --- テーブル定義 ---
+# シート名 = テーブル名。列の並びはスプレッドシートの1行目のヘッダーと同じにする
+SCHEMAS = {
+    'users': [('name', 'TEXT'), ('dob', 'TEXT'), ('height', 'REAL')],
+    'daily': [('name', 'TEXT'), ('date', 'TEXT'), ('weight', 'REAL'), ('body_fat', 'REAL'), ('sleep', 'REAL')],
+    'meal': [('name', 'TEXT'), ('date', 'TEXT'), ('type', 'TEXT'), ('time', 'TEXT'), ('menu', 'TEXT'), ('image_url', 'TEXT')],
+    'exercise': [('name', 'TEXT'), ('date', 'TEXT'), ('time', 'TEXT'), ('content', 'TEXT')],
+    'bowel': [('name', 'TEXT'), ('date', 'TEXT'), ('time', 'TEXT'), ('amount', 'TEXT'), ('hardness', 'TEXT')],
+}
+
+_lock = threading.RLock()
+_conn = None
+_path = None
+
+def connect(path):
+    # 全セッションで1本の接続を共有する（書き込みはロックで順番に行う）
+    global _conn, _path
+    with _lock:
+        if _conn is not None and _path == path:
+            return _conn
+        if _conn is not None:
+            _conn.close()
+        _conn = sqlite3.connect(path, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _path = path
+        for sheet_name, columns in SCHEMAS.items():
+            _create_table(sheet_name, [c for c, _ in columns])
+        return _conn
+
+def _create_table(sheet_name, columns):
+    types = dict(SCHEMAS.get(sheet_name, []))
+    cols = ", ".join(f'"{c}" {types.get(c, "TEXT")}' for c in columns)
+    _conn.execute(f'CREATE TABLE IF NOT EXISTS "{sheet_name}" ({cols})')
+    # 選手ごと・日付ごとの検索はインデックスで引く
+    if 'name' in columns and 'date' in columns:
+        _conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{sheet_name}_name_date" ON "{sheet_name}" (name, date)')
+        _conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{sheet_name}_date" ON "{sheet_name}" (date)')
+    elif 'name' in columns:
+        _conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{sheet_name}_name" ON "{sheet_name}" (name)')
+    _conn.commit()
+
+def _columns(sheet_name):
+    rows = _conn.execute(f'PRAGMA table_info("{sheet_name}")').fetchall()
+    return [r[1] for r in rows]
+
+def _ensure_table(sheet_name, columns):
+    # 定義にないシートは、最初に書き込まれた列でテーブルを作る
+    if not _columns(sheet_name):
+        _create_table(sheet_name, columns)
+
+def _insert(sheet_name, rows):
+    columns = list(rows[0].keys())
+    _ensure_table(sheet_name, columns)
+    col_sql = ", ".join(f'"{c}"' for c in columns)
+    marks = ", ".join("?" for _ in columns)
+    _conn.executemany(
+        f'INSERT INTO "{sheet_name}" ({col_sql}) VALUES ({marks})',
+        [[r.get(c) for c in columns] for r in rows],
+    )
+
+def _select(sheet_name, where="", params=()):
+    columns = _columns(sheet_name)
+    if not columns:
+        return pd.DataFrame()
+    col_sql = ", ".join(f'"{c}"' for c in columns)
+    return pd.read_sql_query(f'SELECT {col_sql} FROM "{sheet_name}" {where} ORDER BY rowid', _conn, params=params)
+
+# --- db.py と同じ公開関数 ---
+def load_data_from_sheet(sheet_name):
+    with _lock:
+        return _select(sheet_name)
+
+def query_rows(sheet_name, name=None, date=None):
+    conditions, params = [], []
+    if name is not None:
+        conditions.append("name = ?")
+        params.append(name)
+    if date is not None:
+        conditions.append("date = ?")
+        params.append(date)
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    with _lock:
+        return _select(sheet_name, where, params)
+
+def player_count(sheet_name, name):
+    with _lock:
+        if not _columns(sheet_name):
+            return 0
+        return _conn.execute(f'SELECT COUNT(*) FROM "{sheet_name}" WHERE name = ?', (name,)).fetchone()[0]
+
+def player_page(sheet_name, name, offset, limit):
+    # その選手の行を新しい順に offset 件目から limit 件。戻り値: (行, 全件数)
+    with _lock:
+        if not _columns(sheet_name):
+            return pd.DataFrame(), 0
+        total = _conn.execute(f'SELECT COUNT(*) FROM "{sheet_name}" WHERE name = ?', (name,)).fetchone()[0]
+        col_sql = ", ".join(f'"{c}"' for c in _columns(sheet_name))
+        rows = pd.read_sql_query(
+            f'SELECT {col_sql} FROM "{sheet_name}" WHERE name = ? ORDER BY date DESC, rowid DESC LIMIT ? OFFSET ?',
+            _conn, params=(name, limit, offset))
+        return rows, total
+
+def append_data_to_sheet(sheet_name, data_dict):
+    append_rows_to_sheets({sheet_name: [data_dict]})
+
+def append_rows_to_sheets(rows_by_sheet):
+    with _lock:
+        for sheet_name, rows in rows_by_sheet.items():
+            if rows:
+                _insert(sheet_name, rows)
+        _conn.commit()
+
+def upsert_rows(sheet_name, key_columns, rows):
+    if not rows:
+        return
+    with _lock:
+        _ensure_table(sheet_name, list(rows[0].keys()))
+        for r in rows:
+            sets = [c for c in r if c not in key_columns]
+            set_sql = ", ".join(f'"{c}" = ?' for c in sets)
+            where_sql = " AND ".join(f'"{c}" = ?' for c in key_columns)
+            cur = _conn.execute(
+                f'UPDATE "{sheet_name}" SET {set_sql} WHERE {where_sql}',
+                [r[c] for c in sets] + [r[c] for c in key_columns],
+            )
+            if cur.rowcount == 0:
+                _insert(sheet_name, [r])
+        _conn.commit()
+
+def delete_rows_where(sheet_names, column, value):
+    counts = {}
+    with _lock:
+        for sheet_name in sheet_names:
+            if column not in _columns(sheet_name):
+                counts[sheet_name] = 0
+                continue
+            cur = _conn.execute(f'DELETE FROM "{sheet_name}" WHERE "{column}" = ?', (value,))
+            counts[sheet_name] = cur.rowcount
+        _conn.commit()
+    return counts
+
+def move_rows_before(sheet_name, cutoff, sink):
+    # cutoff は "YYYY-MM-DD"。日付は文字列で入っているので文字列のまま比べる
+    with _lock:
+        if 'date' not in _columns(sheet_name):
+            return 0
+        # 行の番号（rowid）も _row 列で渡す（移し先で、同じ行を2回受け取ったことが分かるように）
+        col_sql = ", ".join(f'"{c}"' for c in _columns(sheet_name))
+        rows = pd.read_sql_query(
+            f'SELECT rowid AS _row, {col_sql} FROM "{sheet_name}" WHERE date < ? AND date != \'\' ORDER BY rowid',
+            _conn, params=(cutoff,))
+        if rows.empty:
+            return 0
+        sink(rows)
+        _conn.execute(f'DELETE FROM "{sheet_name}" WHERE date < ? AND date != \'\'', (cutoff,))
+        _conn.commit()
+        return len(rows)
+
+def overwrite_sheet_data(sheet_name, df):
+    with _lock:
+        _ensure_table(sheet_name, list(df.columns))
+        _conn.execute(f'DELETE FROM "{sheet_name}"')
+        if not df.empty:
+            _insert(sheet_name, df.to_dict('records'))
+        _conn.commit()
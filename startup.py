@@ -0,0 +1,159 @@
+# startup.py
+# 起動直後の待ち時間を減らす仕組みと、その内訳の記録。
+# - prewarm(): プロセスが立ち上がったら、最初の選手がログインする前に裏のスレッドで
+#   gspread などの読み込み → 認証 → スプレッドシートを開く → users の読み込み を済ませておく
+# - report(): 準備の各段階にかかった時間
+# - python startup.py: 新しいプロセスでアプリの import を測り、モジュールごとの読み込み時間を出す
+#
+#   python startup.py                        # patient_app.py の import の内訳
+#   python startup.py admin_app.py --warm    # 準備（認証など）の時間も測る（secrets.toml が必要）
+import argparse
+import ast
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+import db
+import metrics
+
+PREWARM_SHEETS = db._config("prewarm_sheets", ['users'])
+PREWARM_RETRY_SECONDS = db._config("prewarm_retry_seconds", 30)  # 準備に失敗したシャードをやり直すまでの間隔
+# 起動時には読み込まず、使う画面・処理になってから読み込むモジュール
+DEFERRED_MODULES = ['gspread', 'google.oauth2', 'google.auth.transport.requests', 'plotly.graph_objects', 'cloudinary']
+
+logger = logging.getLogger("startup")
+
+_lock = threading.Lock()
+_threads = {}  # シャード -> 準備のスレッド（いちばん最近のもの）
+_warmed = set()  # 準備が最後まで済んだシャード
+_failed_at = {}  # シャード -> 準備に失敗した時刻
+_steps = []  # [{'shard', 'step', 'seconds', 'error'}]
+
+# --- 裏での準備 ---
+def _import_google():
+    import google.oauth2.service_account
+    import google.auth.transport.requests
+
+def _step(shard, name, func):
+    t = time.perf_counter()
+    error = None
+    try:
+        func()
+    except Exception as e:
+        error = repr(e)
+    seconds = time.perf_counter() - t
+    with _lock:
+        _steps.append({'shard': shard, 'step': name, 'seconds': seconds, 'error': error})
+    metrics.observe('startup_ms', seconds * 1000, step=name)
+    return error is None
+
+def _warm(shard):
+    steps = []
+    if db._local_backend() is None:
+        steps += [
+            ('import gspread', db._gspread),
+            ('import google-auth', _import_google),
+            ('auth', db.get_connection),
+            ('open_by_url', db.get_spreadsheet),
+        ]
+    steps += [(f"load {name}", lambda name=name: db.load_data_from_sheet(name)) for name in PREWARM_SHEETS]
+    ok = True
+    with db.use_shard(shard):
+        for name, func in steps:
+            if not _step(shard, name, func):
+                # 失敗したら後の段階はやらない（画面側のふだんの処理で接続し直す）
+                ok = False
+                break
+    with _lock:
+        # 済んだと覚えるのは最後まで成功したときだけ。失敗したら後の prewarm() でやり直す
+        if ok:
+            _warmed.add(shard)
+            _failed_at.pop(shard, None)
+        else:
+            _failed_at[shard] = time.monotonic()
+    logger.info("prewarm %s: %s", shard, ", ".join(
+        f"{s['step']} {s['seconds']:.2f}s" for s in report() if s['shard'] == shard))
+
+def prewarm(shard=None, wait=False):
+    # 何度呼んでもシャードごとに成功するまでの1回だけ動く（スクリプトの再実行のたびに呼んでよい）。
+    # 失敗したときは PREWARM_RETRY_SECONDS たってから呼ばれたときにやり直す。
+    # 画面側が同じ接続・読み込みを必要としたときは、二重には行わずこちらの完了を待つ
+    shard = db.current_shard() if shard is None else shard
+    with _lock:
+        if shard in _warmed:
+            return
+        thread = _threads.get(shard)
+        failed_at = _failed_at.get(shard)
+        retry = failed_at is not None and time.monotonic() - failed_at >= PREWARM_RETRY_SECONDS
+        if thread is None or (retry and not thread.is_alive()):
+            thread = _threads[shard] = threading.Thread(
+                target=_warm, args=(shard,), name=f"prewarm-{shard}", daemon=True)
+            thread.start()
+    if wait:
+        thread.join()
+
+def report():
+    # 準備の各段階の時間（終わった順）
+    with _lock:
+        return [dict(s) for s in _steps]
+
+# --- import の内訳 ---
+def app_imports(path):
+    # アプリのファイルの先頭で import しているモジュール（書かれている順）
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    names = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.append(node.module)
+    return list(dict.fromkeys(names))
+
+def import_times(modules):
+    # 新しいプロセスで modules を順に import し、({モジュール: 秒}, 読み込まれたモジュール名の集合) を返す。
+    # 先に import したモジュールがついでに読み込んだものは 0 秒になる（時間はそちらに含まれる）
+    code = "; ".join(f"import {m}" for m in modules) + "; import sys; print('\\n'.join(sys.modules))"
+    res = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    if res.returncode:
+        raise RuntimeError(res.stderr.strip().splitlines()[-1])
+    times = {m: 0.0 for m in modules}
+    for line in res.stderr.splitlines():
+        # "import time:  self [us] | cumulative | imported package"。入れ子でない行は名前の前の空白が1つ
+        parts = line.split("|")
+        if not line.startswith("import time:") or len(parts) != 3:
+            continue
+        name = parts[2]
+        if name.startswith(" ") and not name.startswith("  ") and name.strip() in times:
+            times[name.strip()] = int(parts[1]) / 1e6
+    return times, set(res.stdout.split())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="起動時間（モジュールの読み込み・裏での準備）の内訳")
+    parser.add_argument("app", nargs="?", default="patient_app.py", help="測るアプリのファイル")
+    parser.add_argument("--warm", action="store_true", help="認証・スプレッドシートを開く・読み込みの時間も測る")
+    args = parser.parse_args(argv)
+
+    path = args.app if os.path.isabs(args.app) else os.path.join(os.path.dirname(os.path.abspath(__file__)), args.app)
+    times, loaded = import_times(app_imports(path))
+    print(f"モジュールの読み込み（{os.path.basename(path)} の import 順）")
+    for name, seconds in times.items():
+        note = "  ※ Streamlit のサーバーが先に読み込むので、実際の起動では待たない" if name == "streamlit" else ""
+        print(f"  {name:30s} {seconds:7.3f}s{note}")
+    print(f"  {'合計':28s} {sum(times.values()):7.3f}s")
+    print("起動時に読み込まないモジュール")
+    for name in DEFERRED_MODULES:
+        print(f"  {name:30s} {'読み込まれている' if name in loaded else '読み込んでいない（使うときに読み込む）'}")
+
+    if args.warm:
+        prewarm(wait=True)
+        print("裏での準備")
+        for s in report():
+            print(f"  {s['step']:30s} {s['seconds']:7.3f}s" + (f"  失敗: {s['error']}" if s['error'] else ""))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
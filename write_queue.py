@@ -0,0 +1,432 @@
+# write_queue.py
+# 保存ボタンの内容をいったんローカルの記録帳（SQLite）に書き込み、すぐに画面へ返す。
+# スプレッドシートへの書き込みと写真のアップロードは、裏のワーカーがまとめて行う。
+#
+# - 保存1回分ごとの目印（token）をキーにするので、ボタンの連打・再送は1回分しか登録されない。
+#   同じ内容でも、別の回の保存は別に登録する
+# - 失敗したらしばらく待ってから再送する（待ち時間は失敗のたびに伸びる）
+# - 写真は元の大きさのまま記録帳に入れて（保存ボタンは待たせない）、ワーカーが最初に縮小・再圧縮した
+#   ものに入れ替える。記録帳に元の大きな写真を残さない
+# - 写真のアップロードに失敗しても、写真を待たずに他の行は先に送る。写真の行だけを別の保存に分けて
+#   再送し、PHOTO_MAX_ATTEMPTS 回失敗した写真はあきらめて、その行は写真なしで保存する
+# - upsert は何度送っても同じ結果。追加行は1回の batch_update で送り、同じリクエストで保存のキーを
+#   write_log シートにも記録する（db.append_rows_to_sheets）。返事が届かずに失敗扱いになった保存は、
+#   送り直す前にキーが記録されているかを確かめ、届いていれば送り直さない
+# - 保存は、保存したときのシャード（db.py のチーム・シーズン）に送る。ワーカーはシャードごとに
+#   1つずつ動くので、あるチームのスプレッドシートが混んでいても別のチームの保存は待たない
+import hashlib
+import json
+import random
+import sqlite3
+import threading
+import time
+import uuid
+import pandas as pd
+import db
+import photo_upload
+
+JOURNAL_PATH = db._config("journal_path", "write_queue.db")
+BATCH_SIZE = db._config("queue_batch_size", 20)
+RETRY_BASE_SECONDS = db._config("queue_retry_base_seconds", 2)
+RETRY_MAX_SECONDS = db._config("queue_retry_max_seconds", 300)
+PHOTO_MAX_ATTEMPTS = db._config("photo_max_attempts", 5)
+KEEP_DONE_SECONDS = 24 * 60 * 60  # 再送の二重登録を防ぐため、送信済みも1日は残しておく
+
+_lock = threading.Lock()
+_workers = {}  # シャード -> Thread
+_booted = False  # 前回の残りのワーカーを動かしたか
+_wakeups = {}  # シャード -> Event
+
+# 写真のアップロード方法（負荷試験などでは差し替える）
+uploader = photo_upload.upload_to_cloudinary
+
+# --- 記録帳 ---
+def _connect():
+    conn = sqlite3.connect(JOURNAL_PATH, timeout=30)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS journal (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idem_key TEXT UNIQUE,
+            name TEXT,
+            payload TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt REAL DEFAULT 0,
+            last_error TEXT,
+            created_at REAL,
+            shard TEXT DEFAULT 'default'
+        )""")
+    if 'shard' not in [row[1] for row in conn.execute("PRAGMA table_info(journal)")]:
+        # シャードを入れる前に作った記録帳
+        conn.execute("ALTER TABLE journal ADD COLUMN shard TEXT DEFAULT 'default'")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS journal_images (
+            idem_key TEXT,
+            idx INTEGER,
+            data BLOB,
+            url TEXT,
+            error TEXT,
+            attempts INTEGER DEFAULT 0,
+            compressed INTEGER DEFAULT 0,
+            PRIMARY KEY (idem_key, idx)
+        )""")
+    image_columns = [row[1] for row in conn.execute("PRAGMA table_info(journal_images)")]
+    if 'attempts' not in image_columns:
+        conn.execute("ALTER TABLE journal_images ADD COLUMN attempts INTEGER DEFAULT 0")
+    if 'compressed' not in image_columns:
+        conn.execute("ALTER TABLE journal_images ADD COLUMN compressed INTEGER DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_journal_status ON journal (status, next_attempt)")
+    return conn
+
+def make_key(name, token, shard=db.DEFAULT_SHARD):
+    # 保存1回分（token）ごとのキー。同じ token の連打・再送は同じキーになる
+    body = [name, token] if shard == db.DEFAULT_SHARD else [shard, name, token]
+    return hashlib.sha256(json.dumps(body, ensure_ascii=False).encode()).hexdigest()
+
+def new_token():
+    return uuid.uuid4().hex
+
+def fingerprint(ops, images=()):
+    # 保存の中身の要約（画面側で「前回押したときと同じ中身か」を見る用）
+    h = hashlib.sha256(json.dumps(ops, sort_keys=True, ensure_ascii=False, default=str).encode())
+    for data in images:
+        h.update(hashlib.sha256(data).digest())
+    return h.hexdigest()
+
+def enqueue(name, ops, images=(), shard=None, token=None):
+    # ops: [{'op': 'upsert', 'sheet': 'daily', 'key_columns': [...], 'rows': [...]},
+    #       {'op': 'append', 'sheet': 'meal', 'rows': [...]}, ...]
+    # 写真付きの行は 'image_url': '' のまま、'_image': images の番号 を足しておく
+    # shard を省略すると今のシャード（db.current_shard()）に送る
+    # token は保存1回分の目印（画面側で作る）。同じ token は1回分しか登録しない。
+    # 省略すると毎回別の保存として登録する
+    # 戻り値: (キー, 新しく登録されたか)
+    shard = db.current_shard() if shard is None else shard
+    key = make_key(name, token or new_token(), shard)
+    conn = _connect()
+    try:
+        with conn:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO journal (idem_key, name, payload, created_at, shard) VALUES (?, ?, ?, ?, ?)",
+                (key, name, json.dumps(ops, ensure_ascii=False, default=str), time.time(), shard),
+            )
+            is_new = cur.rowcount == 1
+            if is_new:
+                conn.executemany(
+                    "INSERT INTO journal_images (idem_key, idx, data) VALUES (?, ?, ?)",
+                    [(key, i, data) for i, data in enumerate(images)],
+                )
+    finally:
+        conn.close()
+    start(shard)
+    _wakeup(shard).set()
+    return key, is_new
+
+def pending_count(name=None):
+    # name を省略すると全シャード分、指定すると今のシャードのその選手の分
+    conn = _connect()
+    try:
+        if name is None:
+            row = conn.execute("SELECT COUNT(*) FROM journal WHERE status = 'pending'").fetchone()
+        else:
+            row = conn.execute("SELECT COUNT(*) FROM journal WHERE status = 'pending' AND name = ? AND shard = ?",
+                               (name, db.current_shard())).fetchone()
+        return row[0]
+    finally:
+        conn.close()
+
+def pending_rows(sheet_name, name):
+    # まだスプレッドシートに届いていない、その選手の行（振り返りタブでの表示用）
+    conn = _connect()
+    try:
+        payloads = conn.execute(
+            "SELECT payload FROM journal WHERE status = 'pending' AND name = ? AND shard = ? ORDER BY id",
+            (name, db.current_shard())
+        ).fetchall()
+    finally:
+        conn.close()
+    rows = []
+    for (payload,) in payloads:
+        for op in json.loads(payload):
+            if op['sheet'] == sheet_name:
+                rows += [_strip_image_ref(r) for r in op['rows']]
+    return pd.DataFrame(rows)
+
+def failed_upload_count(name):
+    # アップロードに失敗して再送待ちになっている写真の枚数
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT COUNT(*) FROM journal_images i JOIN journal j ON i.idem_key = j.idem_key"
+            " WHERE j.status = 'pending' AND j.name = ? AND j.shard = ? AND i.url IS NULL AND i.error IS NOT NULL",
+            (name, db.current_shard())
+        ).fetchone()
+        return row[0]
+    finally:
+        conn.close()
+
+def lost_photo_count(name):
+    # アップロードをあきらめ、写真なしで保存した写真の枚数（記録帳に残っている直近の分）
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT COUNT(*) FROM journal_images i JOIN journal j ON i.idem_key = j.idem_key"
+            " WHERE j.status = 'done' AND j.name = ? AND j.shard = ? AND i.url IS NULL AND i.attempts >= ?",
+            (name, db.current_shard(), PHOTO_MAX_ATTEMPTS)
+        ).fetchone()
+        return row[0]
+    finally:
+        conn.close()
+
+def _strip_image_ref(row):
+    # 写真はまだアップロードしていないので URL は空
+    row = dict(row)
+    row.pop('_image', None)
+    return row
+
+# --- スプレッドシートへの送信 ---
+def _compress_images(conn, keys):
+    # まだ元の大きさの写真を縮小・再圧縮し、記録帳の中身を入れ替える（1枚ずつ書くので途中で止まっても大丈夫）
+    marks = ", ".join("?" for _ in keys)
+    raw = conn.execute(
+        f"SELECT idem_key, idx, data FROM journal_images"
+        f" WHERE compressed = 0 AND url IS NULL AND idem_key IN ({marks})", keys).fetchall()
+    for key, idx, data in raw:
+        with conn:
+            conn.execute("UPDATE journal_images SET data = ?, compressed = 1 WHERE idem_key = ? AND idx = ?",
+                         (photo_upload.compress_image(data), key, idx))
+
+def _upload_images(conn, keys):
+    # 送信する分の未アップロード写真を、まとめて同時にアップロードする。
+    # 結果（URL または失敗理由）は1枚ずつ記録帳に残し、成功した分は再送時に使い回す。
+    # PHOTO_MAX_ATTEMPTS 回失敗した写真はもう送らない
+    marks = ", ".join("?" for _ in keys)
+    todo = {(key, idx): data for key, idx, data in conn.execute(
+        f"SELECT idem_key, idx, data FROM journal_images"
+        f" WHERE url IS NULL AND attempts < ? AND idem_key IN ({marks})", [PHOTO_MAX_ATTEMPTS] + keys)}
+    if not todo:
+        return
+    results = photo_upload.upload_images(todo, uploader=uploader, compress=False)
+    with conn:
+        for (key, idx), (url, error) in results.items():
+            conn.execute(
+                "UPDATE journal_images SET url = ?, error = ?, attempts = attempts + ? WHERE idem_key = ? AND idx = ?",
+                (url, None if error is None else repr(error), int(error is not None), key, idx),
+            )
+
+def _resolve_images(conn, key, ops):
+    # アップロード済みの URL を行に埋める。
+    # 戻り値: (今送れる ops, 写真の再送待ちの ops, 再送待ちの写真の失敗回数, 最後の失敗理由)
+    # 上限まで失敗した写真はあきらめ、その行は写真なし（image_url が空）で送る
+    images = {idx: (url, error, attempts) for idx, url, error, attempts in conn.execute(
+        "SELECT idx, url, error, attempts FROM journal_images WHERE idem_key = ?", (key,))}
+    ready, waiting = [], []
+    tries, last_error = 0, None
+    for op in ops:
+        now, later = [], []
+        for r in op['rows']:
+            if '_image' in r:
+                url, error, attempts = images[r['_image']]
+                if url is None and attempts < PHOTO_MAX_ATTEMPTS:
+                    later.append(r)
+                    tries, last_error = max(tries, attempts), error
+                    continue
+                r = _strip_image_ref(r)
+                r['image_url'] = url or ""
+            now.append(r)
+        if now:
+            ready.append(dict(op, rows=now))
+        if later:
+            waiting.append(dict(op, rows=later))
+    return ready, waiting, tries, last_error
+
+def _split_photos(conn, entry_id, key, ops, waiting, tries):
+    # 写真の再送待ちの行だけを別の保存に移し、元の保存には今送る分だけを残す（1つのトランザクションで）。
+    # 分けた保存のキーは元のキーから決まるので、同じ保存を二度分けても同じキーになる
+    photo_key = hashlib.sha256(f"{key}:photo".encode()).hexdigest()
+    idxs = [r['_image'] for op in waiting for r in op['rows']]
+    with conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO journal (idem_key, name, payload, created_at, shard, next_attempt)"
+            " SELECT ?, name, ?, created_at, shard, ? FROM journal WHERE id = ?",
+            (photo_key, json.dumps(waiting, ensure_ascii=False, default=str), time.time() + _backoff(tries), entry_id),
+        )
+        conn.executemany("UPDATE journal_images SET idem_key = ? WHERE idem_key = ? AND idx = ?",
+                         [(photo_key, key, idx) for idx in idxs])
+        conn.execute("UPDATE journal SET payload = ? WHERE id = ?",
+                     (json.dumps(ops, ensure_ascii=False, default=str), entry_id))
+
+def _has_append(ops):
+    return any(op['op'] == 'append' for op in ops)
+
+def _flush(entries):
+    # 複数の保存分をまとめて、upsert はシートごとに1回、追加は全シートで1回にする
+    appends = {}
+    upserts = {}
+    for _, _, ops, _ in entries:
+        for op in ops:
+            if op['op'] == 'append':
+                appends.setdefault(op['sheet'], []).extend(op['rows'])
+            else:
+                key_columns = tuple(op['key_columns'])
+                by_key = upserts.setdefault((op['sheet'], key_columns), {})
+                for r in op['rows']:
+                    # 同じキーが複数あれば後から保存した方を残す
+                    by_key[tuple(str(r[c]) for c in key_columns)] = r
+    for (sheet_name, key_columns), by_key in upserts.items():
+        db.upsert_rows(sheet_name, list(key_columns), list(by_key.values()))
+    # upsert の後に追加するので、追加が記録されていればその保存は全部届いている
+    db.append_rows_to_sheets(appends, log_keys=[key for _, _, ops, key in entries if _has_append(ops)])
+
+def _mark_done(conn, entries):
+    with conn:
+        conn.executemany("UPDATE journal SET status = 'done' WHERE id = ?", [(entry[0],) for entry in entries])
+
+def _backoff(attempts):
+    return min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempts) * random.uniform(0.5, 1.0)
+
+def _mark_failed(conn, entry_id, attempts, error):
+    with conn:
+        conn.execute(
+            "UPDATE journal SET attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?",
+            (attempts + 1, time.time() + _backoff(attempts), repr(error), entry_id),
+        )
+
+def _drop_applied(conn, entries):
+    # 前の送信の結果が分からない保存のうち、write_log に記録がある（届いている）ものは送り直さず完了にする
+    keys = [key for _, _, ops, key in entries if _has_append(ops)]
+    if not keys:
+        return entries
+    applied = db.applied_keys(keys)
+    if applied:
+        _mark_done(conn, [entry for entry in entries if entry[3] in applied])
+    return [entry for entry in entries if entry[3] not in applied]
+
+def drain_once(shard=db.DEFAULT_SHARD):
+    # そのシャードの送信できる分を1回まとめて送る。送った件数を返す
+    conn = _connect()
+    try:
+        ready = conn.execute(
+            "SELECT id, idem_key, payload, attempts FROM journal"
+            " WHERE status = 'pending' AND shard = ? AND next_attempt <= ? ORDER BY id LIMIT ?",
+            (shard, time.time(), BATCH_SIZE),
+        ).fetchall()
+        if not ready:
+            return 0
+        with db.use_shard(shard):
+            return _send(conn, ready)
+    finally:
+        conn.close()
+
+def _send(conn, ready):
+    # 取り出した分をまとめて送る（今のシャードへ）。送った件数を返す
+    keys = [key for _, key, _, _ in ready]
+    _compress_images(conn, keys)
+    _upload_images(conn, keys)
+    entries = []
+    for entry_id, key, payload, attempts in ready:
+        try:
+            ops, waiting, tries, error = _resolve_images(conn, key, json.loads(payload))
+        except KeyError:
+            # 読み出した後に別のワーカーが写真の行を分けた。次の回に読み直す
+            continue
+        if waiting and not ops:
+            # 写真の行しかなければ、写真を待って保存ごと再送する
+            _mark_failed(conn, entry_id, attempts, RuntimeError(f"写真のアップロードに失敗しました: {error}"))
+            continue
+        if waiting:
+            _split_photos(conn, entry_id, key, ops, waiting, tries)
+        entries.append((entry_id, attempts, ops, key))
+    # 前に失敗した保存は、実は届いているかもしれないので先に確かめる（順番は保存した順のまま）
+    sent = 0
+    retried = [entry for entry in entries if entry[1] > 0]
+    if retried:
+        try:
+            keep = {entry[0] for entry in _drop_applied(conn, retried)}
+        except Exception as e:
+            for entry in retried:
+                _mark_failed(conn, entry[0], entry[1], e)
+            keep = set()
+        else:
+            sent = len(retried) - len(keep)
+        entries = [entry for entry in entries if entry[1] == 0 or entry[0] in keep]
+    if not entries:
+        return sent
+    try:
+        _flush(entries)
+        _mark_done(conn, entries)
+        return sent + len(entries)
+    except Exception as e:
+        if len(entries) == 1:
+            _mark_failed(conn, entries[0][0], entries[0][1], e)
+            return sent
+    # まとめて送れなかったときは1件ずつ送り、失敗したものだけ後で再送する。
+    # まとめた分が実は届いていることもあるので、先に write_log を確かめる
+    try:
+        remaining = _drop_applied(conn, entries)
+    except Exception as e:
+        for entry in entries:
+            _mark_failed(conn, entry[0], entry[1], e)
+        return sent
+    sent += len(entries) - len(remaining)
+    for entry in remaining:
+        try:
+            _flush([entry])
+            _mark_done(conn, [entry])
+            sent += 1
+        except Exception as e:
+            _mark_failed(conn, entry[0], entry[1], e)
+    return sent
+
+def _purge_done():
+    conn = _connect()
+    try:
+        with conn:
+            old = time.time() - KEEP_DONE_SECONDS
+            conn.execute("DELETE FROM journal_images WHERE idem_key IN"
+                         " (SELECT idem_key FROM journal WHERE status = 'done' AND created_at < ?)", (old,))
+            conn.execute("DELETE FROM journal WHERE status = 'done' AND created_at < ?", (old,))
+    finally:
+        conn.close()
+
+def _wakeup(shard):
+    with _lock:
+        if shard not in _wakeups:
+            _wakeups[shard] = threading.Event()
+        return _wakeups[shard]
+
+def _run_worker(shard):
+    wakeup = _wakeup(shard)
+    while True:
+        try:
+            sent = drain_once(shard)
+        except Exception:
+            sent = 0
+        if sent == 0:
+            # 送るものがなければ、新しい保存が来るか少し経つまで待つ
+            wakeup.wait(timeout=RETRY_BASE_SECONDS)
+            wakeup.clear()
+            _purge_done()
+
+def _pending_shards():
+    conn = _connect()
+    try:
+        return [row[0] for row in conn.execute("SELECT DISTINCT shard FROM journal WHERE status = 'pending'")]
+    finally:
+        conn.close()
+
+def start(shard=None):
+    # ワーカーはシャードごとに1つだけ。プロセスで最初に呼ばれたときは、前回の残り（未送信分）が
+    # あるシャードのワーカーもすべて動かす（選手アプリは起動時に呼ぶので、次の保存を待たずに送る）
+    global _booted
+    shards = [shard] if shard is not None else []
+    if not _booted:
+        _booted = True
+        shards += [s for s in _pending_shards() if s not in shards]
+    with _lock:
+        for key in shards:
+            worker = _workers.get(key)
+            if worker is None or not worker.is_alive():
+                worker = _workers[key] = threading.Thread(
+                    target=_run_worker, args=(key,), name=f"write-queue-{key}", daemon=True)
+                worker.start()